@@ -5,6 +5,8 @@ from .chat import chat_ns
 from .role import role_ns
 from .contact import contact_ns
 from .oauth import oauth_ns
+from .webhook import webhook_ns
+from .image import image_ns
 
 # Create authorizations
 authorizations = {
@@ -35,4 +37,6 @@ api.add_namespace(user_ns)
 api.add_namespace(role_ns)
 api.add_namespace(contact_ns)
 api.add_namespace(chat_ns)
-api.add_namespace(oauth_ns)
\ No newline at end of file
+api.add_namespace(oauth_ns)
+api.add_namespace(webhook_ns)
+api.add_namespace(image_ns)
\ No newline at end of file
@@ -1,6 +1,6 @@
 from flask_restx import Resource, Namespace
 from flask_jwt_extended import jwt_required, current_user, verify_jwt_in_request
-from flask import request
+from flask import Response, request
 from decorators import admin_required, privacy_accepted_required, terms_accepted_required
 from init import db, fernet, limiter, redis
 
@@ -11,7 +11,10 @@ from models.oauth import Oauth
 from functions.api_model import APIModel
 from functions.api import rate_limit_key, role_bypass
 
-from functions.chat import ChatAssistant
+from functions.ai_cache import AIResponseCache
+from functions.chat import ChatAssistant, providers
+from functions.jobs import AIJobs
+from functions.oauth import get_mail_client
 from models.chat import Chat as ChatModel, ChatMessages
 
 # Create Chat API namespace
@@ -165,6 +168,17 @@ class EmailGeneration(Resource):
             chat_ns.abort(404, 'Email Authentication not found.')
             
         ai = data['ai'] if 'ai' in data else 'workersai'
+        
+        # Hand the AI call to the job worker and return the job at once
+        if AIJobs.ENABLED:
+            return AIJobs.enqueue(current_user.id, 'generate', {
+                'contacts': contacts,
+                'instruction': data['instruction'],
+                'language_tone': data['language_tone'],
+                'length': data['length'],
+                'oauth_id': oauth.id,
+                'ai': ai
+            })
                         
         # generate the email
         email_data = ChatAssistant.generate_email(
@@ -173,7 +187,8 @@ class EmailGeneration(Resource):
             language_tone=data['language_tone'],
             length=data['length'],
             oauth=oauth,
-            ai=ai
+            ai=ai,
+            stream=data.get('stream', False)
         )
 
         # return the email data
@@ -191,6 +206,17 @@ class EmailGeneration(Resource):
         
         ai = data['ai'] if 'ai' in data else 'workersai'
         
+        # Hand the AI call to the job worker and return the job at once
+        if AIJobs.ENABLED:
+            return AIJobs.enqueue(current_user.id, 'modify', {
+                'chat_id': data['chat_id'],
+                'contacts': contacts,
+                'instruction': data['instruction'],
+                'language_tone': data['language_tone'],
+                'length': data['length'],
+                'ai': ai
+            })
+        
         # modify the email
         email_data = ChatAssistant.modify_email(
             contacts=contacts,
@@ -198,7 +224,8 @@ class EmailGeneration(Resource):
             instruction=data['instruction'],
             language_tone=data['language_tone'],
             length=data['length'],
-            ai=ai
+            ai=ai,
+            stream=data.get('stream', False)
         )
         
         # return the email data
@@ -290,6 +317,16 @@ class SetParaphrase(Resource):
         
         if not message:
             return {'message': 'Message not found'}, 404
+        
+        # Hand the AI call to the job worker and return the job at once
+        if AIJobs.ENABLED:
+            return AIJobs.enqueue(current_user.id, 'paraphrase', {
+                'message_id': message_id,
+                'text': text,
+                'type': type,
+                'position': position,
+                'ai': ai
+            })
             
         paraphrase = ChatAssistant.paraphrase_text(
             text=text,
@@ -299,15 +336,7 @@ class SetParaphrase(Resource):
         if not paraphrase:
             return {'message': 'Error paraphrasing text'}, 400
         
-        response = {
-            'original': text,
-            'paraphrase': paraphrase,
-            'type': type,
-            'position': position
-        }
-        
-        redis.setex(f'paraphrase_{message_id}', 60, json.dumps(response))
-        # redis.set(f'paraphrase_{message_id}', json.dumps(response))
+        response = ChatAssistant.save_paraphrase(message_id, text, paraphrase, type, position)
             
         return response, 200
     
@@ -371,6 +400,7 @@ class SmartReply(Resource):
         sender = data['sender'] if 'sender' in data else None
         instruction = data['instruction'] if 'instruction' in data else None
         oauth_id = data['oauth_id'] if 'oauth_id' in data else None
+        message_id = data['message_id'] if 'message_id' in data else None
         ai = data['ai'] if 'ai' in data else 'workersai'
         
         oauth = Oauth.query.filter_by(id=oauth_id, user_id=current_user.id).first()
@@ -378,6 +408,17 @@ class SmartReply(Resource):
         if not oauth:
             return {'message': 'Email Authentication not found'}, 404
         
+        # Read the original message from the message cache instead of the request
+        if message_id:
+            message = get_mail_client(oauth).get_message(message_id)
+            
+            if 'message' in message:
+                return {'message': 'Message not found'}, 404
+            
+            subject = subject or message['subject']
+            body = message['body']
+            sender = sender or message['from']
+        
         if not subject:
             return {'message': 'Subject is required'}, 400
         
@@ -390,6 +431,17 @@ class SmartReply(Resource):
         if not sender:
             return {'message': 'Sender is required'}, 400
         
+        # Hand the AI call to the job worker and return the job at once
+        if AIJobs.ENABLED:
+            return AIJobs.enqueue(current_user.id, 'smart_reply', {
+                'subject': subject,
+                'body': body,
+                'sender': sender,
+                'instruction': instruction,
+                'oauth_id': oauth.id,
+                'ai': ai
+            })
+        
         reply = ChatAssistant.smart_reply(
             subject=subject,
             body=body,
@@ -407,3 +459,67 @@ class SmartReply(Resource):
             return {'message': 'Error generating smart reply'}, 400
         
         return response, 200
+
+# AI Job API (/api/chat/job/<job_id>) - GET, DELETE methods
+@chat_ns.route('/job/<string:job_id>')
+class AIJob(Resource):
+    
+    # Get the status and result of an AI job
+    @chat_ns.doc(security='JWT', description='Get the status and result of an AI job', responses={200: 'Success', 401: 'Unauthorized', 404: 'Job not found'})
+    def get(self, job_id):
+        job = AIJobs.get(job_id, current_user.id)
+        
+        if not job:
+            return {'message': 'Job not found'}, 404
+        
+        return job, 200
+    
+    # Cancel an AI job
+    @chat_ns.doc(security='JWT', description='Cancel an AI job', responses={200: 'Success', 401: 'Unauthorized', 404: 'Job not found'})
+    def delete(self, job_id):
+        job = AIJobs.cancel(job_id, current_user.id)
+        
+        if not job:
+            return {'message': 'Job not found'}, 404
+        
+        return job, 200
+
+# AI Job Stream API (/api/chat/job/<job_id>/stream) - GET method
+@chat_ns.route('/job/<string:job_id>/stream')
+class AIJobStream(Resource):
+    
+    # Stream the events of an AI job as Server-Sent Events
+    @chat_ns.doc(security='JWT', description='Stream the events of an AI job', responses={200: 'Success', 401: 'Unauthorized', 404: 'Job not found'})
+    def get(self, job_id):
+        if not AIJobs.get(job_id, current_user.id):
+            return {'message': 'Job not found'}, 404
+        
+        def events():
+            for event, data in AIJobs.events(job_id):
+                # Comments keep idle connections open through proxies
+                yield ': ping\n\n' if event == 'ping' else ChatAssistant.sse(event, data)
+        
+        return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# AI Hedging Metrics API (/api/chat/metrics/hedging) - GET method
+@chat_ns.route('/metrics/hedging')
+class HedgingMetrics(Resource):
+    
+    # Get how often the hedged AI requests were sent and won
+    @admin_required
+    @chat_ns.doc(security='JWT', description='Get the AI request hedging metrics', responses={200: 'Success', 401: 'Unauthorized', 403: 'Forbidden'})
+    def get(self):
+        return {
+            'enabled': providers.HEDGING,
+            'routes': providers.hedge_metrics()
+        }, 200
+
+# AI Cache Metrics API (/api/chat/metrics/cache) - GET method
+@chat_ns.route('/metrics/cache')
+class CacheMetrics(Resource):
+    
+    # Get the size and hit ratio of the AI response cache
+    @admin_required
+    @chat_ns.doc(security='JWT', description='Get the AI response cache metrics', responses={200: 'Success', 401: 'Unauthorized', 403: 'Forbidden'})
+    def get(self):
+        return AIResponseCache.stats(), 200
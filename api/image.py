@@ -0,0 +1,73 @@
+from flask_restx import Resource, Namespace
+from flask_jwt_extended import jwt_required, current_user
+from flask import send_file
+
+from init import fernet, limiter
+
+import json
+from io import BytesIO
+
+from functions.api import rate_limit_key
+from functions.images import InlineImages
+from functions.oauth import Google, Microsoft
+
+from models.oauth import Oauth
+
+# Create Image API namespace
+image_ns = Namespace('image', description='Inline email image proxy API')
+
+# Create rate limit for Image API
+rate_limiter = limiter.shared_limit("600 per minute", key_func=rate_limit_key, scope='image', error_message='Too many requests, please slow down')
+
+# Apply decorators to Image API, browsers send the JWT cookie with image requests
+image_ns.decorators = [jwt_required(), rate_limiter]
+
+# Image Proxy API (/api/image/<string:token>) - GET method
+@image_ns.route('/<string:token>')
+class InlineImage(Resource):
+
+    # Get an inline image of a message
+    @image_ns.doc(security='JWT', description='Get an inline image of a message through a signed URL', responses={200: 'Success', 304: 'Not Modified', 401: 'Unauthorized', 404: 'Not Found'})
+    def get(self, token):
+        # Check the signature of the URL
+        image = InlineImages.verify(token)
+
+        if not image:
+            image_ns.abort(404, 'Image not found.')
+
+        # Get the OAuth account, only its owner may see its images
+        oauth = Oauth.query.filter_by(id=image['oauth_id'], service=image['service'], user_id=current_user.id).first()
+
+        # Check if the OAuth account exists
+        if not oauth:
+            image_ns.abort(404, 'Image not found.')
+
+        # Only serve images, anything else is downloaded as a plain file
+        mime_type = image['mime_type'] if (image['mime_type'] or '').startswith('image/') else 'application/octet-stream'
+
+        # Serve the image from the disk cache when possible
+        path = InlineImages.get_cached(image)
+
+        if not path:
+            # Decrypt the OAuth data
+            oauth_data = json.loads(str(fernet.decrypt(oauth.data.encode()).decode()).replace("'", '"'))
+
+            # Download the image from the provider
+            if oauth.service == 'google':
+                data = Google(oauth_data, oauth_id=oauth.id).attachment_data(image['message_id'], image['attachment_id'])
+            else:
+                data = Microsoft(oauth_data, oauth_id=oauth.id).get_attachment(image['message_id'], image['attachment_id'])
+
+            if not data:
+                image_ns.abort(404, 'Image not found.')
+
+            # Serve the image from memory if it could not be cached
+            path = InlineImages.store(image, data) or BytesIO(data)
+
+        # Images never change, let the browser keep them
+        response = send_file(path, mimetype=mime_type, max_age=InlineImages.BROWSER_MAX_AGE, conditional=True, etag=token[-32:])
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+
+        return response
@@ -1,6 +1,6 @@
 from flask_restx import Resource, Namespace
 from flask_jwt_extended import jwt_required, current_user
-from flask import request
+from flask import request, Response
 
 from decorators import privacy_accepted_required, terms_accepted_required
 from init import db, fernet, limiter
@@ -11,7 +11,16 @@ from functions.api_model import APIModel
 from functions.api import rate_limit_key
 
 from models.oauth import Oauth
+from models.mailbox import MailboxMessage, MailboxSync, MailboxSubscription
 from functions.oauth import Google, Microsoft
+from functions.sync import GmailSync, OutlookSync
+from functions.folders import FolderRegistry
+from functions.message_cache import MessageCache, PageCache
+from functions.prefetch import Prefetcher
+from functions.projection import SUMMARY, MESSAGE
+from functions.inbox import UnifiedInbox
+from functions.attachments import AttachmentStream
+from functions.images import InlineImages
 
 # Create OAuth API namespace
 oauth_ns = Namespace('link', description='OAuth related operations API')
@@ -74,12 +83,32 @@ class OAuthID(Resource):
             # Return an error message
             oauth_ns.abort(404, 'Account not found.')
         
+        # Delete the local mailbox index of the account
+        MailboxMessage.query.filter_by(oauth_id=oauth_id).delete()
+        MailboxSync.query.filter_by(oauth_id=oauth_id).delete()
+        MailboxSubscription.query.filter_by(oauth_id=oauth_id).delete()
+        
         # Delete the OAuth
         db.session.delete(oauth)
         
         # Commit the changes
         db.session.commit()
         
+        # Remove the cached folders of the account
+        FolderRegistry.invalidate(oauth_id)
+        
+        # Remove the cached messages of the account
+        MessageCache.clear(oauth_id)
+        
+        # Remove the cached inline images of the account
+        InlineImages.clear(oauth_id)
+        
+        # Remove the cached credentials of the account
+        if oauth.service == 'google':
+            Google.clear_cached_credentials(oauth_id)
+        elif oauth.service == 'microsoft':
+            Microsoft.clear_cached_token(oauth_id)
+        
         # Return a success message
         return {'message': 'Acount unlinked successfully.'}, 200
 
@@ -135,6 +164,9 @@ class OAuth(Resource):
                     oauth.last_name = last_name
                     # Commit the changes
                     db.session.commit()
+                    
+                    # Drop the credentials cached for the previous link
+                    Google.clear_cached_credentials(oauth.id)
                 else:
                     # Create a new Google OAuth account
                     new_oauth = Oauth(
@@ -190,6 +222,9 @@ class OAuth(Resource):
                     oauth.last_name = last_name
                     # Commit the changes
                     db.session.commit()
+                    
+                    # Drop the access token cached for the previous link
+                    Microsoft.clear_cached_token(oauth.id)
                 else:
                     # Create a new Microsoft OAuth account
                     new_oauth = Oauth(user_id=user_id, service=service, email=email, first_name=first_name, last_name=last_name, data=fernet.encrypt(str(data).encode()).decode())
@@ -208,9 +243,54 @@ class OAuth(Resource):
             # Return an error message
             oauth_ns.abort(400, 'Service not found.')
         
+# OAuth Unified Inbox API (/api/link/inbox) - POST method
+@oauth_ns.route('/inbox')
+class OAuthInbox(Resource):
+    
+    # Get the messages of every linked account merged by date
+    @oauth_ns.doc(security='JWT', description='Get the messages of every linked account merged by date', responses={200: 'Success', 401: 'Unauthorized', 404: 'Not Found'})
+    def post(self):
+        # Get the current user
+        user = current_user
+        
+        # Get the data from the request
+        data = request.get_json(silent=True) or {}
+        
+        # Check if the user is confirmed
+        if not user.email_confirmed_at:
+            # Return an error message
+            return {'message': 'You need to verify your account before linking your Google account.'}, 401
+        
+        # Get the linked accounts
+        accounts = Oauth.query.filter_by(user_id=user.id).all()
+        
+        # Check if the user has linked accounts
+        if not accounts:
+            # Return an error message
+            oauth_ns.abort(404, 'Account not found.')
+        
+        # Get the query, folder_name, max_results, and cursor from the data
+        query = data['query'] if 'query' in data else None
+        folder_name = data['folder_name'] if 'folder_name' in data else 'inbox'
+        max_results = data['max_result'] if 'max_result' in data else 10
+        # Set the max_results to 10 if it is greater than 10
+        if max_results > 10:
+            max_results = 10
+        # Get the composite cursor holding the page of every account
+        next_page = data['next_page'] if 'next_page' in data else None
+        view = data['view'] if 'view' in data else request.args.get('view', 'summary')
+        
+        # Query every account concurrently and merge the messages
+        messages = UnifiedInbox(accounts).list_messages(query=query, cursor=next_page, max_results=max_results, folder_name=folder_name, view=view)
+        
+        # Return the messages
+        return messages, 200
+        
 # OAuth Messages API (/api/link/google/<int:oauth_id>) - GET, POST methods
 @oauth_ns.route('/<string:service>/<int:oauth_id>')
 class OAuthMessages(Resource):
+        # Fields of every listed message, per view
+        projections = {'summary': SUMMARY, 'full': MESSAGE}
         
         # Get the messages from the Google account
         @oauth_ns.doc(security='JWT', description='Get the messages from the Google account', responses={200: 'Success', 401: 'Unauthorized', 404: 'Not Found'})
@@ -248,15 +328,27 @@ class OAuthMessages(Resource):
 
                 # Get the next_page_token from the data
                 next_page = data['next_page'] if 'next_page' in data else None
+                # Get the view, summary returns headers and snippet only
+                view = data['view'] if 'view' in data else request.args.get('view', 'full')
 
-                # Decrypt the OAuth data
-                oauth_data = fernet.decrypt(oauth.data.encode()).decode()
+                params = {'query': query, 'max_results': max_results, 'next_page': next_page, 'folder_name': folder_name, 'view': view}
 
-                # Create a new Google object
-                google = Google(json.loads(str(oauth_data).replace("'", '"')))
+                # Serve the page from the prefetch cache when it was warmed
+                messages = PageCache.get(oauth.id, params)
+
+                if messages is None:
+                    # Decrypt the OAuth data
+                    oauth_data = fernet.decrypt(oauth.data.encode()).decode()
 
-                # Get the messages
-                messages = google.list_messages(query=query, max_results=max_results, next_page=next_page, folder_name=folder_name)
+                    # Create a new Google object
+                    google = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
+
+                    # Get the messages
+                    messages = google.list_messages(**params, projection=self.projections.get(view))
+
+                # Warm the next page and the unread messages in the background
+                if data.get('prefetch'):
+                    Prefetcher.schedule(user.id, oauth, params, messages)
 
                 # Return the messages
                 return messages, 200
@@ -267,15 +359,26 @@ class OAuthMessages(Resource):
                 query = data['query'] if 'query' in data else None
                 max_results = data['max_result'] if 'max_result' in data else 10
                 next_page = data['next_page'] if 'next_page' in data else None
+                view = data['view'] if 'view' in data else request.args.get('view', 'full')
                 
-                # Decrypt the OAuth data
-                oauth_data = fernet.decrypt(oauth.data.encode()).decode()
+                params = {'query': query, 'max_results': max_results, 'next_page': next_page, 'folder_name': folder_name, 'view': view}
                 
-                # Create a new Microsoft object
-                microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')))
+                # Serve the page from the prefetch cache when it was warmed
+                messages = PageCache.get(oauth.id, params)
                 
-                # Get the messages
-                messages = microsoft.list_messages(query=query, max_results=max_results, next_page=next_page, folder_name=folder_name)
+                if messages is None:
+                    # Decrypt the OAuth data
+                    oauth_data = fernet.decrypt(oauth.data.encode()).decode()
+                    
+                    # Create a new Microsoft object
+                    microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
+                    
+                    # Get the messages
+                    messages = microsoft.list_messages(**params, projection=self.projections.get(view))
+                
+                # Warm the next page and the unread messages in the background
+                if data.get('prefetch'):
+                    Prefetcher.schedule(user.id, oauth, params, messages)
                 
                 # Return the messages
                 return messages, 200
@@ -286,6 +389,9 @@ class OAuthMessages(Resource):
 # OAuth Message API (/api/link/<string:service>/<int:oauth_id>/message/<string:message_id>) - GET method
 @oauth_ns.route('/<string:service>/<int:oauth_id>/message/<string:message_id>')
 class OAuthMessage(Resource):
+        # Fields of the opened message
+        projection = MESSAGE
+        
         # Get the message from the Google account
         @oauth_ns.doc(security='JWT', description='Get the message from the Google account', responses={200: 'Success', 401: 'Unauthorized', 404: 'Not Found'})
         def get(self, oauth_id, message_id, service):
@@ -305,24 +411,27 @@ class OAuthMessage(Resource):
                 # Return an error message
                 oauth_ns.abort(404, 'Account not found.')
             
+            # Opening messages keeps the prefetch of the user going
+            Prefetcher.mark_active(user.id)
+            
             # Decrypt the OAuth data
             oauth_data = fernet.decrypt(oauth.data.encode()).decode()
             
             # Check if the service is Google
             if service == 'google':
                 # Create a new Google object
-                google = Google(json.loads(str(oauth_data).replace("'", '"')))
+                google = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
             
                 # Get the message
-                message = google.get_message(message_id)
+                message = google.get_message(message_id, projection=self.projection)
                 
             # Check if the service is Microsoft
             elif service == 'microsoft':
                 # Create a new Microsoft object
-                microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')))
+                microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
                 
                 # Get the message
-                message = microsoft.get_message(message_id)
+                message = microsoft.get_message(message_id, projection=self.projection)
             else:
                 # Return an error message
                 oauth_ns.abort(404, 'Service not found.')
@@ -330,6 +439,67 @@ class OAuthMessage(Resource):
             # Return the message
             return message, 200
         
+# OAuth Message Attachment API (/api/link/<string:service>/<int:oauth_id>/message/<string:message_id>/attachment/<string:attachment_id>) - GET method
+@oauth_ns.route('/<string:service>/<int:oauth_id>/message/<string:message_id>/attachment/<string:attachment_id>')
+class OAuthMessageAttachment(Resource):
+    
+    # Download an attachment of the message
+    @oauth_ns.doc(security='JWT', description='Stream an attachment of the message, supports Range requests', responses={200: 'Success', 206: 'Partial Content', 304: 'Not Modified', 401: 'Unauthorized', 404: 'Not Found', 416: 'Range Not Satisfiable'})
+    def get(self, oauth_id, message_id, attachment_id, service):
+        # Get the current user
+        user = current_user
+        
+        # Check if the user is confirmed
+        if not user.email_confirmed_at:
+            # Return an error message
+            return {'message': 'You need to verify your account before linking your Google account.'}, 401
+        
+        # Get the OAuth account
+        oauth = Oauth.query.filter_by(id=oauth_id, user_id=user.id).first()
+        
+        # Check if the OAuth account exists
+        if not oauth:
+            # Return an error message
+            oauth_ns.abort(404, 'Account not found.')
+        
+        etag = AttachmentStream.etag(service, message_id, attachment_id)
+        
+        # Answer revalidations without downloading the attachment again
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': AttachmentStream.CACHE_CONTROL})
+        
+        # Decrypt the OAuth data
+        oauth_data = fernet.decrypt(oauth.data.encode()).decode()
+        
+        # Check if the service is Google
+        if service == 'google':
+            # Create a new Google object
+            client = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
+        
+        # Check if the service is Microsoft
+        elif service == 'microsoft':
+            # Create a new Microsoft object
+            client = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
+        else:
+            # Return an error message
+            oauth_ns.abort(404, 'Service not found.')
+        
+        # Open the attachment without reading it into memory
+        attachment = client.open_attachment(message_id, attachment_id, AttachmentStream.CHUNK_SIZE)
+        
+        # Check if the attachment exists
+        if not attachment:
+            # Return an error message
+            oauth_ns.abort(404, 'Attachment not found.')
+        
+        # Stream the attachment
+        return AttachmentStream.response(
+            attachment,
+            etag,
+            range_header=request.headers.get('Range'),
+            if_range=request.headers.get('If-Range')
+            )
+        
 # OAuth Folder API (/api/link/<string:service>/<int:oauth_id>/folder) - GET method
 @oauth_ns.route('/<string:service>/<int:oauth_id>/folder')
 class OAuthFolder(Resource):
@@ -359,7 +529,7 @@ class OAuthFolder(Resource):
         # Check if the service is Google
         if service == 'google':
             # Create a new Google object
-            google = Google(json.loads(str(oauth_data).replace("'", '"')))
+            google = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
         
             # Get the folders
             folders = google.list_folders()
@@ -367,7 +537,7 @@ class OAuthFolder(Resource):
         # Check if the service is Microsoft
         elif service == 'microsoft':
             # Create a new Microsoft object
-            microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')))
+            microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
             
             # Get the folders
             folders = microsoft.list_folders()
@@ -407,7 +577,7 @@ class OAuthSingleFolder(Resource):
             # Check if the service is Google
             if service == 'google':
                 # Create a new Google object
-                google = Google(json.loads(str(oauth_data).replace("'", '"')))
+                google = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
             
                 # Get the messages from the folder
                 messages = google.get_folder(folder_name=folder_name)
@@ -415,7 +585,7 @@ class OAuthSingleFolder(Resource):
             # Check if the service is Microsoft
             elif service == 'microsoft':
                 # Create a new Microsoft object
-                microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')))
+                microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
                 
                 # Get the messages from the folder
                 messages = microsoft.get_folder(folder_name=folder_name)
@@ -458,12 +628,16 @@ class OAuthMessageAction(Resource):
                 # Check if the service is Google
                 if service == 'google':
                     # Create a new Google object
-                    google = Google(json.loads(str(oauth_data).replace("'", '"')))
+                    google = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
                     
                     if action == 'read':
                         # Mark the message as read
                         update = google.read_message(message_id)
                         
+                        # Keep the local mailbox index in step
+                        if update:
+                            GmailSync.update_message(oauth.id, message_id, 'read')
+                        
                         # Check if the message was updated
                         if update:
                             # Return a success message
@@ -476,6 +650,10 @@ class OAuthMessageAction(Resource):
                         # Mark the message as unread
                         update = google.unread_message(message_id)
                         
+                        # Keep the local mailbox index in step
+                        if update:
+                            GmailSync.update_message(oauth.id, message_id, 'unread')
+                        
                         # Check if the message was updated
                         if update:
                             # Return a success message
@@ -487,6 +665,10 @@ class OAuthMessageAction(Resource):
                         # Delete the message
                         update = google.delete_message(message_id)
                         
+                        # Keep the local mailbox index in step
+                        if update:
+                            GmailSync.update_message(oauth.id, message_id, 'delete')
+                        
                         # Check if the message was deleted
                         if update:
                             # Return a success message
@@ -498,12 +680,16 @@ class OAuthMessageAction(Resource):
                 # Check if the service is Microsoft
                 elif service == 'microsoft':
                     # Create a new Microsoft object
-                    microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')))
+                    microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
                     
                     if action == 'read':
                         # Mark the message as read
                         update = microsoft.read_message(message_id)
                         
+                        # Keep the local mailbox index in step
+                        if update:
+                            OutlookSync.update_message(oauth.id, message_id, 'read')
+                        
                         # Check if the message was updated
                         if update:
                             # Return a success message
@@ -516,6 +702,10 @@ class OAuthMessageAction(Resource):
                         # Mark the message as unread
                         update = microsoft.unread_message(message_id)
                         
+                        # Keep the local mailbox index in step
+                        if update:
+                            OutlookSync.update_message(oauth.id, message_id, 'unread')
+                        
                         # Check if the message was updated
                         if update:
                             # Return a success message
@@ -527,6 +717,10 @@ class OAuthMessageAction(Resource):
                         # Delete the message
                         update = microsoft.delete_message(message_id)
                         
+                        # Keep the local mailbox index in step
+                        if update:
+                            OutlookSync.update_message(oauth.id, message_id, 'delete')
+                        
                         # Check if the message was deleted
                         if update:
                             # Return a success message
@@ -538,6 +732,85 @@ class OAuthMessageAction(Resource):
                     # Return an error message
                     oauth_ns.abort(404, 'Service not found.')
                     
+# OAuth Bulk Message Action API (/api/link/<string:service>/<int:oauth_id>/messages/actions) - POST method
+@oauth_ns.route('/<string:service>/<int:oauth_id>/messages/actions')
+class OAuthMessagesAction(Resource):
+    
+    # Update the status of several messages
+    @oauth_ns.doc(security='JWT', description='Mark several messages as read or unread, or delete them', responses={200: 'Success', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found'})
+    def post(self, oauth_id, service):
+        # Get the current user
+        user = current_user
+        
+        # Check if the user is confirmed
+        if not user.email_confirmed_at:
+            # Return an error message
+            return {'message': 'You need to verify your account before linking your Google account.'}, 401
+        
+        # Get the data from the request
+        data = request.get_json()
+        
+        # Get the message IDs and the action
+        message_ids = data['message_ids'] if 'message_ids' in data else None
+        action = data['action'].lower() if 'action' in data and data['action'] else None
+        
+        # Check if the message IDs are a non-empty list of strings
+        if not isinstance(message_ids, list) or not message_ids or not all(isinstance(message_id, str) for message_id in message_ids):
+            return {'message': 'Message IDs are required.'}, 400
+        
+        # Check if the action is supported
+        if action not in ['read', 'unread', 'delete']:
+            return {'message': 'Action must be read, unread or delete.'}, 400
+        
+        # Remove duplicate message IDs while keeping their order
+        message_ids = list(dict.fromkeys(message_ids))
+        
+        # Get the OAuth account
+        oauth = Oauth.query.filter_by(id=oauth_id, user_id=user.id, service=service).first()
+        
+        # Check if the OAuth account exists
+        if not oauth:
+            # Return an error message
+            oauth_ns.abort(404, 'Account not found.')
+        
+        # Decrypt the OAuth data
+        oauth_data = fernet.decrypt(oauth.data.encode()).decode()
+        
+        # Check if the service is Google
+        if service == 'google':
+            # Create a new Google object
+            google = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
+            
+            # Apply the action with Gmail batchModify or batchDelete
+            results = google.batch_message_action(message_ids, action)
+            mailbox = GmailSync
+        # Check if the service is Microsoft
+        elif service == 'microsoft':
+            # Create a new Microsoft object
+            microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
+            
+            # Apply the action with a Graph $batch request
+            results = microsoft.batch_message_action(message_ids, action)
+            mailbox = OutlookSync
+        else:
+            # Return an error message
+            oauth_ns.abort(404, 'Service not found.')
+        
+        # Keep the local mailbox index in step
+        for message_id, update in results.items():
+            if update:
+                mailbox.update_message(oauth.id, message_id, action)
+        
+        # Check if any message was updated
+        if not any(results.values()):
+            oauth_ns.abort(400, 'No message was updated.')
+        
+        # Return the result of every message
+        return {
+            'message': f'{sum(results.values())} of {len(results)} messages updated successfully.',
+            'results': results
+        }, 200
+        
 # OAuth Message Reply API (/api/link/<string:service>/<int:oauth_id>/message/<string:message_id>/reply) - POST method
 @oauth_ns.route('/<string:service>/<int:oauth_id>/message/<string:message_id>/reply')
 class OAuthMessageReply(Resource):
@@ -570,7 +843,7 @@ class OAuthMessageReply(Resource):
             # Check if the service is Google
             if service == 'google':
                 # Create a new Google object
-                google = Google(json.loads(str(oauth_data).replace("'", '"')))
+                google = Google(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
                 
                 if not 'body' in data or not data['body']:
                     # Return an error message
@@ -608,7 +881,7 @@ class OAuthMessageReply(Resource):
             # Check if the service is Microsoft
             elif service == 'microsoft':
                 # Create a new Microsoft object
-                microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')))
+                microsoft = Microsoft(json.loads(str(oauth_data).replace("'", '"')), oauth_id=oauth.id)
                 
                 if not 'body' in data or not data['body']:
                     # Return an error message
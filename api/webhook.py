@@ -0,0 +1,59 @@
+from flask_restx import Resource, Namespace
+from flask import make_response, request
+
+from init import limiter
+
+from functions.api import rate_limit_key
+from functions.push import PushNotifications
+
+# Create Webhook API namespace
+webhook_ns = Namespace('webhook', description='Mailbox push notification API')
+
+# Create rate limit for Webhook API
+rate_limiter = limiter.shared_limit("1200 per minute", key_func=rate_limit_key, scope='webhook', error_message='Too many requests, please slow down')
+
+# Apply decorators to Webhook API, providers call it without a user session
+webhook_ns.decorators = [rate_limiter]
+
+# Google Webhook API (/api/webhook/google) - POST method
+@webhook_ns.route('/google')
+class GoogleWebhook(Resource):
+    
+    # Receive a Gmail notification pushed by Pub/Sub
+    @webhook_ns.doc(description='Receive a Gmail push notification', params={'token': 'The webhook secret'}, responses={204: 'Accepted', 403: 'Forbidden'})
+    def post(self):
+        # Check the secret configured on the Pub/Sub push subscription
+        if not PushNotifications.verify_token(request.args.get('token')):
+            webhook_ns.abort(403, 'Forbidden request.')
+        
+        # Get the data from the request
+        data = request.get_json(silent=True) or {}
+        
+        # Invalidate the mailbox of the account
+        PushNotifications.handle_google(data)
+        
+        # Always acknowledge, Pub/Sub retries every other status
+        return '', 204
+    
+# Microsoft Webhook API (/api/webhook/microsoft) - POST method
+@webhook_ns.route('/microsoft')
+class MicrosoftWebhook(Resource):
+    
+    # Receive a Microsoft Graph change notification
+    @webhook_ns.doc(description='Receive a Microsoft Graph change notification', params={'validationToken': 'The subscription validation token'}, responses={200: 'Validated', 202: 'Accepted'})
+    def post(self):
+        # Echo the validation token when Graph creates the subscription
+        validation_token = request.args.get('validationToken')
+        if validation_token:
+            response = make_response(validation_token, 200)
+            response.mimetype = 'text/plain'
+            return response
+        
+        # Get the data from the request
+        data = request.get_json(silent=True) or {}
+        
+        # Invalidate the mailboxes of the notified accounts
+        PushNotifications.handle_microsoft(data)
+        
+        # Acknowledge the notifications
+        return '', 202
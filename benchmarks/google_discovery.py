@@ -0,0 +1,29 @@
+import json
+import timeit
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+# Number of service constructions per measurement
+iterations = 50
+
+# Dummy credentials, no request is sent to Google
+credentials = Credentials(token='benchmark-token')
+
+# Parse the static discovery document once, as the worker cache does
+document = json.loads(get_static_doc('gmail', 'v1'))
+
+# Build the service the way every request used to
+def build_uncached():
+    build('gmail', 'v1', credentials=credentials)
+
+# Build the service from the cached discovery document
+def build_cached():
+    build_from_document(document, credentials=credentials)
+
+if __name__ == '__main__':
+    for name, function in [('build()', build_uncached), ('cached document', build_cached)]:
+        # Take the best of a few runs to reduce noise
+        best = min(timeit.repeat(function, number=iterations, repeat=5))
+        print(f'{name:<16} {best / iterations * 1000:.2f} ms per service')
@@ -0,0 +1,58 @@
+import os
+import re
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from functions.email import Email, HTMLTextExtractor
+
+# Number of extractions per measurement
+iterations = 20
+
+# Directory of saved newsletter .html files, e.g. exported with "Show original"
+corpus_dir = sys.argv[1] if len(sys.argv) > 1 else None
+
+# Build a newsletter shaped message when no corpus is given
+def sample_newsletter():
+    style = '<style>' + ''.join(f'.c{i} {{ color: #{i:06x}; padding: {i % 20}px; }}' for i in range(300)) + '</style>'
+    rows = ''.join(
+        f'<tr><td class="c{i}"><table><tr><td><a href="https://example.com/{i}"><img src="cid:image{i}" alt="Item {i}"></a></td>'
+        f'<td><h2>Story number {i}</h2><p>Lorem ipsum dolor sit amet,&nbsp;consectetur <b>adipiscing</b> elit &amp; more.</p></td></tr></table></td></tr>'
+        for i in range(150)
+    )
+    return f'<html><head>{style}</head><body><table>{rows}</table><script>var tracking = 1;</script></body></html>'
+
+# Load the corpus
+def load_corpus():
+    if not corpus_dir:
+        return [sample_newsletter()]
+
+    corpus = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if name.endswith('.html'):
+            with open(os.path.join(corpus_dir, name), encoding='utf-8', errors='replace') as file:
+                corpus.append(file.read())
+    return corpus
+
+# Extract the text the way every message used to
+def extract_soup(html):
+    text = BeautifulSoup(html, 'html.parser').get_text(separator='\n').strip()
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\n+', '\n', text)
+    text = re.sub(r' +', ' ', text)
+    return re.sub('\u200b', '', text)
+
+if __name__ == '__main__':
+    corpus = load_corpus()
+    size = sum(len(html) for html in corpus) / len(corpus) / 1024
+
+    print(f'{len(corpus)} messages, {size:.1f} KB of HTML on average')
+
+    # The memoized path only parses each message once, later calls hash the HTML
+    for name, function in [('BeautifulSoup', extract_soup), ('HTMLParser', HTMLTextExtractor.extract), ('memoized', Email.extract_text_from_html)]:
+        # Take the best of a few runs to reduce noise
+        best = min(timeit.repeat(lambda: [function(html) for html in corpus], number=iterations, repeat=5))
+        print(f'{name:<14} {best / iterations / len(corpus) * 1000:.2f} ms per message')
@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app
+
+from functions.oauth import get_mail_client, graph
+from functions.projection import SUMMARY, MESSAGE
+
+from models.oauth import Oauth
+
+# Usage: python benchmarks/projection_bytes.py <oauth_id> [messages]
+oauth_id = int(sys.argv[1])
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+# Measure the bytes of a Gmail request as sent over the wire
+def gmail_bytes(google, request):
+    _, content = google.new_http().request(request.uri)
+    return len(content)
+
+# Measure the bytes of a Graph request
+def graph_bytes(microsoft, url):
+    return len(graph.get(url, headers={'Authorization': f'Bearer {microsoft.access_token}'}).content)
+
+def measure_google(google):
+    messages = google.service.users().messages().list(userId='me', maxResults=count).execute().get('messages', [])
+    results = {}
+
+    for name, projection in [('summary', SUMMARY), ('message', MESSAGE)]:
+        before, after = 0, 0
+
+        for message in messages:
+            if name == 'summary':
+                full = google.service.users().messages().get(userId='me', id=message['id'], format='metadata', metadataHeaders=google.SUMMARY_HEADERS)
+                projected = google.service.users().messages().get(userId='me', id=message['id'], format='metadata', metadataHeaders=google.SUMMARY_HEADERS, fields=projection.gmail())
+            else:
+                full = google.service.users().messages().get(userId='me', id=message['id'])
+                projected = google.service.users().messages().get(userId='me', id=message['id'], fields=projection.gmail())
+
+            before += gmail_bytes(google, full)
+            after += gmail_bytes(google, projected)
+
+        results[name] = (before, after, len(messages))
+
+    return results
+
+def measure_microsoft(microsoft):
+    endpoint = 'https://graph.microsoft.com/v1.0/me/messages'
+    headers = {'Authorization': f'Bearer {microsoft.access_token}'}
+    messages = graph.get(f'{endpoint}?$top={count}&$select=id', headers=headers).json().get('value', [])
+    results = {}
+
+    # Listing pages, the way list_messages requested them before and after
+    results['list page'] = (
+        graph_bytes(microsoft, f'{endpoint}?$top={count}&$count=true'),
+        graph_bytes(microsoft, f'{endpoint}?$top={count}&$count=true&$select={SUMMARY.graph()}'),
+        1
+    )
+
+    before, after = 0, 0
+    for message in messages:
+        before += graph_bytes(microsoft, f"{endpoint}/{message['id']}")
+        after += graph_bytes(microsoft, f"{endpoint}/{message['id']}?$select={MESSAGE.graph()}")
+    results['message'] = (before, after, len(messages))
+
+    return results
+
+if __name__ == '__main__':
+    with app.app_context():
+        oauth = Oauth.query.filter_by(id=oauth_id).first()
+        client = get_mail_client(oauth)
+
+        results = measure_google(client) if oauth.service == 'google' else measure_microsoft(client)
+
+        for name, (before, after, requests) in results.items():
+            requests = max(requests, 1)
+            print(f'{name:<10} {before / requests / 1024:8.1f} KB -> {after / requests / 1024:8.1f} KB per request ({(1 - after / max(before, 1)) * 100:.0f}% smaller)')
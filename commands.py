@@ -0,0 +1,86 @@
+import base64
+import json
+import threading
+
+import click
+
+from init import app
+
+from functions.jobs import AIJobs
+from functions.push import PushNotifications
+from models.oauth import Oauth
+from models.mailbox import MailboxSubscription
+
+# Push notification commands (flask push ...)
+@app.cli.group('push')
+def push_cli():
+    """Mailbox push notification commands."""
+
+class PushCommands:
+    # Create missing subscriptions and renew the ones close to expiring, run it from cron
+    @push_cli.command('renew')
+    def renew():
+        renewed, failed = PushNotifications.renew_all()
+        click.echo(f'{renewed} subscription(s) active, {failed} failed.')
+    
+    # Send a provider-shaped notification to the local webhook, a stand-in for Pub/Sub and Graph
+    @push_cli.command('simulate')
+    @click.argument('oauth_id', type=int)
+    def simulate(oauth_id):
+        oauth = Oauth.query.get(oauth_id)
+        
+        if not oauth:
+            raise click.ClickException('Account not found.')
+        
+        client = app.test_client()
+        
+        if oauth.service == 'google':
+            data = base64.b64encode(json.dumps({'emailAddress': oauth.email, 'historyId': 0}).encode()).decode()
+            response = client.post(
+                f'/api/webhook/google?token={PushNotifications.WEBHOOK_SECRET}',
+                json={'message': {'data': data, 'messageId': 'simulated'}, 'subscription': 'simulated'}
+            )
+        else:
+            subscription = MailboxSubscription.query.filter_by(oauth_id=oauth.id, service='microsoft').first()
+            
+            if not subscription:
+                raise click.ClickException('The account has no subscription, run "flask push renew" first.')
+            
+            response = client.post(
+                '/api/webhook/microsoft',
+                json={'value': [{
+                    'subscriptionId': subscription.subscription_id,
+                    'clientState': subscription.client_state,
+                    'changeType': 'created',
+                    'resource': 'me/messages/simulated'
+                }]}
+            )
+        
+        click.echo(f'Webhook responded with {response.status_code}.')
+
+# AI job commands (flask ai ...)
+@app.cli.group('ai')
+def ai_cli():
+    """AI job queue commands."""
+
+class AICommands:
+    # Run the queued AI jobs, keep it running next to the web workers
+    @ai_cli.command('worker')
+    @click.option('--threads', default=8, show_default=True, help='AI jobs to run at the same time.')
+    def worker(threads):
+        stop = threading.Event()
+        workers = [threading.Thread(target=AIJobs.work, args=(stop,), daemon=True) for _ in range(threads)]
+        
+        for thread in workers:
+            thread.start()
+        
+        click.echo(f'AI worker running {threads} thread(s), press Ctrl+C to stop.')
+        
+        try:
+            while any(thread.is_alive() for thread in workers):
+                stop.wait(1)
+        except KeyboardInterrupt:
+            # Let the running jobs finish before exiting
+            stop.set()
+            for thread in workers:
+                thread.join()
@@ -1,4 +1,13 @@
-import requests
+import json
+
+from .http_pool import get_client
+
+class WorkersAIError(Exception):
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
 
 class WorkersAI:
     def __init__(self, api_key = None, base_url = None, model = None):
@@ -6,8 +15,15 @@ class WorkersAI:
         self.api_key = api_key
         self.model = model
         
-    def chat(self, messages):
-        input = [
+    def payload(self, messages, stream=False):
+        query = {
+            "messages": messages,
+        }
+
+        if stream:
+            query["stream"] = True
+
+        return [
             {
             "provider": "workers-ai",
             "endpoint": self.model,
@@ -15,14 +31,14 @@ class WorkersAI:
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json",
             },
-            "query": {
-                "messages": messages,
-            },
+            "query": query,
             },
             ]
-        
-        
-        response = requests.post(
+
+    def chat(self, messages):
+        input = self.payload(messages)
+
+        response = get_client('workersai').post(
             f"{self.base_url}",
             headers={
                 "Content-Type": "application/json",
@@ -30,4 +46,89 @@ class WorkersAI:
             json=input,
         )
         
-        return response.json()
\ No newline at end of file
+        return response.json()
+
+    def error(self, response, body):
+        """Build the WorkersAIError of a failed response."""
+        try:
+            error = json.loads(body)
+            message = (error.get("errors") or error.get("error") or [{}])[0].get("message", "Error generating email")
+        except Exception:
+            message = "Error generating email"
+
+        status_code = response.status_code
+
+        # The gateway answers some rate limits with a 200 and success false
+        if message == "Rate limited" and status_code == 200:
+            status_code = 429
+
+        return WorkersAIError(message, status_code, response.headers.get("Retry-After"))
+
+    def complete(self, messages):
+        """Return the generated text, or raise WorkersAIError."""
+        response = get_client('workersai').post(
+            f"{self.base_url}",
+            headers={
+                "Content-Type": "application/json",
+            },
+            json=self.payload(messages),
+        )
+
+        try:
+            data = response.json()
+        except Exception:
+            raise self.error(response, response.content)
+
+        if response.status_code != 200 or not data.get("success", False):
+            raise self.error(response, response.content)
+
+        return data["result"]["response"]
+
+    def stream(self, messages):
+        """Yield the generated text as Workers AI sends it, the gateway relays it as Server-Sent Events."""
+        client = get_client('workersai')
+
+        response = client.open(
+            "POST",
+            f"{self.base_url}",
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream",
+            },
+            json=self.payload(messages, stream=True),
+        )
+
+        if response.status_code != 200:
+            try:
+                # httpx needs the streamed body read before it can be parsed
+                error = self.error(response, response.read() if client.http2 else response.content)
+            finally:
+                response.close()
+
+            raise error
+
+        buffer = b""
+        chunks = client.iter_content(response, 1024)
+
+        for chunk in chunks:
+            buffer += chunk
+
+            # Every event is a single data line
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.strip()
+
+                if not line.startswith(b"data:"):
+                    continue
+
+                data = line[5:].strip()
+
+                if data == b"[DONE]":
+                    # Hand the connection back to the pool
+                    chunks.close()
+                    return
+
+                token = json.loads(data).get("response")
+
+                if token:
+                    yield token
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import random
+import time
+import zlib
+
+from init import create_logger, env, fernet, redis
+
+logger = create_logger(__name__)
+
+
+# Define the AIResponseCache class
+class AIResponseCache:
+    """Exact-match cache of AI responses, keyed by everything that shapes the completion."""
+
+    ENABLED = env.get('AI_CACHE_ENABLED', 'True').lower() in ('true', '1')
+    # Most cached prompts before the least recently used ones are evicted
+    MAX_ENTRIES = int(env.get('AI_CACHE_MAX_ENTRIES', 10000))
+    # Seconds a response is cached, how many variants are collected before they are reused and whether it is kept per user
+    ROUTES = {
+        'paraphrase': {'ttl': 24 * 3600, 'variants': 3, 'per_user': False},
+        'smart_reply': {'ttl': 3600, 'variants': 1, 'per_user': True},
+    }
+
+    # Define the key method
+    @staticmethod
+    def key(route, models, messages, user_id=None):
+        """models maps every provider to its (model, temperature), any of them may answer a failed over request."""
+        settings = AIResponseCache.ROUTES.get(route) or {}
+
+        # The system prompt is part of the messages
+        digest = hashlib.sha256(json.dumps({
+            'models': models,
+            'messages': messages,
+            'user_id': user_id if settings.get('per_user') else None,
+        }, sort_keys=True).encode()).hexdigest()
+
+        return f'ai_cache_{route}_{digest}'
+
+    # Define the lru_key method
+    @staticmethod
+    def lru_key(route):
+        # One zset per route, so each is trimmed at its own TTL
+        return f'ai_cache_lru_{route}'
+
+    # Define the stats_key method
+    @staticmethod
+    def stats_key(route):
+        return f'ai_cache_stats_{route}'
+
+    # Define the get method
+    @staticmethod
+    def get(route, key):
+        """Return a cached response once every variant of the prompt is collected, otherwise None."""
+        settings = AIResponseCache.ROUTES.get(route)
+
+        if not AIResponseCache.ENABLED or not settings:
+            return None
+
+        try:
+            variants = redis.lrange(key, 0, -1)
+
+            # Keep asking the AI until the prompt has all its variants
+            if len(variants) < settings['variants']:
+                # The entry expired, stop counting it towards the limit
+                if not variants:
+                    redis.zrem(AIResponseCache.lru_key(route), key)
+
+                redis.hincrby(AIResponseCache.stats_key(route), 'misses', 1)
+                return None
+
+            redis.hincrby(AIResponseCache.stats_key(route), 'hits', 1)
+            redis.zadd(AIResponseCache.lru_key(route), {key: time.time()})
+
+            return zlib.decompress(fernet.decrypt(random.choice(variants))).decode()
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+
+    # Define the set method
+    @staticmethod
+    def set(route, key, response):
+        settings = AIResponseCache.ROUTES.get(route)
+
+        if not AIResponseCache.ENABLED or not settings or not response:
+            return
+
+        try:
+            pipe = redis.pipeline()
+            pipe.rpush(key, fernet.encrypt(zlib.compress(response.encode())))
+            pipe.ltrim(key, -settings['variants'], -1)
+            pipe.expire(key, settings['ttl'])
+            pipe.zadd(AIResponseCache.lru_key(route), {key: time.time()})
+            pipe.execute()
+
+            AIResponseCache.evict()
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the evict method
+    @staticmethod
+    def evict():
+        lru_keys = [AIResponseCache.lru_key(route) for route in AIResponseCache.ROUTES]
+
+        # Forget the entries that expired on their own, an entry unused for its TTL was stored before that
+        for route, settings in AIResponseCache.ROUTES.items():
+            redis.zremrangebyscore(AIResponseCache.lru_key(route), 0, time.time() - settings['ttl'])
+
+        excess = sum(redis.zcard(lru_key) for lru_key in lru_keys) - AIResponseCache.MAX_ENTRIES
+
+        # Least recently used first, across the routes
+        while excess > 0:
+            oldest = []
+
+            for lru_key in lru_keys:
+                entries = redis.zrange(lru_key, 0, 0, withscores=True)
+
+                if entries:
+                    oldest.append((entries[0][1], lru_key))
+
+            if not oldest:
+                break
+
+            for key, _ in redis.zpopmin(min(oldest)[1]):
+                redis.delete(key)
+
+            excess -= 1
+
+    # Define the stats method
+    @staticmethod
+    def stats():
+        stats = {}
+
+        for route in AIResponseCache.ROUTES:
+            try:
+                counts = redis.hgetall(AIResponseCache.stats_key(route))
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+                counts = {}
+
+            hits = int(counts.get(b'hits', 0))
+            misses = int(counts.get(b'misses', 0))
+
+            stats[route] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else 0,
+            }
+
+        try:
+            entries = sum(redis.zcard(AIResponseCache.lru_key(route)) for route in AIResponseCache.ROUTES)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            entries = 0
+
+        return {
+            'enabled': AIResponseCache.ENABLED,
+            'entries': entries,
+            'max_entries': AIResponseCache.MAX_ENTRIES,
+            'routes': stats,
+        }
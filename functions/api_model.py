@@ -282,6 +282,7 @@ class APIModel:
             'language_tone': fields.String(required=True, description='Language Tone', example='formal'),
             'length': fields.String(required=True, description='Text Length', example='short'),
             'ai': fields.String(description='AI Model', example='gpt-3'),
+            'stream': fields.Boolean(description='Stream the email as Server-Sent Events', example=False),
         })
         
         # Modify Email API model
@@ -292,6 +293,7 @@ class APIModel:
             'language_tone': fields.String(required=True, description='Language Tone', example='formal'),
             'length': fields.String(required=True, description='Text Length', example='short'),
             'ai': fields.String(description='AI Model', example='gpt-3'),
+            'stream': fields.Boolean(description='Stream the email as Server-Sent Events', example=False),
         })
         
         chat_email_send_model = api.model('ChatSend', {
@@ -0,0 +1,122 @@
+import hashlib
+from urllib.parse import quote
+
+from flask import Response
+
+from init import create_logger
+
+logger = create_logger(__name__)
+
+
+# Define the AttachmentStream class
+class AttachmentStream:
+    # Bytes sent to the client per chunk
+    CHUNK_SIZE = 64 * 1024
+    # Attachments never change for a given ID, so browsers may keep them
+    CACHE_CONTROL = 'private, max-age=86400'
+
+    # Define the etag method
+    @staticmethod
+    def etag(service, message_id, attachment_id):
+        return hashlib.sha256(f'{service}:{message_id}:{attachment_id}'.encode()).hexdigest()[:32]
+
+    # Define the parse_range method
+    @staticmethod
+    def parse_range(header, size):
+        """Return (start, end) for a single byte range, None to send everything, or False if unsatisfiable."""
+        if not header or size is None or not header.startswith('bytes='):
+            return None
+
+        ranges = header[len('bytes='):].split(',')
+
+        # Multiple ranges are allowed to be answered with the full body
+        if len(ranges) != 1:
+            return None
+
+        start, _, end = ranges[0].strip().partition('-')
+
+        try:
+            if not start:
+                # Suffix range, the last N bytes
+                length = int(end)
+                if length <= 0:
+                    return False
+                return max(size - length, 0), size - 1
+
+            start = int(start)
+            end = int(end) if end else size - 1
+        except ValueError:
+            return None
+
+        if start >= size or end < start:
+            return False
+
+        return start, min(end, size - 1)
+
+    # Define the slice_chunks method
+    @staticmethod
+    def slice_chunks(chunks, start, end):
+        position = 0
+
+        for chunk in chunks:
+            chunk_end = position + len(chunk)
+
+            # Skip the chunks before the range
+            if chunk_end <= start:
+                position = chunk_end
+                continue
+
+            yield chunk[max(start - position, 0):end + 1 - position]
+
+            position = chunk_end
+
+            # Stop reading the upstream once the range is sent
+            if position > end:
+                break
+
+        # Close the upstream generator when the range ends early
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+    # Define the response method
+    @staticmethod
+    def response(attachment, etag, range_header=None, if_range=None):
+        headers = {
+            'ETag': f'"{etag}"',
+            'Cache-Control': AttachmentStream.CACHE_CONTROL,
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(attachment['filename'])}",
+            # Never let the browser render the attachment as something else
+            'X-Content-Type-Options': 'nosniff',
+        }
+
+        size = attachment.get('size')
+        chunks = attachment['chunks']
+
+        if size is not None:
+            headers['Accept-Ranges'] = 'bytes'
+
+        # Only honour the range if the client still has the same attachment
+        if if_range and etag not in if_range:
+            range_header = None
+
+        byte_range = AttachmentStream.parse_range(range_header, size)
+
+        if byte_range is False:
+            chunks.close()
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+
+        if byte_range:
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            headers['Content-Length'] = str(end - start + 1)
+            body = AttachmentStream.slice_chunks(chunks, start, end)
+            status = 206
+        else:
+            if size is not None:
+                headers['Content-Length'] = str(size)
+            body = chunks
+            status = 200
+
+        return Response(body, status=status, headers=headers, mimetype=attachment['mime_type'], direct_passthrough=True)
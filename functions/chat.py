@@ -2,13 +2,15 @@ import re
 import json
 from datetime import datetime
 
-from flask import jsonify, make_response, render_template
+from flask import Response, jsonify, make_response, render_template, stream_with_context
 from flask_restx import abort
 from flask_jwt_extended import current_user
 
-from init import openai, workersai, db, fernet, create_logger
+from init import openai, workersai, db, fernet, redis, create_logger
 from functions.oauth import Google, Microsoft
+from functions.ai_cache import AIResponseCache
 from functions.email import Email
+from functions.providers import AIProviderError, AIProviders, OpenAIProvider, WorkersAIProvider
 from models.chat import Chat, ChatMessages
 from models.contact import Contact
 from models.oauth import Oauth
@@ -47,6 +49,12 @@ LENGTH_MAP = {
     "extra_long": "Extra Long (500+ words)"
 }
 
+# AI providers, the preferred one is tried first and the others take over when it is degraded
+providers = AIProviders(
+    OpenAIProvider(openai, model, temperature),
+    WorkersAIProvider(workersai),
+)
+
 
 class ChatAssistant:
     """Encapsulates all chat/email flows in Diyari.ai, refactored for clarity."""
@@ -187,7 +195,115 @@ class ChatAssistant:
         return subj, body
 
     @staticmethod
-    def generate_email(contacts, instruction, language_tone, length, oauth, ai="openai"):
+    def sse(event, data):
+        """Format one Server-Sent Event."""
+        return f"event: {event}{backslash_n}data: {json.dumps(data)}{backslash_n}{backslash_n}"
+
+    @staticmethod
+    def _stream_tokens(messages, ai="openai"):
+        """Yield the generated text piece by piece as the AI produces it."""
+        yield from providers.stream(messages, preferred=ai)
+
+    @staticmethod
+    def _complete(messages, ai, error_message, route=None):
+        """Return the generated text, failing over between the AI providers and caching and hedging the interactive routes."""
+        try:
+            if not route:
+                return providers.complete(messages, preferred=ai)
+
+            # Repeated clicks on the same text are answered from the cache, whichever provider answered them
+            models = {name: [getattr(provider, "model", None), getattr(provider, "temperature", None)] for name, provider in providers.providers.items()}
+            key = AIResponseCache.key(route, models, messages, user_id=current_user.id)
+            cached = AIResponseCache.get(route, key)
+            if cached is not None:
+                return cached
+
+            gen = providers.hedged(messages, route, preferred=ai)
+            AIResponseCache.set(route, key, gen)
+            return gen
+        except AIProviderError as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            if e.rate_limited:
+                abort(400, "Rate limited. Please try again later.")
+            abort(400, error_message)
+
+    @staticmethod
+    def _email_events(chat, oauth, contacts, input_data, messages, ai="openai"):
+        """Yield (event, data) pairs while the draft is generated, then persist the chat messages."""
+        user = current_user._get_current_object()
+
+        def events():
+            yield "start", {"chat_id": chat.id}
+
+            gen_text = ""
+            try:
+                for token in ChatAssistant._stream_tokens(messages, ai):
+                    gen_text += token
+                    yield "token", {"text": token}
+
+                subject, body = ChatAssistant._split_subject_body(gen_text)
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+                rate_limited = isinstance(e, AIProviderError) and e.rate_limited
+                message = "Rate limited. Please try again later." if rate_limited else "Error generating email"
+                yield "error", {"message": message}
+                return
+
+            response_data = {"subject": subject.strip(), "body": body.strip()}
+
+            # Persist once the whole draft is known
+            user_message = ChatMessages(
+                user_id=user.id,
+                chat_id=chat.id,
+                data=fernet.encrypt(json.dumps(input_data).encode()).decode(),
+                chat_type="user"
+            )
+            assistant_message = ChatMessages(
+                user_id=user.id,
+                chat_id=chat.id,
+                data=fernet.encrypt(json.dumps(response_data).encode()).decode(),
+                chat_type="assistant"
+            )
+            db.session.add(user_message)
+            db.session.add(assistant_message)
+            chat.name = subject
+            db.session.commit()
+
+            yield "done", {
+                "chat_id": chat.id,
+                "assistant_message_id": assistant_message.id,
+                "user_message_id": user_message.id,
+                "contacts": contacts,
+                "user": {
+                    "id": user.id,
+                    "first_name": oauth.first_name,
+                    "last_name": oauth.last_name,
+                    "email": oauth.email,
+                    "phone_code": user.phone_code,
+                    "phone_number": user.phone_number,
+                    "company": user.company,
+                    "work_title": user.work_title,
+                    "college": user.college,
+                    "major": user.major,
+                },
+                "input": input_data,
+                "output": response_data,
+            }
+
+        return events()
+
+    @staticmethod
+    def _stream_email(events):
+        """Send the draft events to the browser as Server-Sent Events."""
+        return Response(
+            stream_with_context(ChatAssistant.sse(event, data) for event, data in events),
+            mimetype="text/event-stream",
+            # Keep proxies from buffering the stream
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @staticmethod
+    def generate_email(contacts, instruction, language_tone, length, oauth, ai="openai", stream=False, events=False):
         """Main endpoint: generate a new email draft."""
         # 1) create DB chat record
         chat = ChatAssistant.create_chat(oauth)
@@ -242,24 +358,16 @@ class ChatAssistant:
             {"role": "user",   "content": user_prompt},
         ]
 
-        # 5) call AI
-        if ai == "openai":
-            resp = openai.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
-            gen_text = resp.choices[0].message.content
-        else:
-            resp = workersai.chat(messages)
-            if not resp.get("success", False):
-                err = resp.get("error", [])
-                if err and err[0].get("message") == "Rate limited":
-                    abort(400, "Rate limited. Please try again later.")
-                abort(400, "Error generating email")
-            gen_text = resp["result"]["response"]
-
-        # 6) parse and persist
+        # 5) stream the draft if asked, the messages are persisted when it finishes
+        if stream or events:
+            draft = ChatAssistant._email_events(chat, oauth, contacts, input_data, messages, ai)
+            # The AI job worker reads the events itself
+            return draft if events else ChatAssistant._stream_email(draft)
+
+        # 6) call AI
+        gen_text = ChatAssistant._complete(messages, ai, "Error generating email")
+
+        # 7) parse and persist
         subject, body = ChatAssistant._split_subject_body(gen_text)
         response_data = {"subject": subject.strip(), "body": body.strip()}
 
@@ -307,7 +415,7 @@ class ChatAssistant:
         )
 
     @staticmethod
-    def modify_email(chat_id, contacts, instruction, language_tone, length, ai="openai"):
+    def modify_email(chat_id, contacts, instruction, language_tone, length, ai="openai", stream=False, events=False):
         """Modify an existing email draft in a chat thread."""
         chat  = Chat.query.get(chat_id) or abort(404, "Chat not found")
         oauth = Oauth.query.get(chat.oauth_id) or abort(404, "Email Authentication not found")
@@ -352,18 +460,13 @@ class ChatAssistant:
 
         messages = [{"role": "system",  "content": system_prompt}] + history + [{"role": "user", "content": user_prompt}]
 
+        # Stream the draft if asked
+        if stream or events:
+            draft = ChatAssistant._email_events(chat, oauth, contacts, input_data, messages, ai)
+            return draft if events else ChatAssistant._stream_email(draft)
+
         # Call AI
-        if ai == "openai":
-            resp = openai.chat.completions.create(model=model, messages=messages, temperature=temperature)
-            gen_text = resp.choices[0].message.content
-        else:
-            resp = workersai.chat(messages)
-            if not resp.get("success", False):
-                err = resp.get("error", [])
-                if err and err[0].get("message") == "Rate limited":
-                    abort(400, "Rate limited. Please try again later.")
-                abort(400, "Error generating email")
-            gen_text = resp["result"]["response"]
+        gen_text = ChatAssistant._complete(messages, ai, "Error generating email")
 
         # Parse & save
         subject, body = ChatAssistant._split_subject_body(gen_text)
@@ -434,10 +537,10 @@ class ChatAssistant:
         rendered = render_template("email-template.html", body=body, watermark=True)
 
         if oauth.service == "google":
-            client = Google(data)
+            client = Google(data, oauth_id=oauth.id)
             success = client.send_email(sender=sender, to=to_emails, subject=subject, message=rendered, cc=cc_emails, bcc=bcc_emails)
         elif oauth.service == "microsoft":
-            client = Microsoft(data)
+            client = Microsoft(data, oauth_id=oauth.id)
             success = client.send_email(sender=sender, to=to_emails, subject=subject, body=rendered, cc=cc_emails, bcc=bcc_emails)
         else:
             # Fallback SMTP or other
@@ -461,23 +564,25 @@ class ChatAssistant:
             )},
             {"role": "user", "content": text}
         ]
-        if ai == "openai":
-            resp = openai.chat.completions.create(model=model, messages=messages, temperature=temperature)
-            gen = resp.choices[0].message.content
-        else:
-            resp = workersai.chat(messages)
-            if not resp.get("success", False):
-                err = resp.get("error", [])
-                if err and err[0].get("message") == "Rate limited":
-                    abort(400, "Rate limited. Please try again later.")
-                abort(400, "Error generating paraphrase")
-            gen = resp["result"]["response"]
+        gen = ChatAssistant._complete(messages, ai, "Error generating paraphrase", route="paraphrase")
 
         # Preserve original ending punctuation
         punct = re.search(r"[\W_]*$", text)
         gen = re.sub(r"[\W_]*$", "", gen) + (punct.group() if punct else "")
         return gen
 
+    @staticmethod
+    def save_paraphrase(message_id, text, paraphrase, type, position):
+        """Keep a paraphrase for a minute so the user can apply it to the message."""
+        response = {
+            "original": text,
+            "paraphrase": paraphrase,
+            "type": type,
+            "position": position
+        }
+        redis.setex(f"paraphrase_{message_id}", 60, json.dumps(response))
+        return response
+
     @staticmethod
     def smart_reply(subject, body, sender, instruction, oauth, ai="openai"):
         """Generate a smart reply to an incoming email."""
@@ -506,14 +611,4 @@ class ChatAssistant:
             {"role": "user", "content": user_prompt}
         ]
 
-        if ai == "openai":
-            resp = openai.chat.completions.create(model=model, messages=messages, temperature=temperature)
-            return resp.choices[0].message.content
-        else:
-            resp = workersai.chat(messages)
-            if not resp.get("success", False):
-                err = resp.get("error", [])
-                if err and err[0].get("message") == "Rate limited":
-                    abort(400, "Rate limited. Please try again later.")
-                abort(400, "Error generating smart reply")
-            return resp["result"]["response"]
+        return ChatAssistant._complete(messages, ai, "Error generating smart reply", route="smart_reply")
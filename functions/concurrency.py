@@ -0,0 +1,171 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+import gevent
+from gevent import monkey
+from gevent.pool import Pool
+
+from init import create_logger
+
+logger = create_logger(__name__)
+
+# Most provider calls a worker process runs at the same time
+GLOBAL_LIMIT = 20
+# Most provider calls a single linked account runs at the same time
+ACCOUNT_LIMIT = 5
+
+global_semaphore = threading.BoundedSemaphore(GLOBAL_LIMIT)
+account_semaphores = {}
+account_semaphores_lock = threading.Lock()
+
+
+# Define the get_account_semaphore function
+def get_account_semaphore(account):
+    with account_semaphores_lock:
+        if account not in account_semaphores:
+            account_semaphores[account] = threading.BoundedSemaphore(ACCOUNT_LIMIT)
+        return account_semaphores[account]
+
+
+# Define the run_task function
+def run_task(func, item, account, default, bounded=True):
+    if not bounded:
+        try:
+            return func(item)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return default
+
+    account_semaphore = get_account_semaphore(account) if account is not None else None
+
+    # Wait for the account slot first, a busy account must not hold global slots other accounts could use
+    if account_semaphore:
+        account_semaphore.acquire()
+    try:
+        with global_semaphore:
+            return func(item)
+    except Exception as e:
+        # A failed item must not fail the others
+        logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+        return default
+    finally:
+        if account_semaphore:
+            account_semaphore.release()
+
+
+# Define the fan_out function
+def fan_out(func, items, account=None, default=None, bounded=True):
+    """Run func over items concurrently within the global and per-account limits, returning results in order.
+
+    Tasks that fan out again themselves should pass bounded=False, so they do not hold slots their own calls wait for.
+    """
+    items = list(items)
+
+    if len(items) <= 1:
+        return [run_task(func, item, account, default, bounded) for item in items]
+
+    size = min(ACCOUNT_LIMIT, len(items)) if bounded else len(items)
+
+    # Greenlets and threads do not inherit the app context, hand it over for database access
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def task(item):
+        if app is None:
+            return run_task(func, item, account, default, bounded)
+
+        with app.app_context():
+            return run_task(func, item, account, default, bounded)
+
+    # Use greenlets under the gevent worker, threads everywhere else
+    if monkey.is_module_patched('socket'):
+        return Pool(size).map(task, items)
+
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        return list(executor.map(task, items))
+
+
+# Define the spawn function
+def spawn(func, *args):
+    """Run func in the background with the app context, without waiting for it."""
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def task():
+        try:
+            if app is None:
+                return func(*args)
+
+            with app.app_context():
+                return func(*args)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    if monkey.is_module_patched('socket'):
+        return gevent.spawn(task)
+
+    thread = threading.Thread(target=task, daemon=True)
+    thread.start()
+    return thread
+
+
+# Define the hedge function
+def hedge(primary, backup, delay, allow=None):
+    """Run primary, and backup as well once primary has not answered within delay seconds.
+
+    Returns (index, result) of the first call to succeed, 0 for primary and 1 for backup, and stops the other one.
+    allow is asked before the backup is sent, so callers can keep it within a budget.
+    """
+    app = current_app._get_current_object() if has_app_context() else None
+    results = queue.Queue()
+    patched = monkey.is_module_patched('socket')
+
+    def task(index, func):
+        try:
+            if app is None:
+                results.put((index, True, func()))
+                return
+
+            with app.app_context():
+                results.put((index, True, func()))
+        except Exception as e:
+            results.put((index, False, e))
+
+    def start(index, func):
+        # Use greenlets under the gevent worker, threads everywhere else
+        if patched:
+            return gevent.spawn(task, index, func)
+
+        thread = threading.Thread(target=task, args=(index, func), daemon=True)
+        thread.start()
+        return thread
+
+    tasks = [start(0, primary)]
+    finished = 0
+    timeout = delay
+
+    while True:
+        try:
+            index, ok, value = results.get(timeout=timeout)
+        except queue.Empty:
+            # The primary is slow, send the backup unless the budget is spent
+            timeout = None
+            if allow is None or allow():
+                tasks.append(start(1, backup))
+            continue
+
+        finished += 1
+
+        if ok:
+            # Greenlets can be stopped, a losing thread finishes on its own and is ignored
+            if patched:
+                for other, greenlet in enumerate(tasks):
+                    if other != index:
+                        greenlet.kill(block=False)
+            return index, value
+
+        # Wait for the other call, unless none is running
+        if finished == len(tasks):
+            raise value
+
+        timeout = None
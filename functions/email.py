@@ -1,5 +1,6 @@
-import re
-from bs4 import BeautifulSoup
+import hashlib
+from collections import OrderedDict
+from html.parser import HTMLParser
 from flask_mail import Message
 from flask import render_template
 from init import mail, env, create_logger
@@ -8,6 +9,45 @@ from email_validator import validate_email, caching_resolver
 
 logger = create_logger(__name__)
 
+# Number of extracted message texts kept per worker process
+EXTRACTED_TEXTS_SIZE = 2048
+
+# Extracted message texts keyed by a hash of the HTML
+extracted_texts = OrderedDict()
+
+
+# Define the HTMLTextExtractor class
+class HTMLTextExtractor(HTMLParser):
+    # Elements whose content is never shown as text
+    SKIP_TAGS = {'script', 'style', 'template'}
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+    
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+    
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+    
+    # Define the extract method
+    @staticmethod
+    def extract(html):
+        parser = HTMLTextExtractor()
+        parser.feed(html)
+        parser.close()
+        
+        # Separate the text of different elements and collapse all whitespace in one pass
+        return ' '.join(' '.join(parser.parts).replace('\u200b', '').split())
+
 class Email:
     def send_email(subject, recipients, context, cc=None, bcc=None, sender=env.get('MAIL_DEFAULT_SENDER'), template='email-template.html'):
         try:
@@ -51,20 +91,26 @@ class Email:
         
     # Define extract text from html method
     def extract_text_from_html(html):
+        if not html:
+            return ''
+        
         try:
-            soup = BeautifulSoup(html, 'html.parser')
-
-            # Extract text and separate different elements with a newline
-            text = soup.get_text(separator='\n').strip()
-
-            # Replace multiple spaces or newlines with a single space or newline
-            cleaned_text = re.sub(r'\s+', ' ', text)  # Convert multiple spaces to a single space
-            cleaned_text = re.sub(r'\n+', '\n', cleaned_text)  # Reduce multiple line breaks to a single newline
-            cleaned_text = re.sub(r' +', ' ', cleaned_text)  # Convert multiple spaces to a single space
-
-            # Optionally, remove non-breaking spaces (\u200b) if needed
-            cleaned_text = re.sub(r'\u200b', '', cleaned_text)
-
-            return cleaned_text
+            # Messages never change, so the same body always gives the same text
+            key = hashlib.blake2b(html.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+            
+            text = extracted_texts.get(key)
+            
+            if text is None:
+                text = HTMLTextExtractor.extract(html)
+                
+                extracted_texts[key] = text
+                
+                # Forget the least recently extracted texts
+                if len(extracted_texts) > EXTRACTED_TEXTS_SIZE:
+                    extracted_texts.popitem(last=False)
+            else:
+                extracted_texts.move_to_end(key)
+            
+            return text
         except Exception as e:
-            return str(e)
\ No newline at end of file
+            return str(e)
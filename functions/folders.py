@@ -0,0 +1,49 @@
+import json
+
+from init import create_logger, redis
+
+logger = create_logger(__name__)
+
+
+# Define the FolderRegistry class
+class FolderRegistry:
+    # Seconds a folder list with its counts stays cached
+    TTL = 300
+
+    # Define the key method
+    @staticmethod
+    def key(oauth_id):
+        return f'folders_{oauth_id}'
+
+    # Define the get method
+    @staticmethod
+    def get(oauth_id):
+        if oauth_id is None:
+            return None
+
+        try:
+            folders = redis.get(FolderRegistry.key(oauth_id))
+
+            return json.loads(folders) if folders else None
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+
+    # Define the set method
+    @staticmethod
+    def set(oauth_id, folders):
+        if oauth_id is None:
+            return
+
+        try:
+            redis.setex(FolderRegistry.key(oauth_id), FolderRegistry.TTL, json.dumps(folders))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the invalidate method
+    @staticmethod
+    def invalidate(oauth_id):
+        try:
+            redis.delete(FolderRegistry.key(oauth_id))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
@@ -0,0 +1,125 @@
+# init imports this module through functions.ai, so the logger and settings cannot come from init
+import logging
+from os import environ as env
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Connection pool and timeout settings per upstream, timeouts are (connect, read) seconds
+UPSTREAMS = {
+    'graph': {
+        'pool_connections': 4,
+        'pool_maxsize': 50,
+        'timeout': (5, 30),
+    },
+    'workersai': {
+        'pool_connections': 2,
+        'pool_maxsize': 20,
+        'timeout': (5, 120),
+    },
+    'default': {
+        'pool_connections': 4,
+        'pool_maxsize': 10,
+        'timeout': (5, 60),
+    },
+}
+
+# Upstreams that should use HTTP/2, e.g. HTTP2_UPSTREAMS=graph,workersai
+HTTP2_UPSTREAMS = [name.strip() for name in env.get('HTTP2_UPSTREAMS', '').split(',') if name.strip()]
+
+# Pooled clients shared by every request in the worker process
+clients = {}
+
+
+# Define the HTTPClient class
+class HTTPClient:
+    def __init__(self, name, pool_connections, pool_maxsize, timeout, http2=False):
+        self.name = name
+        self.timeout = timeout
+        self.http2 = False
+
+        if http2:
+            try:
+                # HTTP/2 needs the optional h2 package next to httpx
+                self.client = httpx.Client(
+                    http2=True,
+                    timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+                    limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+                )
+                self.http2 = True
+                return
+            except ImportError:
+                logger.warning(f'HTTP/2 is not available for {name}, install h2 to enable it')
+
+        # Keep-alive connections are reused from the adapter pool
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+
+        self.client = requests.Session()
+        self.client.mount('https://', adapter)
+        self.client.mount('http://', adapter)
+
+    # Define the request method
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        if self.http2:
+            # httpx takes raw bodies as content and a single timeout object
+            if isinstance(kwargs.get('data'), (str, bytes)):
+                kwargs['content'] = kwargs.pop('data')
+            timeout = kwargs.pop('timeout')
+            kwargs['timeout'] = httpx.Timeout(timeout[1], connect=timeout[0]) if isinstance(timeout, tuple) else timeout
+
+        return self.client.request(method, url, **kwargs)
+
+    # Define the open method, the body is left unread for iter_content
+    def open(self, method, url, **kwargs):
+        if self.http2:
+            kwargs.setdefault('timeout', self.timeout)
+            timeout = kwargs.pop('timeout')
+            kwargs['timeout'] = httpx.Timeout(timeout[1], connect=timeout[0]) if isinstance(timeout, tuple) else timeout
+            return self.client.send(self.client.build_request(method, url, **kwargs), stream=True)
+
+        return self.request(method, url, stream=True, **kwargs)
+
+    # Define the iter_content method
+    def iter_content(self, response, chunk_size):
+        try:
+            chunks = response.iter_bytes(chunk_size) if self.http2 else response.iter_content(chunk_size)
+
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+        finally:
+            # Hand the connection back to the pool
+            response.close()
+
+    # Define the get method
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    # Define the post method
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    # Define the patch method
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    # Define the delete method
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+# Define the get_client function
+def get_client(name):
+    client = clients.get(name)
+
+    if client is None:
+        settings = UPSTREAMS.get(name, UPSTREAMS['default'])
+        client = HTTPClient(name, http2=name in HTTP2_UPSTREAMS, **settings)
+        clients[name] = client
+
+    return client
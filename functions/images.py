@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import os
+import re
+import shutil
+import socket
+import tempfile
+
+from itsdangerous import URLSafeSerializer, BadSignature
+
+from init import create_logger, env, redis
+
+logger = create_logger(__name__)
+
+
+# Define the InlineImages class
+class InlineImages:
+    # Directory the proxied images are cached in
+    CACHE_DIR = env.get('IMAGE_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'easy-email-images')
+    # Most megabytes the image cache may use before the least recently used images are evicted
+    CACHE_MAX_BYTES = int(env.get('IMAGE_CACHE_MAX_MB') or 256) * 1024 * 1024
+    # Seconds browsers may keep a proxied image
+    BROWSER_MAX_AGE = 7 * 24 * 3600
+    # Seconds between two walks of the cache directory to evict images, shared by the workers of a host
+    EVICT_INTERVAL = 60
+
+    # The same image always gets the same URL so browsers can cache it
+    serializer = URLSafeSerializer(env.get('SECRET_KEY'), salt='inline-image')
+
+    # Define the url method
+    @staticmethod
+    def url(service, oauth_id, message_id, content_id, attachment_id, mime_type):
+        token = InlineImages.serializer.dumps({
+            's': service,
+            'o': oauth_id,
+            'm': message_id,
+            'c': content_id,
+            'a': attachment_id,
+            't': mime_type
+        })
+
+        return f'/api/image/{token}'
+
+    # Define the verify method
+    @staticmethod
+    def verify(token):
+        try:
+            data = InlineImages.serializer.loads(token)
+        except BadSignature:
+            return None
+
+        return {
+            'service': data['s'],
+            'oauth_id': data['o'],
+            'message_id': data['m'],
+            'content_id': data['c'],
+            'attachment_id': data['a'],
+            'mime_type': data['t']
+        }
+
+    # Define the rewrite method
+    @staticmethod
+    def rewrite(body, service, oauth_id, message_id, images):
+        """Point the cid: references of the body at the image proxy, images are (content_id, attachment_id, mime_type)."""
+        for content_id, attachment_id, mime_type in images:
+            url = InlineImages.url(service, oauth_id, message_id, content_id, attachment_id, mime_type)
+            body = body.replace(f'cid:{content_id}', url)
+
+        return body
+
+    # Define the embed method
+    @staticmethod
+    def embed(body, oauth_id, download):
+        """Turn the image proxy URLs of a body back into data URIs, download(image) returns the bytes of an image.
+
+        Outgoing mail needs this, its recipients cannot load images through the proxy.
+        """
+        def replace(match):
+            image = InlineImages.verify(match.group(1))
+
+            # Only the images of the account the message belongs to
+            if not image or image['oauth_id'] != oauth_id:
+                return match.group(0)
+
+            path = InlineImages.get_cached(image)
+
+            if path:
+                with open(path, 'rb') as file:
+                    data = file.read()
+            else:
+                data = download(image)
+
+            if not data:
+                return match.group(0)
+
+            return f"data:{image['mime_type']};base64,{base64.b64encode(data).decode()}"
+
+        return re.sub(r'/api/image/([A-Za-z0-9_\-.]+)', replace, body)
+
+    # Define the cache_path method
+    @staticmethod
+    def cache_path(image):
+        # Content IDs are stable, Gmail attachment IDs are not
+        key = f"{image['service']}:{image['oauth_id']}:{image['message_id']}:{image['content_id']}"
+
+        # One directory per account, so unlinking it can remove its images
+        return os.path.join(InlineImages.CACHE_DIR, str(image['oauth_id']), hashlib.sha256(key.encode()).hexdigest())
+
+    # Define the get_cached method
+    @staticmethod
+    def get_cached(image):
+        path = InlineImages.cache_path(image)
+
+        try:
+            # Mark the image as recently used
+            os.utime(path)
+            return path
+        except OSError:
+            return None
+
+    # Define the store method
+    @staticmethod
+    def store(image, data):
+        path = InlineImages.cache_path(image)
+        directory = os.path.dirname(path)
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+
+            # Write to a temporary file first so other workers never read half an image
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+
+            # Walking the whole cache is costly, only one worker of the host does it now and then
+            if redis.set(f'inline_image_evict_{socket.gethostname()}', 1, nx=True, ex=InlineImages.EVICT_INTERVAL):
+                InlineImages.evict()
+
+            return path
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+
+    # Define the clear method
+    @staticmethod
+    def clear(oauth_id):
+        shutil.rmtree(os.path.join(InlineImages.CACHE_DIR, str(oauth_id)), ignore_errors=True)
+
+    # Define the evict method
+    @staticmethod
+    def evict():
+        entries = []
+        total = 0
+
+        for directory in os.scandir(InlineImages.CACHE_DIR):
+            if not directory.is_dir():
+                continue
+
+            for entry in os.scandir(directory.path):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        if total <= InlineImages.CACHE_MAX_BYTES:
+            return
+
+        # Remove the least recently used images until the cache fits again
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+            if total <= InlineImages.CACHE_MAX_BYTES:
+                break
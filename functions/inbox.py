@@ -0,0 +1,152 @@
+import base64
+import heapq
+import json
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from init import create_logger
+
+from .concurrency import fan_out
+from .oauth import get_mail_client
+
+logger = create_logger(__name__)
+
+
+# Define the UnifiedInbox class
+class UnifiedInbox:
+    # Providers that have an inbox to merge
+    SERVICES = ['google', 'microsoft']
+
+    def __init__(self, accounts):
+        self.accounts = [account for account in accounts if account.service in self.SERVICES]
+
+    # Define the encode_cursor method
+    @staticmethod
+    def encode_cursor(positions):
+        return base64.urlsafe_b64encode(json.dumps(positions, separators=(',', ':')).encode()).decode()
+
+    # Define the decode_cursor method
+    @staticmethod
+    def decode_cursor(cursor):
+        """Return {oauth_id: {'page': provider page token, 'offset': messages of that page already served}}."""
+        if not cursor:
+            return {}
+
+        try:
+            return {int(oauth_id): position for oauth_id, position in json.loads(base64.urlsafe_b64decode(cursor.encode())).items()}
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return {}
+
+    # Define the message_timestamp method
+    @staticmethod
+    def message_timestamp(message):
+        date = (message.get('message') or {}).get('date')
+
+        if not date:
+            return 0
+
+        try:
+            # Microsoft Graph sends ISO 8601 dates
+            if 'T' in date and date[:4].isdigit():
+                parsed = datetime.fromisoformat(date.replace('Z', '+00:00'))
+            else:
+                # Gmail sends the RFC 2822 Date header
+                parsed = parsedate_to_datetime(date)
+
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+
+            return parsed.timestamp()
+        except Exception:
+            return 0
+
+    # Define the list_messages method
+    def list_messages(self, query=None, cursor=None, max_results=10, folder_name='inbox', view='summary'):
+        positions = self.decode_cursor(cursor)
+
+        # Skip the accounts a previous page already exhausted
+        accounts = [account for account in self.accounts if not positions.get(account.id, {}).get('done')]
+
+        # Get the current page of every account
+        def fetch(account):
+            position = positions.get(account.id, {})
+            client = get_mail_client(account)
+
+            # Outlook names its inbox folder Inbox
+            folder = 'Inbox' if account.service == 'microsoft' and folder_name.lower() == 'inbox' else folder_name
+
+            page = client.list_messages(query=query, next_page=position.get('page'), max_results=max_results, folder_name=folder, view=view)
+
+            if not page or 'messages' not in page:
+                raise Exception(f'Failed to list messages of account {account.id}')
+
+            return page
+
+        # Accounts fan out their own provider calls, so this level is not bounded
+        pages = fan_out(fetch, accounts, bounded=False)
+
+        streams = []
+        remaining = {}
+        failed = []
+        for account, page in zip(accounts, pages):
+            if page is None:
+                failed.append(account.id)
+                continue
+
+            offset = positions.get(account.id, {}).get('offset', 0)
+
+            messages = [
+                dict(message, service=account.service, oauth_id=account.id, email=account.email)
+                for message in page['messages'][offset:]
+            ]
+
+            # Each account returns its messages newest first, which is what the merge expects
+            streams.append([(-self.message_timestamp(message), account.id, index, message) for index, message in enumerate(messages)])
+            remaining[account.id] = (len(messages), bool(page.get('next_page')))
+
+        # Merge the accounts by date and keep one page
+        merged = []
+        for entry in heapq.merge(*streams):
+            merged.append(entry)
+
+            if len(merged) >= max_results:
+                break
+
+            # Stop when an account runs out of fetched messages, its next page may hold newer ones
+            left, has_next = remaining[entry[1]]
+            remaining[entry[1]] = (left - 1, has_next)
+            if left == 1 and has_next:
+                break
+
+        served = {}
+        for _, oauth_id, _, _ in merged:
+            served[oauth_id] = served.get(oauth_id, 0) + 1
+
+        # Work out where every account continues on the next page
+        next_positions = {}
+        for account, page in zip(accounts, pages):
+            position = positions.get(account.id, {})
+
+            if page is None:
+                # Retry the same page next time
+                next_positions[account.id] = position
+                continue
+
+            offset = position.get('offset', 0) + served.get(account.id, 0)
+
+            if offset < len(page['messages']):
+                next_positions[account.id] = {'page': position.get('page'), 'offset': offset}
+            elif page.get('next_page'):
+                next_positions[account.id] = {'page': page['next_page'], 'offset': 0}
+            else:
+                next_positions[account.id] = {'done': True}
+
+        has_more = any(not position.get('done') for position in next_positions.values())
+
+        return {
+            'messages': [message for _, _, _, message in merged],
+            'total_results': sum((page or {}).get('total_results', 0) or 0 for page in pages),
+            'failed_accounts': failed,
+            'next_page': self.encode_cursor({**positions, **next_positions}) if has_more else None
+        }
@@ -0,0 +1,434 @@
+import json
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from flask_jwt_extended import create_access_token, verify_jwt_in_request
+from werkzeug.exceptions import HTTPException
+
+from init import app, create_logger, env, fernet, redis
+
+from .chat import ChatAssistant
+from .concurrency import spawn
+
+from models.oauth import Oauth
+from models.user import User
+
+logger = create_logger(__name__)
+
+
+# Define the AIJobs class
+class AIJobs:
+    """Redis-backed queue that runs the AI calls in a separate worker process (flask ai worker)."""
+
+    # Queue the AI endpoints instead of calling the AI inside the request
+    ENABLED = env.get('AI_JOBS_ENABLED', 'False').lower() in ('true', '1')
+    # Jobs one user may run at the same time, the rest wait in the queue
+    PER_USER = int(env.get('AI_JOBS_PER_USER', 2))
+    # Jobs one user may have queued or running, further submissions are refused
+    MAX_PENDING = int(env.get('AI_JOBS_MAX_PENDING', 5))
+    # Seconds a job, its result and its events are kept
+    TTL = 3600
+    # Lower runs first, short interactive results are waited on in the open message
+    PRIORITIES = {
+        'paraphrase': 0,
+        'smart_reply': 0,
+        'generate': 1,
+        'modify': 1,
+    }
+    # Statuses a job ends in
+    FINISHED = ('done', 'failed', 'cancelled')
+
+    # Seconds an idle worker waits before looking at the queue again
+    POLL_SECONDS = 0.5
+    # Seconds a claimed job may go without its worker renewing the lease before it is reaped
+    LEASE_SECONDS = 600
+    # Times a job is run before a lost lease fails it
+    MAX_ATTEMPTS = 2
+
+    QUEUE_KEY = 'ai_jobs_queue'
+    LEASE_KEY = 'ai_jobs_leases'
+
+    # Define the job_key method
+    @staticmethod
+    def job_key(job_id):
+        return f'ai_job_{job_id}'
+
+    # Define the events_key method
+    @staticmethod
+    def events_key(job_id):
+        return f'ai_job_events_{job_id}'
+
+    # Define the pending_key method
+    @staticmethod
+    def pending_key(user_id):
+        return f'ai_jobs_pending_{user_id}'
+
+    # Define the running_key method
+    @staticmethod
+    def running_key(user_id):
+        return f'ai_jobs_running_{user_id}'
+
+    # Define the submit method
+    @staticmethod
+    def submit(user_id, kind, payload):
+        """Queue a job and return its id, or None once the user has too many jobs pending."""
+        pending_key = AIJobs.pending_key(user_id)
+
+        if redis.scard(pending_key) >= AIJobs.MAX_PENDING:
+            return None
+
+        job_id = uuid.uuid4().hex
+        priority = AIJobs.PRIORITIES.get(kind, 1)
+
+        redis.hset(AIJobs.job_key(job_id), mapping={
+            'user_id': user_id,
+            'kind': kind,
+            'priority': priority,
+            'status': 'queued',
+            'payload': fernet.encrypt(json.dumps(payload).encode()),
+            'created_at': time.time(),
+        })
+        redis.expire(AIJobs.job_key(job_id), AIJobs.TTL)
+
+        redis.sadd(pending_key, job_id)
+        redis.expire(pending_key, AIJobs.TTL)
+
+        # Priority first, then first in first out
+        redis.zadd(AIJobs.QUEUE_KEY, {job_id: priority * 10 ** 13 + int(time.time() * 1000)})
+
+        return job_id
+
+    # Define the enqueue method
+    @staticmethod
+    def enqueue(user_id, kind, payload):
+        """Queue a job for an API endpoint and return the response body and status code."""
+        job_id = AIJobs.submit(user_id, kind, payload)
+
+        if not job_id:
+            return {'message': 'Too many AI requests are pending, please wait for them to finish'}, 429
+
+        return {'job_id': job_id, 'status': 'queued'}, 202
+
+    # Define the get method
+    @staticmethod
+    def get(job_id, user_id):
+        job = redis.hgetall(AIJobs.job_key(job_id))
+
+        if not job or int(job[b'user_id']) != user_id:
+            return None
+
+        data = {
+            'job_id': job_id,
+            'kind': job[b'kind'].decode(),
+            'status': job[b'status'].decode(),
+        }
+
+        if b'result' in job:
+            data['result'] = json.loads(fernet.decrypt(job[b'result']))
+
+        if b'error' in job:
+            data['message'] = job[b'error'].decode()
+
+        return data
+
+    # Define the cancel method
+    @staticmethod
+    def cancel(job_id, user_id):
+        job = AIJobs.get(job_id, user_id)
+
+        if not job:
+            return None
+
+        if job['status'] in AIJobs.FINISHED:
+            return job
+
+        # A queued job is dropped at once, a running one stops at its next event
+        if redis.zrem(AIJobs.QUEUE_KEY, job_id):
+            AIJobs.finish(job_id, user_id, 'cancelled')
+        else:
+            redis.hset(AIJobs.job_key(job_id), 'cancelled', 1)
+
+        job['status'] = 'cancelled'
+        return job
+
+    # Define the is_cancelled method
+    @staticmethod
+    def is_cancelled(job_id):
+        return bool(redis.hexists(AIJobs.job_key(job_id), 'cancelled'))
+
+    # Define the publish method
+    @staticmethod
+    def publish(job_id, event, data):
+        key = AIJobs.events_key(job_id)
+
+        redis.xadd(key, {'event': event, 'data': fernet.encrypt(json.dumps(data).encode())})
+        redis.expire(key, AIJobs.TTL)
+
+    # Define the events method
+    @staticmethod
+    def events(job_id, block=15000):
+        """Yield the (event, data) pairs of a job from the start until it finishes."""
+        last_id = '0'
+
+        while True:
+            entries = redis.xread({AIJobs.events_key(job_id): last_id}, block=block, count=100)
+
+            if not entries:
+                # Nothing arrived within the block time, stop if the job is gone or over
+                status = redis.hget(AIJobs.job_key(job_id), 'status')
+
+                if status is None or status.decode() in AIJobs.FINISHED:
+                    return
+
+                yield 'ping', {}
+                continue
+
+            for entry_id, fields in entries[0][1]:
+                last_id = entry_id
+                event = fields[b'event'].decode()
+
+                yield event, json.loads(fernet.decrypt(fields[b'data']))
+
+                if event in ('done', 'error', 'cancelled'):
+                    return
+
+    # Define the finish method
+    @staticmethod
+    def finish(job_id, user_id, status, result=None, error=None, lease=None):
+        """Record how a job ended, a worker passes its lease so a reaped attempt cannot overwrite the next one."""
+        # The reaper took the job away from this worker
+        if lease is not None and redis.hget(AIJobs.job_key(job_id), 'lease') != lease.encode():
+            return
+
+        mapping = {'status': status}
+
+        if result is not None:
+            mapping['result'] = fernet.encrypt(json.dumps(result).encode())
+
+        if error is not None:
+            mapping['error'] = error
+
+        redis.hset(AIJobs.job_key(job_id), mapping=mapping)
+        redis.expire(AIJobs.job_key(job_id), AIJobs.TTL)
+        redis.srem(AIJobs.pending_key(user_id), job_id)
+
+        if status == 'done':
+            AIJobs.publish(job_id, 'done', result)
+        elif status == 'failed':
+            AIJobs.publish(job_id, 'error', {'message': error})
+        else:
+            AIJobs.publish(job_id, 'cancelled', {'message': 'The job was cancelled'})
+
+    # Define the claim method
+    @staticmethod
+    def claim():
+        """Take the first queued job whose user is under the per-user cap."""
+        for job_id in redis.zrange(AIJobs.QUEUE_KEY, 0, 99):
+            job_id = job_id.decode()
+            user_id = redis.hget(AIJobs.job_key(job_id), 'user_id')
+
+            if user_id is None:
+                # The job expired while it waited
+                redis.zrem(AIJobs.QUEUE_KEY, job_id)
+                continue
+
+            user_id = int(user_id)
+            running_key = AIJobs.running_key(user_id)
+
+            # Skip the user for now, their later jobs keep their place in the queue
+            if redis.incr(running_key) > AIJobs.PER_USER:
+                redis.decr(running_key)
+                continue
+
+            # Only the worker that removes the job from the queue runs it
+            if not redis.zrem(AIJobs.QUEUE_KEY, job_id):
+                redis.decr(running_key)
+                continue
+
+            lease = uuid.uuid4().hex
+
+            redis.expire(running_key, AIJobs.TTL)
+            redis.zadd(AIJobs.LEASE_KEY, {job_id: time.time() + AIJobs.LEASE_SECONDS})
+            redis.hset(AIJobs.job_key(job_id), mapping={'status': 'running', 'lease': lease})
+            redis.hincrby(AIJobs.job_key(job_id), 'attempts', 1)
+
+            return job_id, user_id, lease
+
+        return None
+
+    # Define the renew method
+    @staticmethod
+    def renew(job_id):
+        # Only a job that still holds its lease is renewed
+        redis.zadd(AIJobs.LEASE_KEY, {job_id: time.time() + AIJobs.LEASE_SECONDS}, xx=True)
+
+    # Define the release method
+    @staticmethod
+    def release(job_id, user_id):
+        """Give back the job's running slot, only once whether its worker or the reaper gets here first."""
+        if redis.zrem(AIJobs.LEASE_KEY, job_id):
+            redis.decr(AIJobs.running_key(user_id))
+            return True
+
+        return False
+
+    # Define the reap method
+    @staticmethod
+    def reap():
+        """Requeue or fail the running jobs whose worker stopped renewing the lease."""
+        for job_id in redis.zrangebyscore(AIJobs.LEASE_KEY, 0, time.time(), start=0, num=100):
+            job_id = job_id.decode()
+            job = redis.hgetall(AIJobs.job_key(job_id))
+
+            if not job:
+                # The job expired, nobody is left to give back the slot
+                redis.zrem(AIJobs.LEASE_KEY, job_id)
+                continue
+
+            user_id = int(job[b'user_id'])
+
+            if not AIJobs.release(job_id, user_id) or job[b'status'].decode() in AIJobs.FINISHED:
+                continue
+
+            # Whatever the lost attempt still finishes with is ignored
+            redis.hdel(AIJobs.job_key(job_id), 'lease')
+
+            if b'cancelled' in job:
+                AIJobs.finish(job_id, user_id, 'cancelled')
+            # A job that already streamed output cannot start over without repeating it
+            elif int(job.get(b'attempts', 0)) < AIJobs.MAX_ATTEMPTS and not redis.exists(AIJobs.events_key(job_id)):
+                redis.hset(AIJobs.job_key(job_id), 'status', 'queued')
+                redis.zadd(AIJobs.QUEUE_KEY, {job_id: int(job[b'priority']) * 10 ** 13 + int(float(job[b'created_at']) * 1000)})
+            else:
+                AIJobs.finish(job_id, user_id, 'failed', error='The AI job stopped responding')
+
+    # Define the run method
+    @staticmethod
+    def run(job_id, user_id, lease):
+        # Keep the lease while the job runs, the AI calls can block for minutes
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(AIJobs.LEASE_SECONDS / 3):
+                AIJobs.renew(job_id)
+
+        spawn(heartbeat)
+
+        try:
+            job = redis.hgetall(AIJobs.job_key(job_id))
+            user = User.query.get(user_id)
+
+            if not job:
+                # The job expired, only its place among the user's pending jobs is left
+                redis.srem(AIJobs.pending_key(user_id), job_id)
+                return
+
+            if not user:
+                AIJobs.finish(job_id, user_id, 'failed', error='The AI job could not be found', lease=lease)
+                return
+
+            kind = job[b'kind'].decode()
+            payload = json.loads(fernet.decrypt(job[b'payload']))
+
+            # Run the job as its user, the chat flows read current_user
+            token = create_access_token(identity=user, expires_delta=timedelta(minutes=10))
+
+            with app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+                verify_jwt_in_request()
+                AIJobs.execute(job_id, user_id, kind, payload, lease)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            AIJobs.finish(job_id, user_id, 'failed', error='Error running the AI job', lease=lease)
+        finally:
+            stopped.set()
+            AIJobs.release(job_id, user_id)
+
+    # Define the execute method
+    @staticmethod
+    def execute(job_id, user_id, kind, payload, lease=None):
+        try:
+            if kind in ('generate', 'modify'):
+                if kind == 'generate':
+                    oauth = Oauth.query.filter_by(id=payload.pop('oauth_id'), user_id=user_id).first()
+
+                    if not oauth:
+                        AIJobs.finish(job_id, user_id, 'failed', error='Email Authentication not found.', lease=lease)
+                        return
+
+                    draft = ChatAssistant.generate_email(oauth=oauth, events=True, **payload)
+                else:
+                    draft = ChatAssistant.modify_email(events=True, **payload)
+
+                # Relay the draft as it is generated, closing it early skips persisting it
+                for event, data in draft:
+                    if AIJobs.is_cancelled(job_id):
+                        draft.close()
+                        AIJobs.finish(job_id, user_id, 'cancelled', lease=lease)
+                        return
+
+                    if event == 'done':
+                        AIJobs.finish(job_id, user_id, 'done', result=data, lease=lease)
+                    elif event == 'error':
+                        AIJobs.finish(job_id, user_id, 'failed', error=data['message'], lease=lease)
+                    else:
+                        AIJobs.publish(job_id, event, data)
+                return
+
+            if kind == 'paraphrase':
+                paraphrase = ChatAssistant.paraphrase_text(text=payload['text'], ai=payload['ai'])
+
+                if not paraphrase:
+                    AIJobs.finish(job_id, user_id, 'failed', error='Error paraphrasing text', lease=lease)
+                    return
+
+                result = ChatAssistant.save_paraphrase(payload['message_id'], payload['text'], paraphrase, payload['type'], payload['position'])
+            elif kind == 'smart_reply':
+                oauth = Oauth.query.filter_by(id=payload.pop('oauth_id'), user_id=user_id).first()
+
+                if not oauth:
+                    AIJobs.finish(job_id, user_id, 'failed', error='Email Authentication not found', lease=lease)
+                    return
+
+                reply = ChatAssistant.smart_reply(oauth=oauth, **payload)
+
+                if not reply:
+                    AIJobs.finish(job_id, user_id, 'failed', error='Error generating smart reply', lease=lease)
+                    return
+
+                result = {'reply': reply}
+            else:
+                AIJobs.finish(job_id, user_id, 'failed', error=f'Unknown job {kind}', lease=lease)
+                return
+
+            # The user may have cancelled while the AI was answering
+            if AIJobs.is_cancelled(job_id):
+                AIJobs.finish(job_id, user_id, 'cancelled', lease=lease)
+                return
+
+            AIJobs.finish(job_id, user_id, 'done', result=result, lease=lease)
+        except HTTPException as e:
+            # The chat flows abort with the message meant for the user
+            message = (getattr(e, 'data', None) or {}).get('message') or e.description
+            AIJobs.finish(job_id, user_id, 'failed', error=message, lease=lease)
+
+    # Define the work method
+    @staticmethod
+    def work(stop):
+        """Claim and run jobs until stop is set, one loop per worker thread."""
+        while not stop.is_set():
+            try:
+                AIJobs.reap()
+
+                claimed = AIJobs.claim()
+
+                if not claimed:
+                    stop.wait(AIJobs.POLL_SECONDS)
+                    continue
+
+                with app.app_context():
+                    AIJobs.run(*claimed)
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+                stop.wait(1)
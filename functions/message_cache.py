@@ -0,0 +1,185 @@
+import hashlib
+import json
+import zlib
+
+from init import create_logger, fernet, redis
+
+logger = create_logger(__name__)
+
+
+# Define the MessageCache class
+class MessageCache:
+    # Seconds a parsed message stays cached, the content of a received message never changes
+    TTL = 7 * 24 * 3600
+    # Seconds a read flag stays cached, it may be changed from other mail clients
+    FLAGS_TTL = 300
+
+    # Define the key method
+    @staticmethod
+    def key(oauth_id, message_id):
+        return f'message_{oauth_id}_{message_id}'
+
+    # Define the flag_key method
+    @staticmethod
+    def flag_key(oauth_id, message_id):
+        return f'message_read_{oauth_id}_{message_id}'
+
+    # Define the get method
+    @staticmethod
+    def get(oauth_id, message_id):
+        if oauth_id is None:
+            return None
+
+        try:
+            data = redis.get(MessageCache.key(oauth_id, message_id))
+
+            if not data:
+                return None
+
+            return json.loads(zlib.decompress(fernet.decrypt(data)))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+
+    # Define the exists method
+    @staticmethod
+    def exists(oauth_id, message_id):
+        if oauth_id is None:
+            return False
+
+        try:
+            return bool(redis.exists(MessageCache.key(oauth_id, message_id)))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return False
+
+    # Define the set method
+    @staticmethod
+    def set(oauth_id, message_id, message):
+        if oauth_id is None:
+            return
+
+        try:
+            # Compress before encrypting, encrypted data does not compress
+            data = fernet.encrypt(zlib.compress(json.dumps(message).encode()))
+
+            redis.setex(MessageCache.key(oauth_id, message_id), MessageCache.TTL, data)
+
+            if 'isRead' in message:
+                MessageCache.set_read(oauth_id, message_id, message['isRead'])
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the get_read method
+    @staticmethod
+    def get_read(oauth_id, message_id):
+        if oauth_id is None:
+            return None
+
+        try:
+            flag = redis.get(MessageCache.flag_key(oauth_id, message_id))
+
+            return None if flag is None else flag in (b'1', '1')
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+
+    # Define the set_read method
+    @staticmethod
+    def set_read(oauth_id, message_id, is_read):
+        if oauth_id is None:
+            return
+
+        try:
+            redis.setex(MessageCache.flag_key(oauth_id, message_id), MessageCache.FLAGS_TTL, '1' if is_read else '0')
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the delete method
+    @staticmethod
+    def delete(oauth_id, message_id):
+        if oauth_id is None:
+            return
+
+        try:
+            redis.delete(MessageCache.key(oauth_id, message_id), MessageCache.flag_key(oauth_id, message_id))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the clear method
+    @staticmethod
+    def clear(oauth_id):
+        try:
+            # Remove every cached message and flag of the account
+            for pattern in (f'message_{oauth_id}_*', f'message_read_{oauth_id}_*'):
+                keys = list(redis.scan_iter(match=pattern, count=500))
+
+                if keys:
+                    redis.delete(*keys)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+
+# Define the PageCache class
+class PageCache:
+    # Seconds a listed page stays cached, pages are only kept for quick paging
+    TTL = 120
+
+    # Define the version_key method
+    @staticmethod
+    def version_key(oauth_id):
+        return f'inbox_page_version_{oauth_id}'
+
+    # Define the key method
+    @staticmethod
+    def key(oauth_id, params):
+        try:
+            version = int(redis.get(PageCache.version_key(oauth_id)) or 0)
+        except Exception:
+            version = 0
+
+        # The version changes whenever the mailbox does, which retires every cached page at once
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+        return f'inbox_page_{oauth_id}_{version}_{digest}'
+
+    # Define the get method
+    @staticmethod
+    def get(oauth_id, params):
+        if oauth_id is None:
+            return None
+
+        try:
+            data = redis.get(PageCache.key(oauth_id, params))
+
+            if not data:
+                return None
+
+            return json.loads(zlib.decompress(fernet.decrypt(data)))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+
+    # Define the set method
+    @staticmethod
+    def set(oauth_id, params, page):
+        if oauth_id is None:
+            return
+
+        try:
+            data = fernet.encrypt(zlib.compress(json.dumps(page).encode()))
+
+            redis.setex(PageCache.key(oauth_id, params), PageCache.TTL, data)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the invalidate method
+    @staticmethod
+    def invalidate(oauth_id):
+        if oauth_id is None:
+            return
+
+        try:
+            redis.incr(PageCache.version_key(oauth_id))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
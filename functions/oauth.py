@@ -5,16 +5,30 @@ from email.mime.multipart import MIMEMultipart
 
 from email.mime.text import MIMEText
 import json
+import queue
+import time
+from contextlib import contextmanager
+from datetime import datetime
 
 import requests
 
-from init import create_logger, env, fernet, db
+from init import create_logger, env, fernet, db, redis
 
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import build_http
+from google_auth_httplib2 import AuthorizedHttp
 
 from .email import Email
+from .sync import GmailSync, OutlookSync, LOCAL_PAGE_PREFIX, OLDER_PAGE_PREFIX
+from .folders import FolderRegistry
+from .http_pool import get_client
+from .concurrency import fan_out, GLOBAL_LIMIT
+from .images import InlineImages
+from .message_cache import MessageCache
+from .projection import SUMMARY, MESSAGE
 
 import msal
 
@@ -22,17 +36,87 @@ from models.oauth import Oauth
 
 logger = create_logger(__name__)
 
+# Pooled keep-alive client for Microsoft Graph
+graph = get_client('graph')
+
+# MSAL metadata responses shared by every request in the worker process, so new apps skip the authority discovery
+msal_http_cache = {}
+
+# Idle keep-alive connections to the Google APIs, one concurrent call can use each
+gmail_http_pool = queue.LifoQueue(maxsize=GLOBAL_LIMIT)
+
+# Parsed Google discovery documents, cached once per worker process
+discovery_documents = {}
+
+# Build a Google API service from the cached discovery document
+def build_service(service_name, version, credentials):
+    document = discovery_documents.get((service_name, version))
+    
+    if document is None:
+        # Load the static discovery document shipped with googleapiclient
+        static_document = get_static_doc(service_name, version)
+        
+        # Fall back to the discovery service if there is no static document
+        if static_document is None:
+            return build(service_name, version, credentials=credentials)
+        
+        document = json.loads(static_document)
+        discovery_documents[(service_name, version)] = document
+    
+    # Bind the credentials to a new service built from the parsed document
+    return build_from_document(document, credentials=credentials)
+
 
 # Define the Google class
 class Google:
     # Google API variables
     SCOPES = env.get('GOOGLE_SCOPES').split(',')
+    # Headers requested for the summary view of a message
+    SUMMARY_HEADERS = ['Subject', 'From', 'To', 'Cc', 'Date']
+    # Stop sharing refreshed credentials when they have less than this many seconds left
+    TOKEN_EXPIRY_MARGIN = 300
+    # Gmail throttles batch requests of more than 50 calls
+    BATCH_SIZE = 50
+    # Times the calls refused in a batch are retried, backing off between attempts
+    BATCH_RETRIES = 3
     
     # Google API Initialization
-    def __init__(self, credentials):
+    def __init__(self, credentials, oauth_id=None):
         self.credentials = credentials
+        self.oauth_id = oauth_id
         self.authenticate()
         
+    # Define the credentials_key method
+    @staticmethod
+    def credentials_key(oauth_id):
+        return f'google_credentials_{oauth_id}'
+    
+    # Define the clear_cached_credentials method
+    @staticmethod
+    def clear_cached_credentials(oauth_id):
+        try:
+            redis.delete(Google.credentials_key(oauth_id))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+    
+    # Define the get_cached_credentials method
+    def get_cached_credentials(self):
+        if self.oauth_id is None:
+            return None
+        
+        try:
+            cached = redis.get(self.credentials_key(self.oauth_id))
+            
+            if not cached:
+                return None
+            
+            creds = Credentials.from_authorized_user_info(json.loads(fernet.decrypt(cached).decode()), self.SCOPES)
+            
+            return creds if creds.valid else None
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+        
     # Define the authenticate method
     def authenticate(self):
         try:
@@ -48,41 +132,118 @@ class Google:
         if not self.creds or not self.creds.valid:
             # Check if the credentials are expired and refresh them
             if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    # Refresh the credentials
-                    self.creds.refresh(Request())
-                    
-                    # Update the database with the new credentials
-                    creds_json = self.creds.to_json()
-                    profile = self.fetch_user_profile()
-                    email = profile['email']
-                    oauth = Oauth.query.filter_by(email=email).first()
-                    if not oauth:
-                        return False
-                    
-                    oauth.data = fernet.encrypt(str(creds_json).encode()).decode()
+                # Use the credentials another request already refreshed
+                cached_creds = self.get_cached_credentials()
+                
+                if cached_creds:
+                    self.creds = cached_creds
+                elif self.oauth_id is None:
+                    self.refresh_credentials()
+                else:
+                    # Only let one request refresh the credentials of an account at a time
+                    lock = redis.lock(f'google_credentials_lock_{self.oauth_id}', timeout=30, blocking_timeout=30)
                     
-                    db.session.commit()
-                except Exception as e:
-                    # Print the error
-                    logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
-                    # Set the credentials to None
-                    self.creds = None
+                    if lock.acquire():
+                        try:
+                            # The credentials may have been refreshed while we waited
+                            cached_creds = self.get_cached_credentials()
+                            
+                            if cached_creds:
+                                self.creds = cached_creds
+                            else:
+                                self.refresh_credentials()
+                        finally:
+                            try:
+                                lock.release()
+                            except Exception as e:
+                                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+                    else:
+                        self.creds = None
         
         # Check if the credentials are still None
         try:
-            self.service = build('gmail', 'v1', credentials=self.creds)
+            self.service = build_service('gmail', 'v1', credentials=self.creds)
         except Exception as e:
             # Print the error
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             # Set the service to None
             self.service = None
         
+    # Define the pooled_http method
+    @contextmanager
+    def pooled_http(self):
+        # httplib2 connections are not safe to share between concurrent calls, so each call checks one out
+        try:
+            http = gmail_http_pool.get_nowait()
+        except queue.Empty:
+            http = build_http()
+        
+        try:
+            yield AuthorizedHttp(self.creds, http=http)
+        finally:
+            # Hand the open connection to the next call, whichever account it is for
+            try:
+                gmail_http_pool.put_nowait(http)
+            except queue.Full:
+                http.close()
+        
+    # Define the refresh_credentials method
+    def refresh_credentials(self):
+        try:
+            # Refresh the credentials
+            self.creds.refresh(Request())
+            
+            # Update the database with the new credentials
+            creds_json = self.creds.to_json()
+            
+            if self.oauth_id is not None:
+                oauth = Oauth.query.filter_by(id=self.oauth_id).first()
+            else:
+                profile = self.fetch_user_profile()
+                email = profile['email']
+                oauth = Oauth.query.filter_by(email=email).first()
+                
+            if not oauth:
+                return False
+            
+            oauth.data = fernet.encrypt(str(creds_json).encode()).decode()
+            
+            db.session.commit()
+            
+            # Share the refreshed credentials until shortly before they expire
+            if self.oauth_id is not None and self.creds.expiry:
+                expires_in = int((self.creds.expiry - datetime.utcnow()).total_seconds()) - self.TOKEN_EXPIRY_MARGIN
+                
+                if expires_in > 0:
+                    redis.setex(self.credentials_key(self.oauth_id), expires_in, fernet.encrypt(creds_json.encode()))
+            
+            return True
+        except Exception as e:
+            # Print the error
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            # Set the credentials to None
+            self.creds = None
+            return False
+        
+    # Define the watch method
+    def watch(self, topic_name):
+        try:
+            # Ask Gmail to publish mailbox changes to the Pub/Sub topic
+            response = self.service.users().watch(
+                userId='me',
+                body={'topicName': topic_name}
+            ).execute()
+            
+            return response
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+        
     # Define the fetch user profile method
     def fetch_user_profile(self):
         try:
             # Create people service
-            people_service = build('people', 'v1', credentials=self.creds)
+            people_service = build_service('people', 'v1', credentials=self.creds)
             profile = people_service.people().get(resourceName='people/me', personFields='names,emailAddresses').execute()
             
             # Get the names
@@ -150,16 +311,15 @@ class Google:
     def reply_email(self, sender, message_id, reply_message, subject=None, cc=None, bcc=None, attachments=None):
         try:
             # Get the original message using the message ID
-            original_message = self.service.users().messages().get(userId='me', id=message_id).execute()
+            original_message = self.get_message(message_id)
             
-
             # Extract the necessary fields from the original message
-            original_subject = original_message['payload']['headers'][0]['value']
+            original_subject = original_message['subject']
             thread_id = original_message['threadId']
-            original_from = next(header for header in original_message['payload']['headers'] if header['name'] == 'From')['value']
-            og_msg = self.get_message(message_id)
-            original_body = og_msg['body']
-            date = og_msg['date']
+            original_from = original_message['from']
+            # The recipients cannot load the quoted images through the image proxy
+            original_body = InlineImages.embed(original_message['body'], self.oauth_id, lambda image: self.attachment_data(image['message_id'], image['attachment_id']))
+            date = original_message['date']
             
 
             # Modify the subject to include "Re:"
@@ -214,10 +374,23 @@ class Google:
 
     
     # Define the list_messages method
-    def list_messages(self, query='', next_page=None, max_results=5, folder_name=None):
+    def list_messages(self, query='', next_page=None, max_results=5, folder_name=None, view='full', projection=None):
         try:
             all_messages = []
             
+            # Serve unfiltered summary listings from the local mailbox index
+            if view == 'summary' and not query and self.oauth_id is not None and (not next_page or next_page.startswith((LOCAL_PAGE_PREFIX, OLDER_PAGE_PREFIX))):
+                mailbox = GmailSync(self, self.oauth_id)
+                mailbox.sync()
+                
+                data = mailbox.list_messages(folder_name=folder_name, max_results=max_results, next_page=next_page)
+                
+                if data is not None:
+                    return data
+                
+                # Fall back to the provider from the first page
+                next_page = None
+            
             folder_info = self.get_folder(folder_name.upper() if not folder_name is None else None)
             
             # List the messages
@@ -226,7 +399,8 @@ class Google:
                 q=query, 
                 maxResults=max_results,
                 pageToken=next_page,
-                labelIds=[folder_info['id']] if not folder_info is None else []
+                labelIds=[folder_info['id']] if not folder_info is None else [],
+                fields='messages(id,threadId),nextPageToken,resultSizeEstimate'
                 ).execute()
             
             total_results = messages.get('resultSizeEstimate', 0)
@@ -234,10 +408,14 @@ class Google:
             total_pages = (total_results // max_results) + (1 if total_results % max_results != 0 else 0)
             
             get_messages = messages.get('messages', [])
+            
+            # Fetch every message on the page in a single batch request
+            batch_messages = self.get_messages_batch([message['id'] for message in get_messages], view=view, projection=projection)
+            
             for message in get_messages:
                 message_id = message['id']
                 thread_id = message['threadId']
-                message = self.get_message(message_id)
+                message = batch_messages[message_id]
                 all_messages.append(
                     {
                     'id': message_id,
@@ -261,11 +439,210 @@ class Google:
             return {'message': 'Failed to list messages'}
     
     # Define the get_message method
-    def get_message(self, message_id):
+    def get_message(self, message_id, projection=MESSAGE):
         try:
+            # The content never changes, only the read flag has to be checked
+            cached = MessageCache.get(self.oauth_id, message_id) if projection is MESSAGE else None
+            
+            if cached:
+                is_read = MessageCache.get_read(self.oauth_id, message_id)
+                
+                if is_read is None:
+                    is_read = self.get_read_state(message_id)
+                    
+                    if is_read is not None:
+                        MessageCache.set_read(self.oauth_id, message_id, is_read)
+                
+                if is_read is not None:
+                    cached['isRead'] = is_read
+                
+                return cached
+            
             # Get the message
-            message = self.service.users().messages().get(userId='me', id=message_id).execute()
+            message = self.service.users().messages().get(userId='me', id=message_id, fields=projection.gmail()).execute()
+            
+            msg = self.parse_message(message_id, message)
+            
+            # Only complete messages are cached
+            if 'message' not in msg and projection is MESSAGE:
+                MessageCache.set(self.oauth_id, message_id, msg)
+            
+            return msg
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return {'message': 'Failed to get message'}
+    
+    # Define the get_read_state method
+    def get_read_state(self, message_id):
+        try:
+            message = self.service.users().messages().get(userId='me', id=message_id, format='minimal', fields='labelIds').execute()
             
+            return 'UNREAD' not in message.get('labelIds', [])
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
+    # Define the get_messages_batch method
+    def get_messages_batch(self, message_ids, view='full', projection=None):
+        raw_messages = self.fetch_messages_batch(message_ids, view=view, projection=projection)
+        
+        # Parse the messages in the original order
+        messages = {}
+        for message_id in message_ids:
+            if message_id in raw_messages and view == 'summary':
+                messages[message_id] = self.parse_message_summary(raw_messages[message_id])
+            elif message_id in raw_messages:
+                messages[message_id] = self.parse_message(message_id, raw_messages[message_id])
+            else:
+                messages[message_id] = {'message': 'Failed to get message'}
+        
+        return messages
+    
+    # Define the fetch_messages_batch method
+    def fetch_messages_batch(self, message_ids, view='full', projection=None, failed=None):
+        """Fetch the raw messages keyed by ID, the IDs still failing after the retries are added to failed."""
+        raw_messages = {}
+        retry_ids = []
+        
+        # Only download the fields the view reads
+        fields = (projection or (SUMMARY if view == 'summary' else MESSAGE)).gmail()
+        
+        # Collect every batch response keyed by the message ID
+        def callback(request_id, response, exception):
+            if exception is not None:
+                logger.error('Failed to get message {} in batch: {}'.format(request_id, exception))
+                
+                # A deleted message will not come back, anything else is retried
+                if getattr(getattr(exception, 'resp', None), 'status', None) != 404:
+                    retry_ids.append(request_id)
+                return
+            raw_messages[request_id] = response
+        
+        # Send one batch request per chunk of message IDs
+        def execute_batch(chunk):
+            batch = self.service.new_batch_http_request(callback=callback)
+            
+            for message_id in chunk:
+                if view == 'summary':
+                    # Only fetch the headers and snippet for the summary view
+                    request = self.service.users().messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=self.SUMMARY_HEADERS, fields=fields)
+                else:
+                    request = self.service.users().messages().get(userId='me', id=message_id, fields=fields)
+                batch.add(request, request_id=message_id)
+            
+            try:
+                # Execute all the queued requests in one HTTP round trip
+                with self.pooled_http() as http:
+                    batch.execute(http=http)
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+                retry_ids.extend(message_id for message_id in chunk if message_id not in raw_messages)
+        
+        pending = list(message_ids)
+        
+        for attempt in range(self.BATCH_RETRIES + 1):
+            if attempt:
+                # Back off before asking again for the calls Gmail refused
+                time.sleep(0.5 * 2 ** (attempt - 1))
+            
+            del retry_ids[:]
+            
+            # Run the chunks concurrently, a failed chunk only loses its own messages
+            chunks = [pending[start:start + self.BATCH_SIZE] for start in range(0, len(pending), self.BATCH_SIZE)]
+            fan_out(execute_batch, chunks, account=self.oauth_id)
+            
+            pending = list(retry_ids)
+            
+            if not pending:
+                break
+        
+        if failed is not None:
+            failed.extend(pending)
+        
+        return raw_messages
+    
+    # Define the get_history_id method
+    def get_history_id(self):
+        try:
+            profile = self.service.users().getProfile(userId='me').execute()
+            
+            return profile.get('historyId')
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
+    # Define the list_message_ids method
+    def list_message_ids(self, max_results=500):
+        try:
+            message_ids = []
+            next_page = None
+            
+            # Page through the mailbox until enough message IDs are collected
+            while len(message_ids) < max_results:
+                messages = self.service.users().messages().list(
+                    userId='me',
+                    maxResults=min(500, max_results - len(message_ids)),
+                    pageToken=next_page,
+                    includeSpamTrash=True,
+                    fields='messages/id,nextPageToken'
+                    ).execute()
+                
+                message_ids += [message['id'] for message in messages.get('messages', [])]
+                
+                next_page = messages.get('nextPageToken', None)
+                if not next_page:
+                    break
+            
+            return message_ids
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
+    # Define the list_history method
+    def list_history(self, start_history_id):
+        history = []
+        next_page = None
+        
+        # Page through every change since the start history ID
+        while True:
+            response = self.service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                pageToken=next_page
+                ).execute()
+            
+            history += response.get('history', [])
+            
+            next_page = response.get('nextPageToken', None)
+            if not next_page:
+                return history, response.get('historyId', start_history_id)
+    
+    # Define the parse_message_summary method
+    def parse_message_summary(self, message):
+        try:
+            payload = message.get('payload', {})
+            header = payload.get('headers', [])
+            
+            msg = {
+                'subject': next((i['value'] for i in header if i['name'] == 'Subject'), None),
+                'from': next((i['value'] for i in header if i['name'] == 'From'), None),
+                'to': next((i['value'] for i in header if i['name'] == 'To'), None),
+                'cc': next((i['value'] for i in header if i['name'] == 'Cc'), None),
+                'date': next((i['value'] for i in header if i['name'] == 'Date'), None),
+                'snippet': message.get('snippet', ''),
+                # Metadata responses have no parts, a mixed payload is how Gmail marks attachments
+                'hasAttachments': payload.get('mimeType') == 'multipart/mixed',
+                'isRead': 'UNREAD' not in message.get('labelIds', [])
+            }
+            
+            return msg
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return {'message': 'Failed to get message'}
+    
+    # Define the parse_message method
+    def parse_message(self, message_id, message):
+        try:
             header = message.get('payload', {}).get('headers', [])
             subject = next((i['value'] for i in header if i['name'] == 'Subject'), None)
             from_email = next((i['value'] for i in header if i['name'] == 'From'), None)
@@ -273,7 +650,6 @@ class Google:
             date = next((i['value'] for i in header if i['name'] == 'Date'), None)
             cc = next((i['value'] for i in header if i['name'] == 'Cc'), None)
             bcc = next((i['value'] for i in header if i['name'] == 'Bcc'), None)
-            attachments = []
             
             labels = message.get('labelIds', [])
             is_read = 'UNREAD' not in labels
@@ -290,15 +666,7 @@ class Google:
                     if attachment_data:
                         body = base64.urlsafe_b64decode(attachment_data).decode('utf-8')
                         break  # Prefer HTML, so break if found
-                elif mime_type == 'multipart/alternative':
-                    for subpart in part.get('parts', []):
-                        sub_mime_type = subpart.get('mimeType')
-                        if sub_mime_type == 'text/html':
-                            attachment_data = subpart['body'].get('data')
-                            if attachment_data:
-                                body = base64.urlsafe_b64decode(attachment_data).decode('utf-8')
-                                break  # Prefer HTML, so break if found
-                elif mime_type == 'multipart/mixed':
+                elif mime_type in ('multipart/alternative', 'multipart/mixed', 'multipart/related'):
                     for subpart in part.get('parts', []):
                         sub_mime_type = subpart.get('mimeType')
                         if sub_mime_type == 'text/html':
@@ -306,32 +674,13 @@ class Google:
                             if attachment_data:
                                 body = base64.urlsafe_b64decode(attachment_data).decode('utf-8')
                                 break  # Prefer HTML, so break if found
-                        elif sub_mime_type == 'application/pdf':
-                            attachment_id = subpart['body']['attachmentId']
-                            attachment = self.get_attachment(message_id, attachment_id)
-                            attachments.append(attachment)
-                elif mime_type == 'application/pdf':
-                    attachment_id = part['body']['attachmentId']
-                    attachment = self.get_attachment(message_id, attachment_id)
-                    attachments.append(attachment)
                 elif mime_type == 'text/plain' and not body:
                     attachment_data = part['body'].get('data')
                     if attachment_data:
                         body = base64.urlsafe_b64decode(attachment_data).decode('utf-8')
-                elif mime_type == 'multipart/related':
-                    for subpart in part.get('parts', []):
-                        sub_mime_type = subpart.get('mimeType')
-                        if sub_mime_type == 'text/html':
-                            attachment_data = subpart['body'].get('data')
-                            if attachment_data:
-                                body = base64.urlsafe_b64decode(attachment_data).decode('utf-8')
-                                break
-                        elif sub_mime_type == 'application/pdf':
-                            attachment_id = subpart['body']['attachmentId']
-                            attachment = self.get_attachment(message_id, attachment_id)
-                            attachments += attachment
                             
             attachments = []
+            inline_images = []
             for part in parts:
                 if part.get('filename'):
                     content_id = part.get('headers', [{}])[0].get('value')
@@ -351,13 +700,17 @@ class Google:
                         for header in part.get('headers', []):
                             if header.get('name') == 'Content-ID':
                                 content_id = header.get('value').replace('<', '').replace('>', '')
-                                attachment_data = self.get_attachment_base64(message_id, attachment_id)
                                 if f'cid:{content_id}' not in body:
                                     attachments.append(attachment)
                                 else:
-                                    body = body.replace(f'cid:{content_id}', f'data:{mime_type};base64,{attachment_data}')
+                                    inline_images.append((content_id, attachment_id, mime_type))
+            
+            # Let the browser load the inline images lazily through the image proxy
+            if self.oauth_id is not None:
+                body = InlineImages.rewrite(body, 'google', self.oauth_id, message_id, inline_images)
             
             msg = {
+                'threadId': message.get('threadId'),
                 'subject': subject,
                 'from': from_email,
                 'to': to_email,
@@ -401,6 +754,29 @@ class Google:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return False
         
+    # Define batch_message_action method
+    def batch_message_action(self, message_ids, action):
+        # Gmail accepts at most 1000 message IDs per batch call
+        batch_size = 1000
+        
+        try:
+            for start in range(0, len(message_ids), batch_size):
+                ids = message_ids[start:start + batch_size]
+                
+                if action == 'read':
+                    self.service.users().messages().batchModify(userId='me', body={'ids': ids, 'removeLabelIds': ['UNREAD']}).execute()
+                elif action == 'unread':
+                    self.service.users().messages().batchModify(userId='me', body={'ids': ids, 'addLabelIds': ['UNREAD']}).execute()
+                elif action == 'delete':
+                    self.service.users().messages().batchDelete(userId='me', body={'ids': ids}).execute()
+                else:
+                    return {message_id: False for message_id in message_ids}
+            
+            return {message_id: True for message_id in message_ids}
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return {message_id: False for message_id in message_ids}
+        
     # Define delete_message method
     def delete_message(self, message_id):
         try:
@@ -427,13 +803,13 @@ class Google:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return {'message': 'Failed to get attachment'}
     
-    def attachment_data(self, message_id, attachment_id):
+    def attachment_data(self, message_id, attachment_id, http=None):
         try:
             attachment = self.service.users().messages().attachments().get(
                 userId='me',
                 messageId=message_id,
                 id=attachment_id
-            ).execute()
+            ).execute(http=http)
             
             data = attachment['data']
             file_data = base64.urlsafe_b64decode(data)
@@ -443,39 +819,118 @@ class Google:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return None
 
-    def get_attachment_base64(self, message_id, attachment_id):
+    # Define the open_attachment method
+    def open_attachment(self, message_id, attachment_id, chunk_size):
+        try:
+            attachment = self.service.users().messages().attachments().get(
+                userId='me',
+                messageId=message_id,
+                id=attachment_id
+            ).execute()
+            
+            # Look up the file name and type from the message parts
+            message = self.service.users().messages().get(
+                userId='me',
+                id=message_id,
+                fields='payload(parts(filename,mimeType,body/attachmentId,parts(filename,mimeType,body/attachmentId)))'
+            ).execute()
+            part = self.find_attachment_part(message.get('payload', {}).get('parts', []), attachment_id) or {}
+            
+            data = attachment['data']
+            
+            return {
+                'filename': part.get('filename') or 'attachment',
+                'mime_type': part.get('mimeType') or 'application/octet-stream',
+                'size': len(data.rstrip('=')) * 3 // 4,
+                'chunks': self.decode_chunks(data, chunk_size)
+            }
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
+    # Define the find_attachment_part method
+    @staticmethod
+    def find_attachment_part(parts, attachment_id):
+        for part in parts:
+            if part.get('body', {}).get('attachmentId') == attachment_id:
+                return part
+            
+            found = Google.find_attachment_part(part.get('parts', []), attachment_id)
+            if found:
+                return found
+        
+        return None
+    
+    # Define the decode_chunks method
+    @staticmethod
+    def decode_chunks(data, chunk_size):
+        # Gmail only returns base64, decode it a chunk at a time instead of in one copy
+        step = chunk_size // 3 * 4
+        
+        for start in range(0, len(data), step):
+            piece = data[start:start + step]
+            yield base64.urlsafe_b64decode(piece + '=' * (-len(piece) % 4))
+
+    def get_attachment_base64(self, message_id, attachment_id, http=None):
         try:
-            attachment_data = self.attachment_data(message_id, attachment_id)  # Ensure correct method call
+            attachment_data = self.attachment_data(message_id, attachment_id, http=http)  # Ensure correct method call
             base64_string = base64.b64encode(attachment_data).decode('utf-8')  # Return the base64 string
             return base64_string
         except Exception as e:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return None
     
-    def list_folders(self):
+    def list_folders(self, refresh=False):
+        # Serve the folders from the registry while they are cached
+        cached_folders = None if refresh else FolderRegistry.get(self.oauth_id)
+        if cached_folders is not None:
+            return cached_folders
+        
         try:
             folders = self.service.users().labels().list(userId='me').execute()
+            label_ids = [folder['id'] for folder in folders.get('labels', [])]
+            label_details = {}
+            
+            # Collect every label response keyed by the label ID
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    logger.error('Failed to get label {} in batch: {}'.format(request_id, exception))
+                    return
+                label_details[request_id] = response
+            
+            # Get label details including message count, unread count, and visibility in batches Gmail accepts
+            for start in range(0, len(label_ids), self.BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=callback)
+                for label_id in label_ids[start:start + self.BATCH_SIZE]:
+                    batch.add(self.service.users().labels().get(userId='me', id=label_id), request_id=label_id)
+                with self.pooled_http() as http:
+                    batch.execute(http=http)
+            
             folder_counts = []
             
             for folder in folders.get('labels', []):
                 label_id = folder['id']
                 
-                # Get label details including message count, unread count, and visibility
-                label_details = self.service.users().labels().get(userId='me', id=label_id).execute()
+                if label_id not in label_details:
+                    continue
                 
                 # Determine if the label is hidden based on labelListVisibility
-                is_hidden = label_details.get('labelListVisibility') == 'labelHide'
+                is_hidden = label_details[label_id].get('labelListVisibility') == 'labelHide'
                 
                 # Store folder information with counts and visibility
                 folder_info = {
                     'id': label_id,
-                    'name': label_details['name'].lower().capitalize(),
-                    'messageCount': label_details.get('messagesTotal', 0),
-                    'unreadCount': label_details.get('messagesUnread', 0),
+                    'name': label_details[label_id]['name'].lower().capitalize(),
+                    'messageCount': label_details[label_id].get('messagesTotal', 0),
+                    'unreadCount': label_details[label_id].get('messagesUnread', 0),
                     'isHidden': is_hidden
                 }
                 folder_counts.append(folder_info)
             
+            # Only cache complete lists, the next request asks again for the missing labels
+            if len(label_details) == len(label_ids):
+                FolderRegistry.set(self.oauth_id, folder_counts)
+            
             return folder_counts
         except Exception as e:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
@@ -499,28 +954,97 @@ class Microsoft:
     CLIENT_ID = env.get('MICROSOFT_CLIENT_ID')
     CLIENT_SECRET = env.get('MICROSOFT_CLIENT_SECRET')
     AUTHORITY = env.get('MICROSOFT_AUTHORITY')
+    # Fields requested for the summary view of a message
+    SUMMARY_FIELDS = SUMMARY.graph()
+    
+    # Refresh the access token when it has less than this many seconds left
+    TOKEN_EXPIRY_MARGIN = 300
     
-    def __init__(self, credentials):
+    def __init__(self, credentials, oauth_id=None):
         self.credentials = credentials
+        self.oauth_id = oauth_id
         self.authenticate()
         
+    @classmethod
+    def get_app(cls):
+        # Tokens are kept in the database and Redis, so every call gets a throwaway token cache
+        return msal.ConfidentialClientApplication(
+            cls.CLIENT_ID, authority=cls.AUTHORITY,
+            client_credential=cls.CLIENT_SECRET,
+            token_cache=msal.TokenCache(),
+            http_cache=msal_http_cache
+        )
+    
+    @staticmethod
+    def token_key(oauth_id):
+        return f'microsoft_token_{oauth_id}'
+    
+    @staticmethod
+    def clear_cached_token(oauth_id):
+        try:
+            redis.delete(Microsoft.token_key(oauth_id))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+    
+    def get_cached_token(self):
+        if self.oauth_id is None:
+            return None
+        
+        try:
+            token = redis.get(self.token_key(self.oauth_id))
+            
+            if not token:
+                return None
+            
+            return fernet.decrypt(token).decode()
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+        
     def authenticate(self):
         self.access_token = self.credentials.get('access_token')
         self.refresh_token = self.credentials.get('refresh_token')
         
-        self.app = msal.ConfidentialClientApplication(
-            self.CLIENT_ID, authority=self.AUTHORITY,
-            client_credential=self.CLIENT_SECRET
-        )
+        # Use the cached access token while it is not near expiry
+        cached_token = self.get_cached_token()
+        if cached_token:
+            self.access_token = cached_token
+            return True
         
-        code = self.app.acquire_token_by_refresh_token(self.refresh_token, scopes=self.SCOPES)
+        if self.oauth_id is None:
+            return self.refresh_access_token()
         
-        if 'error' in code:
+        # Only let one request refresh the token of an account at a time
+        lock = redis.lock(f'microsoft_token_lock_{self.oauth_id}', timeout=30, blocking_timeout=30)
+        
+        if not lock.acquire():
             return False
         
-        email = self.credentials.get('id_token_claims').get('preferred_username')
+        try:
+            # Another request may have refreshed the token while we waited
+            cached_token = self.get_cached_token()
+            if cached_token:
+                self.access_token = cached_token
+                return True
+            
+            return self.refresh_access_token()
+        finally:
+            try:
+                lock.release()
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+    
+    def refresh_access_token(self):
+        code = self.get_app().acquire_token_by_refresh_token(self.refresh_token, scopes=self.SCOPES)
+        
+        if 'error' in code:
+            return False
         
-        oauth = Oauth.query.filter_by(email=email).first()
+        if self.oauth_id is not None:
+            oauth = Oauth.query.filter_by(id=self.oauth_id).first()
+        else:
+            email = self.credentials.get('id_token_claims').get('preferred_username')
+            oauth = Oauth.query.filter_by(email=email).first()
         
         if not oauth:
             return False
@@ -531,6 +1055,16 @@ class Microsoft:
         
         self.access_token = code['access_token']
         
+        # Cache the access token until shortly before it expires
+        expires_in = int(code.get('expires_in', 0)) - self.TOKEN_EXPIRY_MARGIN
+        if self.oauth_id is not None and expires_in > 0:
+            try:
+                redis.setex(self.token_key(self.oauth_id), expires_in, fernet.encrypt(self.access_token.encode()))
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+        
+        return True
+        
     def send_email(self, sender, to, subject, body, cc=None, bcc=None, attachments=None):
         # Create the message
         msg = MIMEMultipart()
@@ -603,7 +1137,7 @@ class Microsoft:
                     
             graph_endpoint = "https://graph.microsoft.com/v1.0/me/sendMail"
             
-            response = requests.post(graph_endpoint, headers=headers, data=json.dumps(data))
+            response = graph.post(graph_endpoint, headers=headers, data=json.dumps(data))
             
             if response.status_code == 202:
                 return True
@@ -626,7 +1160,8 @@ class Microsoft:
             original_to = original_message['to'].split(', ')
             original_cc = original_message['cc'].split(', ') if original_message['cc'] else None
             original_bcc = original_message['bcc'].split(', ') if original_message['bcc'] else None
-            original_body = original_message['body']
+            # The recipients cannot load the quoted images through the image proxy
+            original_body = InlineImages.embed(original_message['body'], self.oauth_id, lambda image: self.get_attachment(image['message_id'], image['attachment_id']))
             date = original_message['date']
             
             # Modify the subject to include "Re:"
@@ -705,7 +1240,7 @@ class Microsoft:
                     
             graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/reply"
             
-            response = requests.post(graph_endpoint, headers=headers, data=json.dumps(data))
+            response = graph.post(graph_endpoint, headers=headers, data=json.dumps(data))
             
             if response.status_code == 202:
                 return True
@@ -716,7 +1251,7 @@ class Microsoft:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return False
         
-    def list_messages(self, query='', next_page=None, max_results=5, folder_name=None):
+    def list_messages(self, query='', next_page=None, max_results=5, folder_name=None, view='full', projection=None):
         all_messages = []
         
         folder_info = self.get_folder(folder_name)
@@ -725,6 +1260,19 @@ class Microsoft:
             return None
         
         folder_id = folder_info.get('id', None)
+        
+        # Serve unfiltered summary listings from the local mailbox index
+        if view == 'summary' and not query and self.oauth_id is not None and (not next_page or next_page.startswith((LOCAL_PAGE_PREFIX, OLDER_PAGE_PREFIX))):
+            mailbox = OutlookSync(self, self.oauth_id)
+            mailbox.sync(folder_id)
+            
+            data = mailbox.list_messages(folder_info, max_results=max_results, next_page=next_page)
+            
+            if data is not None:
+                return data
+            
+            # Fall back to the provider from the first page
+            next_page = None
 
         graph_endpoint = "https://graph.microsoft.com/v1.0/me/messages" if not folder_name else f"https://graph.microsoft.com/v1.0/me/mailFolders/{folder_id}/messages"
 
@@ -743,10 +1291,13 @@ class Microsoft:
                 graph_endpoint += f"?$search={requests.utils.quote(query)}&$top={max_results}&$count=true"
             else:
                 graph_endpoint += f"?$top={max_results}&$count=true"
+            
+            # Only select the fields the view reads
+            graph_endpoint += f"&$select={(projection or (SUMMARY if view == 'summary' else MESSAGE)).graph()}"
 
         try:
             # Send the request to Microsoft Graph API
-            response = requests.get(graph_endpoint, headers=headers)
+            response = graph.get(graph_endpoint, headers=headers)
 
             if response.status_code == 200:
                 messages = response.json()
@@ -755,10 +1306,17 @@ class Microsoft:
                 
                 total_pages = (total_results // max_results) + (1 if total_results % max_results != 0 else 0)
 
-                # Process each message
+                # Get the attachments of every message on the page in one batch request
+                attachment_ids = [message['id'] for message in messages.get('value', []) if message.get('hasAttachments', False)]
+                attachments = self.get_attachments_batch(attachment_ids) if attachment_ids and view != 'summary' else {}
+
+                # Process each message from the page response
                 for message in messages.get('value', []):
                     message_id = message['id']
-                    message_content = self.get_message(message_id)
+                    if view == 'summary':
+                        message_content = self.parse_message_summary(message)
+                    else:
+                        message_content = self.parse_message(message, attachments.get(message_id, []))
                     all_messages.append(
                         {
                             'id': message_id,
@@ -783,52 +1341,131 @@ class Microsoft:
             print(f"An error occurred: {e}")
             return None
         
-    def get_message(self, message_id):
+    def create_subscription(self, notification_url, client_state, expires_at):
         try:
-            graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}"
+            graph_endpoint = "https://graph.microsoft.com/v1.0/subscriptions"
             
             headers = {
                 'Authorization': f'Bearer {self.access_token}',
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(graph_endpoint, headers=headers)
+            data = {
+                'changeType': 'created,updated,deleted',
+                'notificationUrl': notification_url,
+                'resource': 'me/messages',
+                'expirationDateTime': expires_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'clientState': client_state
+            }
+            
+            response = graph.post(graph_endpoint, headers=headers, data=json.dumps(data))
+            
+            if response.status_code == 201:
+                return response.json()
+            
+            logger.error(f"Failed to create subscription: {response.status_code} - {response.text}")
+            return None
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
+    def renew_subscription(self, subscription_id, expires_at):
+        try:
+            graph_endpoint = f"https://graph.microsoft.com/v1.0/subscriptions/{subscription_id}"
+            
+            headers = {
+                'Authorization': f'Bearer {self.access_token}',
+                'Content-Type': 'application/json'
+            }
+            
+            data = {
+                'expirationDateTime': expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')
+            }
+            
+            response = graph.patch(graph_endpoint, headers=headers, data=json.dumps(data))
+            
+            if response.status_code == 200:
+                return response.json()
+            
+            logger.error(f"Failed to renew subscription: {response.status_code} - {response.text}")
+            return None
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
+    def get_messages_delta(self, folder_id, delta_link=None, received_after=None):
+        if delta_link:
+            graph_endpoint = delta_link
+        else:
+            graph_endpoint = f"https://graph.microsoft.com/v1.0/me/mailFolders/{folder_id}/messages/delta?$select={self.SUMMARY_FIELDS}"
+            
+            # Limit the first sync to recently received messages
+            if received_after:
+                graph_endpoint += f"&$filter=receivedDateTime+ge+{received_after}"
+        
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json',
+            'Prefer': 'odata.maxpagesize=100'
+        }
+        
+        messages = []
+        
+        # Follow the next links until Graph hands out the delta link for the next sync
+        while True:
+            response = graph.get(graph_endpoint, headers=headers)
+            
+            if response.status_code != 200:
+                logger.error(f"Failed to get message delta: {response.status_code} - {response.text}")
+                return None, None, response.status_code
+            
+            page = response.json()
+            messages += page.get('value', [])
+            
+            if '@odata.nextLink' in page:
+                graph_endpoint = page['@odata.nextLink']
+            else:
+                return messages, page.get('@odata.deltaLink'), response.status_code
+            
+    def get_message(self, message_id, projection=MESSAGE):
+        try:
+            # The content never changes, only the read flag has to be checked
+            cached = MessageCache.get(self.oauth_id, message_id) if projection is MESSAGE else None
+            
+            if cached:
+                is_read = MessageCache.get_read(self.oauth_id, message_id)
+                
+                if is_read is None:
+                    is_read = self.get_read_state(message_id)
+                    
+                    if is_read is not None:
+                        MessageCache.set_read(self.oauth_id, message_id, is_read)
+                
+                if is_read is not None:
+                    cached['isRead'] = is_read
+                
+                return cached
+            
+            graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}?$select={projection.graph()}"
+            
+            headers = {
+                'Authorization': f'Bearer {self.access_token}',
+                'Content-Type': 'application/json'
+            }
+            
+            response = graph.get(graph_endpoint, headers=headers)
             
             # Check if the response status is successful
             if response.status_code == 200:
                 message = response.json()
                 
-                # Check if the message is in the Junk folder or has issues
-                if 'folderId' in message and message['folderId'] == 'junk':
-                    logger.warning(f"Message with ID {message_id} is in the Junk folder. Some fields may be different.")
-                
-                subject = message.get('subject', None)
-                from_email = message.get('from', {}).get('emailAddress', {}).get('address', None)
-                to_email = message.get('toRecipients', [{}])[0].get('emailAddress', {}).get('address', None) if message.get('toRecipients') else None
-                date = message.get('receivedDateTime', None)
-                cc = ', '.join([i.get('emailAddress', {}).get('address', None) for i in message.get('ccRecipients', [])])
-                bcc = ', '.join([i.get('emailAddress', {}).get('address', None) for i in message.get('bccRecipients', [])])
-                has_attachments = message.get('hasAttachments', False)
-                attachments = []
-                body = message.get('body', {}).get('content', None)
+                attachments = self.get_attachments(message_id) if message.get('hasAttachments', False) else []
                 
-                is_read = message.get('isRead', False) 
+                msg = self.parse_message(message, attachments)
                 
-                if has_attachments:
-                    attachments = self.get_attachments(message_id)
-                    
-                msg = {
-                    'subject': subject,
-                    'from': from_email,
-                    'to': to_email,
-                    'date': date,
-                    'cc': cc,
-                    'bcc': bcc,
-                    'body': body,
-                    'text': Email.extract_text_from_html(body),
-                    'attachments': attachments,
-                    'isRead': is_read
-                }
+                # Only complete messages are cached
+                if 'message' not in msg and projection is MESSAGE:
+                    MessageCache.set(self.oauth_id, message_id, msg)
                 
                 return msg
             else:
@@ -839,6 +1476,213 @@ class Microsoft:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return {'message': 'Failed to get message'}
 
+    # Define the get_read_state method
+    def get_read_state(self, message_id):
+        try:
+            graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}?$select=isRead"
+            
+            headers = {
+                'Authorization': f'Bearer {self.access_token}'
+            }
+            
+            response = graph.get(graph_endpoint, headers=headers)
+            
+            if response.status_code == 200:
+                return response.json().get('isRead', False)
+            
+            return None
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
+    def parse_message_summary(self, message):
+        try:
+            msg = {
+                'subject': message.get('subject', None),
+                'from': message.get('from', {}).get('emailAddress', {}).get('address', None),
+                'to': message.get('toRecipients', [{}])[0].get('emailAddress', {}).get('address', None) if message.get('toRecipients') else None,
+                'cc': ', '.join([i.get('emailAddress', {}).get('address', None) for i in message.get('ccRecipients', [])]),
+                'date': message.get('receivedDateTime', None),
+                'snippet': message.get('bodyPreview', ''),
+                'hasAttachments': message.get('hasAttachments', False),
+                'isRead': message.get('isRead', False)
+            }
+            
+            return msg
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return {'message': 'Failed to get message'}
+    
+    def parse_message(self, message, attachments=None):
+        try:
+            # Check if the message is in the Junk folder or has issues
+            if 'folderId' in message and message['folderId'] == 'junk':
+                logger.warning(f"Message with ID {message.get('id')} is in the Junk folder. Some fields may be different.")
+            
+            subject = message.get('subject', None)
+            from_email = message.get('from', {}).get('emailAddress', {}).get('address', None)
+            to_email = message.get('toRecipients', [{}])[0].get('emailAddress', {}).get('address', None) if message.get('toRecipients') else None
+            date = message.get('receivedDateTime', None)
+            cc = ', '.join([i.get('emailAddress', {}).get('address', None) for i in message.get('ccRecipients', [])])
+            bcc = ', '.join([i.get('emailAddress', {}).get('address', None) for i in message.get('bccRecipients', [])])
+            body = message.get('body', {}).get('content', None)
+            
+            is_read = message.get('isRead', False) 
+            
+            # Point the inline images at the image proxy and list the other attachments
+            inline_images = []
+            visible_attachments = []
+            for attachment in attachments or []:
+                content_id = (attachment.get('content_id') or '').replace('<', '').replace('>', '')
+                
+                if content_id and body and f'cid:{content_id}' in body:
+                    inline_images.append((content_id, attachment['attachment_id'], attachment.get('mime_type')))
+                else:
+                    visible_attachments.append(attachment)
+            
+            if inline_images and self.oauth_id is not None:
+                body = InlineImages.rewrite(body, 'microsoft', self.oauth_id, message['id'], inline_images)
+            else:
+                visible_attachments = attachments or []
+                
+            msg = {
+                'subject': subject,
+                'from': from_email,
+                'to': to_email,
+                'date': date,
+                'cc': cc,
+                'bcc': bcc,
+                'body': body,
+                'text': Email.extract_text_from_html(body),
+                'attachments': visible_attachments,
+                'isRead': is_read
+            }
+            
+            return msg
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return {'message': 'Failed to get message'}
+    
+    def batch_request(self, batch_requests):
+        # Microsoft Graph accepts at most 20 requests per batch
+        batch_size = 20
+        responses = {}
+        
+        graph_endpoint = "https://graph.microsoft.com/v1.0/$batch"
+        
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
+        }
+        
+        # Send one batch request per chunk of requests
+        def execute_batch(chunk):
+            response = graph.post(graph_endpoint, headers=headers, data=json.dumps({'requests': chunk}))
+            
+            if response.status_code != 200:
+                logger.error(f"Failed to send batch request: {response.status_code} - {response.text}")
+                return []
+            
+            return response.json().get('responses', [])
+        
+        # Run the chunks concurrently, a failed chunk only loses its own requests
+        chunks = [batch_requests[start:start + batch_size] for start in range(0, len(batch_requests), batch_size)]
+        
+        for sub_responses in fan_out(execute_batch, chunks, account=self.oauth_id, default=[]):
+            # Collect every sub-response keyed by its request ID
+            for sub_response in sub_responses:
+                responses[sub_response.get('id')] = sub_response
+        
+        return responses
+    
+    def get_messages_batch(self, message_ids):
+        batch_requests = [
+            {
+                'id': message_id,
+                'method': 'GET',
+                'url': f'/me/messages/{message_id}?$select={MESSAGE.graph()}'
+            } for message_id in message_ids
+        ]
+        
+        responses = self.batch_request(batch_requests)
+        
+        # Get the attachments of the messages that have any in one more batch request
+        attachment_ids = [
+            message_id for message_id in message_ids
+            if responses.get(message_id, {}).get('status') == 200 and responses[message_id].get('body', {}).get('hasAttachments', False)
+        ]
+        attachments = self.get_attachments_batch(attachment_ids) if attachment_ids else {}
+        
+        messages = {}
+        for message_id in message_ids:
+            response = responses.get(message_id, {})
+            if response.get('status') == 200:
+                messages[message_id] = self.parse_message(response.get('body', {}), attachments.get(message_id, []))
+            else:
+                messages[message_id] = {'message': 'Failed to get message'}
+        
+        return messages
+    
+    def get_attachments_batch(self, message_ids):
+        batch_requests = [
+            {
+                'id': message_id,
+                'method': 'GET',
+                'url': f'/me/messages/{message_id}/attachments?$select=id,name,size,contentType,contentId'
+            } for message_id in message_ids
+        ]
+        
+        responses = self.batch_request(batch_requests)
+        
+        all_attachments = {}
+        for message_id in message_ids:
+            response = responses.get(message_id, {})
+            if response.get('status') == 200:
+                all_attachments[message_id] = [
+                    {
+                        'id': attachment['id'],
+                        'attachment_id': attachment['id'],
+                        'filename': attachment['name'],
+                        'mime_type': attachment.get('contentType'),
+                        'content_id': attachment.get('contentId'),
+                        'has_content_id': bool(attachment.get('contentId')),
+                        'size': round(attachment.get('size', 0) / 1024, 2)
+                    } for attachment in response.get('body', {}).get('value', [])
+                ]
+            else:
+                all_attachments[message_id] = []
+        
+        return all_attachments
+    
+    def batch_message_action(self, message_ids, action):
+        # Map each action to its Graph request and expected status code
+        actions = {
+            'read': ('PATCH', {'isRead': True}, 200),
+            'unread': ('PATCH', {'isRead': False}, 200),
+            'delete': ('DELETE', None, 204)
+        }
+        
+        if action not in actions:
+            return {message_id: False for message_id in message_ids}
+        
+        method, body, status_code = actions[action]
+        
+        batch_requests = []
+        for message_id in message_ids:
+            batch_request = {
+                'id': message_id,
+                'method': method,
+                'url': f'/me/messages/{message_id}'
+            }
+            if body is not None:
+                batch_request['body'] = body
+                batch_request['headers'] = {'Content-Type': 'application/json'}
+            batch_requests.append(batch_request)
+        
+        responses = self.batch_request(batch_requests)
+        
+        return {message_id: responses.get(message_id, {}).get('status') == status_code for message_id in message_ids}
+
     def read_message(self, message_id):
         try:
             graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}"
@@ -852,7 +1696,7 @@ class Microsoft:
                 'isRead': True
             }
             
-            response = requests.patch(graph_endpoint, headers=headers, data=json.dumps(data))
+            response = graph.patch(graph_endpoint, headers=headers, data=json.dumps(data))
             
             if response.status_code == 200:
                 return True
@@ -875,7 +1719,7 @@ class Microsoft:
                 'isRead': False
             }
             
-            response = requests.patch(graph_endpoint, headers=headers, data=json.dumps(data))
+            response = graph.patch(graph_endpoint, headers=headers, data=json.dumps(data))
             
             if response.status_code == 200:
                 return True
@@ -894,7 +1738,7 @@ class Microsoft:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.delete(graph_endpoint, headers=headers)
+            response = graph.delete(graph_endpoint, headers=headers)
             
             if response.status_code == 204:
                 return True
@@ -906,14 +1750,15 @@ class Microsoft:
             
     def get_attachments(self, message_id):
         try:
-            graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments"
+            # Only list the metadata, the contents are downloaded on demand
+            graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments?$select=id,name,size,contentType,contentId"
             
             headers = {
                 'Authorization': f'Bearer {self.access_token}',
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(graph_endpoint, headers=headers)
+            response = graph.get(graph_endpoint, headers=headers)
             
             if response.status_code == 200:
                 all_attachments = []
@@ -926,7 +1771,12 @@ class Microsoft:
                     all_attachments.append(
                         {
                             'id': attachment_id,
+                            'attachment_id': attachment_id,
                             'filename': attachment_name,
+                            'mime_type': attachment.get('contentType'),
+                            'content_id': attachment.get('contentId'),
+                            'has_content_id': bool(attachment.get('contentId')),
+                            'size': round(attachment.get('size', 0) / 1024, 2)
                         }
                     )
                     
@@ -938,6 +1788,46 @@ class Microsoft:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return []
     
+    # Define the open_attachment method
+    def open_attachment(self, message_id, attachment_id, chunk_size):
+        try:
+            graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments/{attachment_id}"
+            
+            headers = {
+                'Authorization': f'Bearer {self.access_token}'
+            }
+            
+            metadata = graph.get(f"{graph_endpoint}?$select=name,contentType", headers=headers)
+            
+            if metadata.status_code != 200:
+                logger.error(f"Failed to get attachment: {metadata.status_code} - {metadata.text}")
+                return None
+            
+            metadata = metadata.json()
+            
+            # Stream the raw bytes instead of reading the whole attachment
+            response = graph.open('GET', f"{graph_endpoint}/$value", headers=headers)
+            
+            if response.status_code != 200:
+                logger.error(f"Failed to get attachment: {response.status_code}")
+                response.close()
+                return None
+            
+            # The length is only known when the body is not re-encoded on the way
+            size = response.headers.get('Content-Length')
+            if response.headers.get('Content-Encoding', 'identity') != 'identity':
+                size = None
+            
+            return {
+                'filename': metadata.get('name') or 'attachment',
+                'mime_type': metadata.get('contentType') or response.headers.get('Content-Type') or 'application/octet-stream',
+                'size': int(size) if size else None,
+                'chunks': graph.iter_content(response, chunk_size)
+            }
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return None
+    
     def get_attachment(self, message_id, attachment_id):
         try:
             graph_endpoint = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments/{attachment_id}/$value"
@@ -947,7 +1837,7 @@ class Microsoft:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(graph_endpoint, headers=headers)
+            response = graph.get(graph_endpoint, headers=headers)
             
             if response.status_code == 200:
                 return response.content
@@ -957,7 +1847,12 @@ class Microsoft:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
             return None
     
-    def list_folders(self):
+    def list_folders(self, refresh=False):
+        # Serve the folders from the registry while they are cached
+        cached_folders = None if refresh else FolderRegistry.get(self.oauth_id)
+        if cached_folders is not None:
+            return cached_folders
+        
         try:
             folder_endpoint = 'https://graph.microsoft.com/v1.0/me/mailFolders'
             
@@ -966,7 +1861,7 @@ class Microsoft:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(folder_endpoint, headers=headers)
+            response = graph.get(folder_endpoint, headers=headers)
             
             folder_counts = []
             
@@ -982,6 +1877,8 @@ class Microsoft:
                         'isHidden': folder.get('isHidden', False)
                     }
                     folder_counts.append(folder_info)
+                
+                FolderRegistry.set(self.oauth_id, folder_counts)
                     
                 return folder_counts
             else:
@@ -1001,4 +1898,17 @@ class Microsoft:
             return None
         except Exception as e:
             logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
-            return None
\ No newline at end of file
+            return None
+
+
+# Define the get_mail_client function
+def get_mail_client(oauth):
+    # Decrypt the OAuth data
+    oauth_data = json.loads(str(fernet.decrypt(oauth.data.encode()).decode()).replace("'", '"'))
+
+    if oauth.service == 'google':
+        return Google(oauth_data, oauth_id=oauth.id)
+    elif oauth.service == 'microsoft':
+        return Microsoft(oauth_data, oauth_id=oauth.id)
+
+    return None
@@ -0,0 +1,137 @@
+from init import create_logger, env, redis
+
+from .concurrency import spawn
+from .message_cache import MessageCache, PageCache
+from .oauth import get_mail_client
+from .sync import LOCAL_PAGE_PREFIX
+
+from models.oauth import Oauth
+
+logger = create_logger(__name__)
+
+
+# Define the Prefetcher class
+class Prefetcher:
+    # Prefetching can be turned off for every user
+    ENABLED = env.get('PREFETCH_ENABLED', 'True').lower() in ('true', '1')
+    # Provider calls one user may spend on prefetching per minute
+    BUDGET = 20
+    # Unread message bodies warmed from each listed page
+    MESSAGES = 3
+    # Seconds without a request after which a user counts as idle
+    IDLE_SECONDS = 60
+
+    # Define the active_key method
+    @staticmethod
+    def active_key(user_id):
+        return f'prefetch_active_{user_id}'
+
+    # Define the generation_key method
+    @staticmethod
+    def generation_key(user_id):
+        return f'prefetch_generation_{user_id}'
+
+    # Define the budget_key method
+    @staticmethod
+    def budget_key(user_id):
+        return f'prefetch_budget_{user_id}'
+
+    # Define the mark_active method
+    @staticmethod
+    def mark_active(user_id):
+        try:
+            redis.setex(Prefetcher.active_key(user_id), Prefetcher.IDLE_SECONDS, 1)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the is_current method
+    @staticmethod
+    def is_current(user_id, generation):
+        # Stop once the user went idle or listed another page
+        try:
+            if not redis.exists(Prefetcher.active_key(user_id)):
+                return False
+
+            return int(redis.get(Prefetcher.generation_key(user_id)) or 0) == generation
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return False
+
+    # Define the take_budget method
+    @staticmethod
+    def take_budget(user_id):
+        try:
+            key = Prefetcher.budget_key(user_id)
+            spent = redis.incr(key)
+
+            if spent == 1:
+                redis.expire(key, 60)
+
+            return spent <= Prefetcher.BUDGET
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return False
+
+    # Define the schedule method
+    @staticmethod
+    def schedule(user_id, oauth, params, page):
+        """Warm the next page and the top unread messages of a listed page in the background."""
+        if not Prefetcher.ENABLED or not page or 'messages' not in page:
+            return
+
+        try:
+            Prefetcher.mark_active(user_id)
+
+            # A new page supersedes the prefetch of the previous one
+            generation = redis.incr(Prefetcher.generation_key(user_id))
+            redis.expire(Prefetcher.generation_key(user_id), 24 * 3600)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return
+
+        spawn(Prefetcher.run, user_id, oauth.id, params, page, generation)
+
+    # Define the run method
+    @staticmethod
+    def run(user_id, oauth_id, params, page, generation):
+        oauth = Oauth.query.filter_by(id=oauth_id, user_id=user_id).first()
+
+        if not oauth:
+            return
+
+        client = None
+
+        # Warm the next page, the local index already serves its own pages quickly
+        next_page = page.get('next_page')
+
+        if next_page and not next_page.startswith(LOCAL_PAGE_PREFIX):
+            next_params = dict(params, next_page=next_page)
+
+            if PageCache.get(oauth_id, next_params) is None:
+                if not Prefetcher.is_current(user_id, generation) or not Prefetcher.take_budget(user_id):
+                    return
+
+                client = get_mail_client(oauth)
+                next_data = client.list_messages(**next_params)
+
+                if next_data and 'messages' in next_data:
+                    PageCache.set(oauth_id, next_params, next_data)
+
+        # Full pages already carry the bodies
+        if params.get('view') != 'summary':
+            return
+
+        # Warm the bodies of the unread messages the user is most likely to open
+        unread = [message['id'] for message in page['messages'] if not (message.get('message') or {}).get('isRead', True)]
+
+        for message_id in unread[:Prefetcher.MESSAGES]:
+            if MessageCache.exists(oauth_id, message_id):
+                continue
+
+            if not Prefetcher.is_current(user_id, generation) or not Prefetcher.take_budget(user_id):
+                return
+
+            client = client or get_mail_client(oauth)
+
+            # get_message stores the parsed message in the message cache
+            client.get_message(message_id)
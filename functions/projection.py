@@ -0,0 +1,81 @@
+# Graph message properties that hold each field of a parsed message
+GRAPH_FIELDS = {
+    'id': 'id',
+    'subject': 'subject',
+    'from': 'from',
+    'to': 'toRecipients',
+    'cc': 'ccRecipients',
+    'bcc': 'bccRecipients',
+    'date': 'receivedDateTime',
+    'snippet': 'bodyPreview',
+    'body': 'body',
+    'hasAttachments': 'hasAttachments',
+    'attachments': 'hasAttachments',
+    'isRead': 'isRead',
+    'receivedAt': 'receivedDateTime',
+}
+
+# Gmail message fields that hold each field of a parsed message, as partial response paths
+GMAIL_FIELDS = {
+    'id': 'id',
+    'threadId': 'threadId',
+    'subject': 'payload/headers',
+    'from': 'payload/headers',
+    'to': 'payload/headers',
+    'cc': 'payload/headers',
+    'bcc': 'payload/headers',
+    'date': 'payload/headers',
+    'snippet': 'snippet',
+    'body': 'payload/parts',
+    'hasAttachments': 'payload/mimeType',
+    'attachments': 'payload/parts',
+    'isRead': 'labelIds',
+    'labels': 'labelIds',
+    'receivedAt': 'internalDate',
+}
+
+
+# Define the Projection class
+class Projection:
+    """The fields of a message an endpoint reads, turned into Graph $select and Gmail fields parameters."""
+
+    def __init__(self, *fields):
+        self.fields = fields
+
+    # Define the graph method
+    def graph(self):
+        selected = []
+
+        for field in self.fields:
+            graph_field = GRAPH_FIELDS.get(field)
+
+            if graph_field and graph_field not in selected:
+                selected.append(graph_field)
+
+        return ','.join(selected)
+
+    # Define the gmail method
+    def gmail(self):
+        # Group the nested paths under their parent, e.g. payload(headers,parts)
+        groups = {}
+
+        for field in self.fields:
+            path = GMAIL_FIELDS.get(field)
+
+            if not path:
+                continue
+
+            parent, _, child = path.partition('/')
+            children = groups.setdefault(parent, [])
+
+            if child and child not in children:
+                children.append(child)
+
+        return ','.join(f"{parent}({','.join(children)})" if children else parent for parent, children in groups.items())
+
+
+# Fields of a message in an inbox listing
+SUMMARY = Projection('id', 'threadId', 'subject', 'from', 'to', 'cc', 'date', 'snippet', 'hasAttachments', 'isRead', 'receivedAt')
+
+# Fields of an opened message, also used for replies and the message cache
+MESSAGE = Projection('id', 'threadId', 'subject', 'from', 'to', 'cc', 'bcc', 'date', 'body', 'attachments', 'isRead')
@@ -0,0 +1,503 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from init import create_logger, env, redis
+
+from .ai import WorkersAIError
+from .concurrency import hedge
+
+logger = create_logger(__name__)
+
+
+# Define the AIProviderError class
+class AIProviderError(Exception):
+    def __init__(self, message, rate_limited=False, failover=True):
+        super().__init__(message)
+        self.message = message
+        self.rate_limited = rate_limited
+        self.failover = failover
+
+
+# Define the ProviderFailure class
+class ProviderFailure:
+    """A failed provider call, classified for the retry and failover logic."""
+
+    def __init__(self, error, retryable, rate_limited=False, retry_after=None, failover=True):
+        self.error = error
+        self.retryable = retryable
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.failover = failover
+
+
+# Define the parse_retry_after function
+def parse_retry_after(value):
+    """Return the seconds of a Retry-After header, given as seconds or as an HTTP date."""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+
+# Define the classify_status function
+def classify_status(error, status_code, retry_after):
+    # Rate limits and server errors go away on their own, retry them
+    if status_code == 429:
+        return ProviderFailure(error, retryable=True, rate_limited=True, retry_after=parse_retry_after(retry_after))
+
+    if status_code is None or status_code >= 500:
+        return ProviderFailure(error, retryable=True, retry_after=parse_retry_after(retry_after))
+
+    # A provider that refuses the credentials will not recover on retry, but the other one may answer
+    if status_code in (401, 403):
+        return ProviderFailure(error, retryable=False)
+
+    # The request itself is wrong, the other provider would refuse it as well
+    return ProviderFailure(error, retryable=False, failover=False)
+
+
+# Define the CircuitBreaker class
+class CircuitBreaker:
+    """Per-provider breaker shared by every worker through Redis."""
+
+    # Failures within the window that open the breaker
+    FAILURES = 5
+    # Seconds failures are counted over
+    WINDOW = 60
+    # Seconds an open breaker skips the provider
+    COOLDOWN = 30
+    # Longest Retry-After an open breaker honours
+    MAX_COOLDOWN = 300
+
+    def __init__(self, name):
+        self.name = name
+
+    # Define the failures_key method
+    def failures_key(self):
+        return f'ai_breaker_failures_{self.name}'
+
+    # Define the open_key method
+    def open_key(self):
+        return f'ai_breaker_open_{self.name}'
+
+    # Define the is_open method
+    def is_open(self):
+        try:
+            return bool(redis.exists(self.open_key()))
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return False
+
+    # Define the record_success method
+    def record_success(self):
+        try:
+            redis.delete(self.failures_key())
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the record_failure method
+    def record_failure(self, retry_after=None):
+        try:
+            # The provider told us when to come back
+            if retry_after:
+                self.open(retry_after)
+                return
+
+            failures = redis.incr(self.failures_key())
+
+            if failures == 1:
+                redis.expire(self.failures_key(), self.WINDOW)
+
+            # Once open, the count stays high so the first failure after the cooldown opens it again
+            if failures >= self.FAILURES:
+                self.open(self.COOLDOWN)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the open method
+    def open(self, seconds):
+        seconds = int(min(max(seconds, 1), self.MAX_COOLDOWN))
+
+        redis.setex(self.open_key(), seconds, 1)
+        logger.warning(f'AI provider {self.name} is degraded, skipping it for {seconds}s')
+
+
+# Define the OpenAIProvider class
+class OpenAIProvider:
+    name = 'openai'
+
+    def __init__(self, client, model, temperature):
+        self.client = client
+        self.model = model
+        self.temperature = temperature
+
+    # Define the classify method
+    def classify(self, error):
+        if isinstance(error, (APIConnectionError, APITimeoutError)):
+            return ProviderFailure(error, retryable=True)
+
+        if isinstance(error, APIStatusError):
+            return classify_status(error, error.status_code, error.response.headers.get('retry-after'))
+
+        return ProviderFailure(error, retryable=False)
+
+    # Define the complete method
+    def complete(self, messages):
+        response = self.client.chat.completions.create(model=self.model, messages=messages, temperature=self.temperature)
+        return response.choices[0].message.content
+
+    # Define the stream method
+    def stream(self, messages):
+        stream = self.client.chat.completions.create(model=self.model, messages=messages, temperature=self.temperature, stream=True)
+
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+# Define the WorkersAIProvider class
+class WorkersAIProvider:
+    name = 'workersai'
+
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def model(self):
+        return self.client.model
+
+    # Define the classify method
+    def classify(self, error):
+        if isinstance(error, WorkersAIError):
+            return classify_status(error, error.status_code, error.retry_after)
+
+        # Connection errors and timeouts of the pooled client
+        return ProviderFailure(error, retryable=True)
+
+    # Define the complete method
+    def complete(self, messages):
+        return self.client.complete(messages)
+
+    # Define the stream method
+    def stream(self, messages):
+        yield from self.client.stream(messages)
+
+
+# Define the AIProviders class
+class AIProviders:
+    """Call the preferred AI provider with jittered retries and fail over to the others when it is degraded."""
+
+    # Calls made to one provider before failing over
+    ATTEMPTS = 3
+    # Base and cap of the exponential backoff in seconds
+    BACKOFF = 0.5
+    MAX_BACKOFF = 4
+    # Longest Retry-After waited for in the request, longer ones fail over at once
+    MAX_RETRY_AFTER = 5
+
+    # Send a duplicate request to the next provider when the first one stalls on the interactive routes
+    HEDGING = env.get('AI_HEDGING_ENABLED', 'False').lower() in ('true', '1')
+    # Share of a route's requests per minute that may be hedged
+    HEDGE_BUDGETS = {
+        'paraphrase': 0.1,
+        'smart_reply': 0.05,
+    }
+    # Bounds of the hedge delay, which follows the measured p95 of the primary provider
+    MIN_HEDGE_DELAY = 0.3
+    MAX_HEDGE_DELAY = 5
+    DEFAULT_HEDGE_DELAY = 2
+    # Latency samples kept per route and provider, and the fewest the p95 is trusted from
+    LATENCY_SAMPLES = 200
+    MIN_LATENCY_SAMPLES = 20
+    # Seconds a worker reuses a computed p95
+    DELAY_TTL = 30
+
+    def __init__(self, *providers):
+        self.providers = {provider.name: provider for provider in providers}
+        self.breakers = {provider.name: CircuitBreaker(provider.name) for provider in providers}
+        self.delays = {}
+
+    # Define the order method
+    def order(self, preferred):
+        # The preferred provider first, then the rest in the configured order
+        names = sorted(self.providers, key=lambda name: name != preferred)
+
+        available = [name for name in names if not self.breakers[name].is_open()]
+
+        if not available:
+            raise AIProviderError('Every AI provider is degraded', rate_limited=True)
+
+        return available
+
+    # Define the backoff method
+    def backoff(self, attempt, failure):
+        if failure.retry_after is not None:
+            return failure.retry_after
+
+        # Full jitter keeps the workers from retrying in lockstep
+        return random.uniform(0, min(self.MAX_BACKOFF, self.BACKOFF * 2 ** attempt))
+
+    # Define the should_retry method
+    def should_retry(self, name, attempt, failure, last):
+        """Sleep and return True to retry the provider, or return False to fail over to the next one."""
+        if not failure.failover:
+            raise AIProviderError(str(failure.error), failover=False)
+
+        # Waiting out a long Retry-After would hold the request, let another provider answer
+        long_wait = failure.retry_after is not None and failure.retry_after > self.MAX_RETRY_AFTER
+
+        # A rate limited provider is only retried when no other provider is left to answer
+        move_on = failure.rate_limited and not last
+
+        if not failure.retryable or long_wait or move_on or attempt == self.ATTEMPTS - 1:
+            self.breakers[name].record_failure(failure.retry_after if long_wait else None)
+            return False
+
+        time.sleep(self.backoff(attempt, failure))
+        return True
+
+    # Define the call method
+    def call(self, messages, name, last=True):
+        """Complete on one provider with retries, returning (result, None) or (None, failure) once it gives up."""
+        provider = self.providers[name]
+
+        for attempt in range(self.ATTEMPTS):
+            try:
+                result = provider.complete(messages)
+                self.breakers[name].record_success()
+                return result, None
+            except Exception as e:
+                logger.warning(f'AI provider {name} failed (attempt {attempt + 1}): {e}')
+                failure = provider.classify(e)
+
+                if not self.should_retry(name, attempt, failure, last=last):
+                    return None, failure
+
+    # Define the complete method
+    def complete(self, messages, preferred='openai'):
+        """Return the generated text of the first provider that answers."""
+        rate_limited = False
+
+        names = self.order(preferred)
+
+        for name in names:
+            result, failure = self.call(messages, name, last=name == names[-1])
+
+            if failure is None:
+                return result
+
+            rate_limited = rate_limited or failure.rate_limited
+
+        raise AIProviderError('Every AI provider failed', rate_limited=rate_limited)
+
+    # Define the stream method
+    def stream(self, messages, preferred='openai'):
+        """Yield the generated text, failing over only until the first token is sent."""
+        rate_limited = False
+
+        names = self.order(preferred)
+
+        for name in names:
+            provider = self.providers[name]
+
+            for attempt in range(self.ATTEMPTS):
+                started = False
+
+                try:
+                    for token in provider.stream(messages):
+                        started = True
+                        yield token
+
+                    self.breakers[name].record_success()
+                    return
+                except Exception as e:
+                    # Part of the draft reached the browser, it cannot switch providers anymore
+                    if started:
+                        self.breakers[name].record_failure()
+                        raise AIProviderError(str(e))
+
+                    logger.warning(f'AI provider {name} failed to stream (attempt {attempt + 1}): {e}')
+                    failure = provider.classify(e)
+                    rate_limited = rate_limited or failure.rate_limited
+
+                    if not self.should_retry(name, attempt, failure, last=name == names[-1]):
+                        break
+
+        raise AIProviderError('Every AI provider failed', rate_limited=rate_limited)
+
+    # Define the latency_key method
+    @staticmethod
+    def latency_key(route, name):
+        return f'ai_latency_{route}_{name}'
+
+    # Define the metrics_key method
+    @staticmethod
+    def metrics_key(route):
+        return f'ai_hedge_metrics_{route}'
+
+    # Define the budget_key method
+    @staticmethod
+    def budget_key(route):
+        return f'ai_hedge_budget_{route}'
+
+    # Define the record_latency method
+    def record_latency(self, route, name, seconds):
+        try:
+            key = self.latency_key(route, name)
+
+            redis.lpush(key, round(seconds, 3))
+            redis.ltrim(key, 0, self.LATENCY_SAMPLES - 1)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the hedge_delay method
+    def hedge_delay(self, route, name):
+        """Return the p95 latency of the provider on the route, within the hedge delay bounds."""
+        cached = self.delays.get((route, name))
+
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        delay = self.DEFAULT_HEDGE_DELAY
+
+        try:
+            samples = sorted(float(sample) for sample in redis.lrange(self.latency_key(route, name), 0, -1))
+
+            if len(samples) >= self.MIN_LATENCY_SAMPLES:
+                delay = samples[int(len(samples) * 0.95) - 1]
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+        delay = min(max(delay, self.MIN_HEDGE_DELAY), self.MAX_HEDGE_DELAY)
+        self.delays[(route, name)] = (delay, time.monotonic() + self.DELAY_TTL)
+
+        return delay
+
+    # Define the take_hedge_budget method
+    def take_hedge_budget(self, route):
+        try:
+            key = self.budget_key(route)
+            requests = int(redis.hget(key, 'requests') or 0)
+            hedges = redis.hincrby(key, 'hedges', 1)
+
+            # At least one hedge a minute, so a quiet route can still escape a stall
+            if hedges > max(1, requests * self.HEDGE_BUDGETS.get(route, 0)):
+                redis.hincrby(key, 'hedges', -1)
+                return False
+
+            return True
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return False
+
+    # Define the count method
+    def count(self, route, *fields):
+        try:
+            for field in fields:
+                redis.hincrby(self.metrics_key(route), field, 1)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the hedged method
+    def hedged(self, messages, route, preferred='openai'):
+        """Complete on the preferred provider, and hedge on the next one once it runs past its p95."""
+        names = self.order(preferred)
+
+        if not self.HEDGING or route not in self.HEDGE_BUDGETS or len(names) < 2:
+            return self.complete(messages, preferred)
+
+        primary, backup = names[0], names[1]
+        hedges = []
+
+        # Every request counts towards the budget of the current minute
+        try:
+            key = self.budget_key(route)
+            if redis.hincrby(key, 'requests', 1) == 1:
+                redis.expire(key, 60)
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+        def allow():
+            if self.breakers[backup].is_open() or not self.take_hedge_budget(route):
+                return False
+
+            hedges.append(backup)
+            return True
+
+        # Each leg calls its own provider only, failing over inside a leg could land on the other leg's provider
+        def leg(name, last=False):
+            started = time.monotonic()
+            result, failure = self.call(messages, name, last=last)
+
+            if failure is not None:
+                raise AIProviderError(f'AI provider {name} failed', rate_limited=failure.rate_limited)
+
+            # Only answers are timed, a leg stopped by the other one never gets here
+            self.record_latency(route, name, time.monotonic() - started)
+
+            return result
+
+        try:
+            try:
+                index, result = hedge(
+                    lambda: leg(primary),
+                    lambda: leg(backup),
+                    self.hedge_delay(route, primary),
+                    allow=allow,
+                )
+            except AIProviderError as e:
+                if hedges or not e.failover:
+                    raise
+
+                # The primary gave up before a hedge was sent, fail over like complete does
+                index, result = 1, leg(backup, last=True)
+        except Exception:
+            self.count(route, 'requests', 'failures')
+            raise
+
+        if not hedges:
+            self.count(route, 'requests')
+        elif index == 0:
+            self.count(route, 'requests', 'hedged', 'primary_wins')
+        else:
+            self.count(route, 'requests', 'hedged', 'hedge_wins')
+
+        return result
+
+    # Define the hedge_metrics method
+    def hedge_metrics(self):
+        metrics = {}
+
+        for route in self.HEDGE_BUDGETS:
+            try:
+                counts = {field.decode(): int(value) for field, value in redis.hgetall(self.metrics_key(route)).items()}
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+                counts = {}
+
+            requests = counts.get('requests', 0)
+            hedged = counts.get('hedged', 0)
+
+            metrics[route] = {
+                'requests': requests,
+                'hedged': hedged,
+                'primary_wins': counts.get('primary_wins', 0),
+                'hedge_wins': counts.get('hedge_wins', 0),
+                'failures': counts.get('failures', 0),
+                'hedge_rate': round(hedged / requests, 4) if requests else 0,
+                'hedge_win_rate': round(counts.get('hedge_wins', 0) / hedged, 4) if hedged else 0,
+                'hedge_delays': {name: self.hedge_delay(route, name) for name in self.providers},
+            }
+
+        return metrics
@@ -0,0 +1,154 @@
+import base64
+import hmac
+import json
+import secrets
+from datetime import datetime, timedelta
+
+from init import create_logger, db, env
+
+from functions.oauth import get_mail_client
+from functions.sync import invalidate_mailbox
+
+from models.oauth import Oauth
+from models.mailbox import MailboxSubscription
+
+logger = create_logger(__name__)
+
+
+# Define the PushNotifications class
+class PushNotifications:
+    # Push configuration
+    GOOGLE_TOPIC = env.get('GOOGLE_PUBSUB_TOPIC')
+    WEBHOOK_URL = env.get('WEBHOOK_URL')
+    WEBHOOK_SECRET = env.get('WEBHOOK_SECRET')
+    # Renew subscriptions that expire within this window
+    RENEW_WINDOW = timedelta(hours=24)
+    # Graph limits mail subscriptions to a little under three days
+    MICROSOFT_LIFETIME = timedelta(minutes=4200)
+
+    # Define the subscribe method
+    @staticmethod
+    def subscribe(oauth):
+        try:
+            subscription = MailboxSubscription.query.filter_by(oauth_id=oauth.id, service=oauth.service).first()
+
+            # Keep subscriptions that are not close to expiring
+            if subscription and subscription.expires_at and subscription.expires_at - datetime.utcnow() > PushNotifications.RENEW_WINDOW:
+                return True
+
+            client = get_mail_client(oauth)
+
+            if oauth.service == 'google':
+                if not PushNotifications.GOOGLE_TOPIC:
+                    return False
+
+                # Gmail renews a watch by calling watch again
+                response = client.watch(PushNotifications.GOOGLE_TOPIC)
+
+                if not response:
+                    return False
+
+                expires_at = datetime.utcfromtimestamp(int(response['expiration']) / 1000)
+                subscription_id = None
+                client_state = None
+            elif oauth.service == 'microsoft':
+                if not PushNotifications.WEBHOOK_URL:
+                    return False
+
+                expires_at = datetime.utcnow() + PushNotifications.MICROSOFT_LIFETIME
+
+                response = None
+                if subscription and subscription.subscription_id:
+                    response = client.renew_subscription(subscription.subscription_id, expires_at)
+
+                # Create a new subscription if there was none or it could not be renewed
+                if response:
+                    subscription_id = subscription.subscription_id
+                    client_state = subscription.client_state
+                else:
+                    client_state = secrets.token_urlsafe(32)
+                    response = client.create_subscription(f"{PushNotifications.WEBHOOK_URL}/api/webhook/microsoft", client_state, expires_at)
+
+                    if not response:
+                        return False
+
+                    subscription_id = response['id']
+            else:
+                return False
+
+            if not subscription:
+                subscription = MailboxSubscription(oauth_id=oauth.id, service=oauth.service)
+                db.session.add(subscription)
+
+            subscription.subscription_id = subscription_id
+            subscription.client_state = client_state
+            subscription.expires_at = expires_at
+
+            db.session.commit()
+
+            return True
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            db.session.rollback()
+            return False
+
+    # Define the renew_all method
+    @staticmethod
+    def renew_all():
+        renewed, failed = 0, 0
+
+        # Subscribe every linked account, renewing the ones close to expiring
+        for oauth in Oauth.query.filter(Oauth.service.in_(['google', 'microsoft'])).all():
+            if PushNotifications.subscribe(oauth):
+                renewed += 1
+            else:
+                failed += 1
+
+        return renewed, failed
+
+    # Define the verify_token method
+    @staticmethod
+    def verify_token(token):
+        if not PushNotifications.WEBHOOK_SECRET or not token:
+            return False
+
+        return hmac.compare_digest(token, PushNotifications.WEBHOOK_SECRET)
+
+    # Define the handle_google method
+    @staticmethod
+    def handle_google(payload):
+        try:
+            # Pub/Sub wraps the Gmail notification in a base64 encoded message
+            data = json.loads(base64.b64decode(payload['message']['data']).decode())
+            email = data['emailAddress']
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            return False
+
+        # The same mailbox may be linked by several users
+        accounts = Oauth.query.filter_by(email=email, service='google').all()
+
+        for oauth in accounts:
+            invalidate_mailbox(oauth.id)
+
+        return bool(accounts)
+
+    # Define the handle_microsoft method
+    @staticmethod
+    def handle_microsoft(payload):
+        handled = 0
+
+        for notification in payload.get('value', []):
+            subscription = MailboxSubscription.query.filter_by(
+                subscription_id=notification.get('subscriptionId'),
+                service='microsoft'
+                ).first()
+
+            # Ignore notifications that do not carry the secret of the subscription
+            if not subscription or not hmac.compare_digest(notification.get('clientState') or '', subscription.client_state or ''):
+                continue
+
+            invalidate_mailbox(subscription.oauth_id)
+            handled += 1
+
+        return handled > 0
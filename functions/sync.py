@@ -0,0 +1,614 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from googleapiclient.errors import HttpError
+from sqlalchemy import func
+
+from init import create_logger, db, fernet, redis
+
+from models.mailbox import MailboxMessage, MailboxSync, MailboxSubscription
+
+from .folders import FolderRegistry
+from .message_cache import MessageCache, PageCache
+
+logger = create_logger(__name__)
+
+# Gmail system labels whose ID is the upper-case label name
+SYSTEM_LABELS = ['INBOX', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'STARRED', 'IMPORTANT', 'UNREAD', 'CHAT']
+
+# Prefix of the page tokens handed out for the local message index
+LOCAL_PAGE_PREFIX = 'local:'
+# Prefix of the page tokens handed out for mail older than the indexed window
+OLDER_PAGE_PREFIX = 'older:'
+
+# Seconds between safety-net syncs of accounts kept fresh by push notifications
+PUSH_SYNC_INTERVAL = 900
+
+
+# Define the get_sync_interval function
+def get_sync_interval(oauth_id, interval):
+    # Push notifications invalidate the index, so polling can slow down while a subscription is active
+    subscription = MailboxSubscription.query.filter(
+        MailboxSubscription.oauth_id == oauth_id,
+        MailboxSubscription.expires_at > datetime.utcnow()
+        ).first()
+    
+    return PUSH_SYNC_INTERVAL if subscription else interval
+
+
+# Define the invalidate_mailbox function
+def invalidate_mailbox(oauth_id):
+    # Clearing the sync time makes the next listing sync with the provider
+    MailboxSync.query.filter_by(oauth_id=oauth_id).update({'synced_at': None})
+    db.session.commit()
+    
+    # Folder counts may have changed as well
+    FolderRegistry.invalidate(oauth_id)
+    
+    # Cached pages may be missing new messages
+    PageCache.invalidate(oauth_id)
+
+
+# Define the GmailSync class
+class GmailSync:
+    # Number of most recent messages indexed when an account is first synced
+    SEED_LIMIT = 500
+    # Minimum number of seconds between two incremental syncs of an account
+    SYNC_INTERVAL = 30
+
+    def __init__(self, google, oauth_id):
+        self.google = google
+        self.oauth_id = oauth_id
+
+    # Define the get_state method
+    def get_state(self):
+        return MailboxSync.query.filter_by(oauth_id=self.oauth_id, folder_id=None).first()
+
+    # Define the sync method
+    def sync(self, force=False):
+        state = self.get_state()
+
+        # Skip the provider call if the index was synced recently
+        if state and state.sync_token and state.synced_at and not force:
+            if datetime.utcnow() - state.synced_at < timedelta(seconds=get_sync_interval(self.oauth_id, self.SYNC_INTERVAL)):
+                return True
+
+        # Only one request syncs an account at a time, the others serve the current index
+        lock = redis.lock(f'mailbox_sync_lock_{self.oauth_id}', timeout=120)
+
+        if not lock.acquire(blocking=False):
+            return bool(state and state.sync_token)
+
+        try:
+            if not state or not state.sync_token:
+                return self.seed(state)
+
+            try:
+                return self.apply_history(state)
+            except HttpError as e:
+                # Gmail only keeps a limited history, seed again when the start ID is too old
+                if e.resp.status == 404:
+                    return self.seed(state)
+                raise
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            db.session.rollback()
+            return False
+        finally:
+            try:
+                lock.release()
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the seed method
+    def seed(self, state=None):
+        # Take the history ID first so no change made while seeding is missed
+        history_id = self.google.get_history_id()
+
+        if not history_id:
+            return False
+
+        message_ids = self.google.list_message_ids(max_results=self.SEED_LIMIT)
+
+        if message_ids is None:
+            return False
+
+        MailboxMessage.query.filter_by(oauth_id=self.oauth_id).delete()
+
+        # Keep the previous index and history ID until every message is stored
+        if not self.store_messages(message_ids):
+            db.session.rollback()
+            return False
+
+        if not state:
+            state = MailboxSync(oauth_id=self.oauth_id, folder_id=None)
+            db.session.add(state)
+
+        # Everything newer than the oldest seeded message is indexed, unless the whole mailbox fit
+        state.window_start = db.session.query(func.min(MailboxMessage.received_at)).filter(
+            MailboxMessage.oauth_id == self.oauth_id
+            ).scalar() if len(message_ids) >= self.SEED_LIMIT else None
+        state.sync_token = str(history_id)
+        state.synced_at = datetime.utcnow()
+
+        db.session.commit()
+
+        return True
+
+    # Define the apply_history method
+    def apply_history(self, state):
+        history, history_id = self.google.list_history(state.sync_token)
+
+        changed_ids = set()
+        deleted_ids = set()
+
+        # Collect the messages that were added, deleted or relabelled
+        for record in history:
+            for item in record.get('messagesAdded', []) + record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                changed_ids.add(item['message']['id'])
+            for item in record.get('messagesDeleted', []):
+                deleted_ids.add(item['message']['id'])
+
+        changed_ids -= deleted_ids
+
+        if deleted_ids:
+            MailboxMessage.query.filter(
+                MailboxMessage.oauth_id == self.oauth_id,
+                MailboxMessage.message_id.in_(deleted_ids)
+                ).delete(synchronize_session=False)
+
+        # Apply the same history again on the next sync if a message could not be fetched
+        if changed_ids and not self.store_messages(list(changed_ids), window_start=state.window_start):
+            db.session.rollback()
+            return False
+
+        # New or relabelled messages change the folder counts
+        if changed_ids or deleted_ids:
+            FolderRegistry.invalidate(self.oauth_id)
+
+        state.sync_token = str(history_id)
+        state.synced_at = datetime.utcnow()
+
+        db.session.commit()
+
+        return True
+
+    # Define the store_messages method
+    def store_messages(self, message_ids, window_start=None):
+        """Index the messages, returning False when some of them could not be fetched."""
+        failed = []
+        raw_messages = self.google.fetch_messages_batch(message_ids, view='summary', failed=failed)
+
+        # Load the rows that already exist in one query
+        existing = {
+            row.message_id: row for row in MailboxMessage.query.filter(
+                MailboxMessage.oauth_id == self.oauth_id,
+                MailboxMessage.message_id.in_(list(raw_messages.keys()))
+                ).all()
+        } if raw_messages else {}
+
+        for message_id, raw_message in raw_messages.items():
+            label_ids = raw_message.get('labelIds', [])
+            summary = self.google.parse_message_summary(raw_message)
+
+            row = existing.get(message_id)
+            if not row:
+                # Relabelled mail older than the window is still listed from Gmail
+                if window_start is not None and int(raw_message.get('internalDate', 0)) < window_start:
+                    continue
+
+                row = MailboxMessage(oauth_id=self.oauth_id, message_id=message_id)
+                db.session.add(row)
+
+            row.thread_id = raw_message.get('threadId')
+            row.label_ids = f",{','.join(label_ids)},"
+            row.received_at = int(raw_message.get('internalDate', 0))
+            row.is_read = 'UNREAD' not in label_ids
+            row.data = fernet.encrypt(json.dumps(summary).encode()).decode()
+
+        return not failed
+
+    # Define the resolve_label method
+    def resolve_label(self, folder_name):
+        """Return the label ID of a folder and its message total, the total is None when unknown."""
+        if not folder_name:
+            return None, None
+
+        folder_info = self.google.get_folder(folder_name)
+
+        if folder_info:
+            return folder_info['id'], folder_info.get('messageCount')
+
+        if folder_name.upper() in SYSTEM_LABELS:
+            return folder_name.upper(), None
+
+        return None, None
+
+    # Define the list_messages method
+    def list_messages(self, folder_name=None, next_page=None, max_results=10):
+        state = self.get_state()
+
+        if not state:
+            return None
+
+        # Local rows are listed down to this second, Gmail lists the mail before it
+        boundary = state.window_start // 1000 + 1 if state.window_start is not None else None
+
+        query = MailboxMessage.query.filter(MailboxMessage.oauth_id == self.oauth_id)
+
+        label_id, total_results = self.resolve_label(folder_name)
+        if label_id:
+            query = query.filter(MailboxMessage.label_ids.like(f'%,{label_id},%'))
+        else:
+            # Gmail leaves spam and trash out of unfiltered listings
+            query = query.filter(
+                ~MailboxMessage.label_ids.like('%,SPAM,%'),
+                ~MailboxMessage.label_ids.like('%,TRASH,%')
+                )
+
+        if boundary is not None:
+            query = query.filter(MailboxMessage.received_at >= boundary * 1000)
+
+        indexed = query.count()
+
+        # The label total covers the mail outside the window as well
+        if total_results is None:
+            total_results = indexed
+
+        total_pages = (total_results // max_results) + (1 if total_results % max_results != 0 else 0)
+
+        if next_page and next_page.startswith(OLDER_PAGE_PREFIX):
+            return self.list_older(folder_name, next_page, max_results, total_results, total_pages)
+
+        try:
+            offset = int(next_page[len(LOCAL_PAGE_PREFIX):]) if next_page else 0
+        except ValueError:
+            offset = 0
+
+        rows = query.order_by(MailboxMessage.received_at.desc()).offset(offset).limit(max_results).all()
+
+        # Continue with Gmail once the window runs out
+        if not rows and boundary is not None:
+            return self.list_older(folder_name, f'{OLDER_PAGE_PREFIX}{boundary}:', max_results, total_results, total_pages)
+
+        all_messages = [
+            {
+                'id': row.message_id,
+                'thread_id': row.thread_id,
+                'message': json.loads(fernet.decrypt(row.data.encode()).decode())
+            } for row in rows
+        ]
+
+        if offset + max_results < indexed:
+            next_page = f'{LOCAL_PAGE_PREFIX}{offset + max_results}'
+        elif boundary is not None:
+            next_page = f'{OLDER_PAGE_PREFIX}{boundary}:'
+        else:
+            next_page = None
+
+        data = {
+            'messages': all_messages,
+            'total_results': total_results,
+            'total_pages': total_pages,
+            'next_page': next_page
+        }
+
+        return data
+
+    # Define the list_older method
+    def list_older(self, folder_name, next_page, max_results, total_results, total_pages):
+        # The token carries the boundary it started from, so later syncs do not shift the pages
+        boundary, _, page_token = next_page[len(OLDER_PAGE_PREFIX):].partition(':')
+
+        data = self.google.list_messages(
+            query=f'before:{boundary}',
+            next_page=page_token or None,
+            max_results=max_results,
+            folder_name=folder_name,
+            view='summary'
+            )
+
+        if 'messages' not in data:
+            return data
+
+        data['total_results'] = total_results
+        data['total_pages'] = total_pages
+        data['next_page'] = f'{OLDER_PAGE_PREFIX}{boundary}:{data["next_page"]}' if data.get('next_page') else None
+
+        return data
+
+    # Define the update_message method
+    @staticmethod
+    def update_message(oauth_id, message_id, action):
+        # The action changed the folder counts
+        FolderRegistry.invalidate(oauth_id)
+        
+        # Cached pages still show the old state of the message
+        PageCache.invalidate(oauth_id)
+        
+        # Keep the cached message in step
+        if action == 'delete':
+            MessageCache.delete(oauth_id, message_id)
+        elif action in ('read', 'unread'):
+            MessageCache.set_read(oauth_id, message_id, action == 'read')
+        
+        try:
+            row = MailboxMessage.query.filter_by(oauth_id=oauth_id, message_id=message_id).first()
+
+            if not row:
+                return
+
+            # Apply the action to the index right away instead of waiting for the next sync
+            if action == 'delete':
+                db.session.delete(row)
+            elif action in ('read', 'unread'):
+                label_ids = [label for label in row.label_ids.strip(',').split(',') if label and label != 'UNREAD']
+                if action == 'unread':
+                    label_ids.append('UNREAD')
+
+                data = json.loads(fernet.decrypt(row.data.encode()).decode())
+                data['isRead'] = action == 'read'
+
+                row.label_ids = f",{','.join(label_ids)},"
+                row.is_read = action == 'read'
+                row.data = fernet.encrypt(json.dumps(data).encode()).decode()
+
+            db.session.commit()
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            db.session.rollback()
+
+
+# Define the OutlookSync class
+class OutlookSync:
+    # Number of days of mail indexed when a folder is first synced
+    SEED_DAYS = 90
+    # Minimum number of seconds between two delta syncs of a folder
+    SYNC_INTERVAL = 30
+
+    def __init__(self, microsoft, oauth_id):
+        self.microsoft = microsoft
+        self.oauth_id = oauth_id
+
+    # Define the get_state method
+    def get_state(self, folder_id):
+        return MailboxSync.query.filter_by(oauth_id=self.oauth_id, folder_id=folder_id).first()
+
+    # Define the sync method
+    def sync(self, folder_id, force=False):
+        state = self.get_state(folder_id)
+
+        # Skip the provider call if the folder was synced recently
+        if state and state.sync_token and state.synced_at and not force:
+            if datetime.utcnow() - state.synced_at < timedelta(seconds=get_sync_interval(self.oauth_id, self.SYNC_INTERVAL)):
+                return True
+
+        # Only one request syncs a folder at a time, the others serve the current index
+        lock = redis.lock(f'mailbox_sync_lock_{self.oauth_id}_{folder_id}', timeout=120)
+
+        if not lock.acquire(blocking=False):
+            return bool(state and state.sync_token)
+
+        try:
+            if state and state.sync_token:
+                messages, delta_link, status_code = self.microsoft.get_messages_delta(folder_id, delta_link=state.sync_token)
+
+                # Graph expires old delta links, start over when that happens
+                if status_code == 410:
+                    state.sync_token = None
+                elif messages is None:
+                    return False
+
+            window_start = None
+
+            if not state or not state.sync_token:
+                received_after = (datetime.utcnow() - timedelta(days=self.SEED_DAYS)).replace(microsecond=0)
+                window_start = int(received_after.replace(tzinfo=timezone.utc).timestamp() * 1000)
+                messages, delta_link, status_code = self.microsoft.get_messages_delta(folder_id, received_after=received_after.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+                if messages is None:
+                    return False
+
+                MailboxMessage.query.filter_by(oauth_id=self.oauth_id, folder_id=folder_id).delete()
+
+            self.apply_delta(folder_id, messages)
+
+            # Changed messages change the folder counts
+            if messages:
+                FolderRegistry.invalidate(self.oauth_id)
+
+            if not state:
+                state = MailboxSync(oauth_id=self.oauth_id, folder_id=folder_id)
+                db.session.add(state)
+
+            # Mail received before the seeded days is listed from Graph
+            if window_start is not None:
+                state.window_start = window_start
+
+            state.sync_token = delta_link
+            state.synced_at = datetime.utcnow()
+
+            db.session.commit()
+
+            return True
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            db.session.rollback()
+            return False
+        finally:
+            try:
+                lock.release()
+            except Exception as e:
+                logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+
+    # Define the apply_delta method
+    def apply_delta(self, folder_id, messages):
+        removed_ids = [message['id'] for message in messages if '@removed' in message]
+        changed = {message['id']: message for message in messages if '@removed' not in message}
+
+        # Only remove rows of this folder, a moved message may already belong to another one
+        if removed_ids:
+            MailboxMessage.query.filter(
+                MailboxMessage.oauth_id == self.oauth_id,
+                MailboxMessage.folder_id == folder_id,
+                MailboxMessage.message_id.in_(removed_ids)
+                ).delete(synchronize_session=False)
+
+        if not changed:
+            return
+
+        # Load the rows that already exist in one query
+        existing = {
+            row.message_id: row for row in MailboxMessage.query.filter(
+                MailboxMessage.oauth_id == self.oauth_id,
+                MailboxMessage.message_id.in_(list(changed.keys()))
+                ).all()
+        }
+
+        for message_id, message in changed.items():
+            row = existing.get(message_id)
+
+            if row:
+                # Delta items only carry the fields that changed, merge them into the stored message
+                message = {**self.load_message(row), **message}
+            else:
+                row = MailboxMessage(oauth_id=self.oauth_id, message_id=message_id)
+                db.session.add(row)
+
+            summary = self.microsoft.parse_message_summary(message)
+            received = message.get('receivedDateTime')
+
+            row.folder_id = folder_id
+            row.received_at = int(datetime.fromisoformat(received.replace('Z', '+00:00')).timestamp() * 1000) if received else 0
+            row.is_read = summary.get('isRead', False)
+            row.data = fernet.encrypt(json.dumps({**message, '@summary': summary}).encode()).decode()
+
+    # Define the load_message method
+    @staticmethod
+    def load_message(row):
+        message = json.loads(fernet.decrypt(row.data.encode()).decode())
+        message.pop('@summary', None)
+        return message
+
+    # Define the list_messages method
+    def list_messages(self, folder_info, next_page=None, max_results=10):
+        state = self.get_state(folder_info['id'])
+
+        if not state:
+            return None
+
+        query = MailboxMessage.query.filter_by(oauth_id=self.oauth_id, folder_id=folder_info['id'])
+
+        if state.window_start is not None:
+            query = query.filter(MailboxMessage.received_at >= state.window_start)
+
+        indexed = query.count()
+
+        # The folder total covers the mail outside the window as well
+        total_results = max(folder_info.get('messageCount') or 0, indexed)
+        total_pages = (total_results // max_results) + (1 if total_results % max_results != 0 else 0)
+
+        # Older mail is only left when the folder holds more than the window
+        older = state.window_start is not None and indexed < total_results
+
+        if next_page and next_page.startswith(OLDER_PAGE_PREFIX):
+            return self.list_older(folder_info, next_page, max_results, total_results, total_pages)
+
+        try:
+            offset = int(next_page[len(LOCAL_PAGE_PREFIX):]) if next_page else 0
+        except ValueError:
+            offset = 0
+
+        rows = query.order_by(MailboxMessage.received_at.desc()).offset(offset).limit(max_results).all()
+
+        # Continue with Graph once the window runs out
+        if not rows and older:
+            return self.list_older(folder_info, f'{OLDER_PAGE_PREFIX}{state.window_start}', max_results, total_results, total_pages)
+
+        all_messages = [
+            {
+                'id': row.message_id,
+                'message': json.loads(fernet.decrypt(row.data.encode()).decode())['@summary']
+            } for row in rows
+        ]
+
+        if offset + max_results < indexed:
+            next_page = f'{LOCAL_PAGE_PREFIX}{offset + max_results}'
+        elif older:
+            next_page = f'{OLDER_PAGE_PREFIX}{state.window_start}'
+        else:
+            next_page = None
+
+        data = {
+            'messages': all_messages,
+            'total_results': total_results,
+            'total_pages': total_pages,
+            'next_page': next_page
+        }
+
+        return data
+
+    # Define the list_older method
+    def list_older(self, folder_info, next_page, max_results, total_results, total_pages):
+        page = next_page[len(OLDER_PAGE_PREFIX):]
+
+        # The first page starts from the window boundary, the later ones follow the Graph next links
+        if not page.startswith('https://'):
+            try:
+                received_before = datetime.fromtimestamp(int(page) / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            except ValueError:
+                return None
+
+            page = (
+                f"https://graph.microsoft.com/v1.0/me/mailFolders/{folder_info['id']}/messages"
+                f"?$filter=receivedDateTime+lt+{received_before}&$orderby=receivedDateTime+desc"
+                f"&$top={max_results}&$count=true&$select={self.microsoft.SUMMARY_FIELDS}"
+            )
+
+        data = self.microsoft.list_messages(next_page=page, max_results=max_results, folder_name=folder_info['name'], view='summary')
+
+        if not data:
+            return data
+
+        data['total_results'] = total_results
+        data['total_pages'] = total_pages
+        data['next_page'] = f'{OLDER_PAGE_PREFIX}{data["next_page"]}' if data.get('next_page') else None
+
+        return data
+
+    # Define the update_message method
+    @staticmethod
+    def update_message(oauth_id, message_id, action):
+        # The action changed the folder counts
+        FolderRegistry.invalidate(oauth_id)
+        
+        # Cached pages still show the old state of the message
+        PageCache.invalidate(oauth_id)
+        
+        # Keep the cached message in step
+        if action == 'delete':
+            MessageCache.delete(oauth_id, message_id)
+        elif action in ('read', 'unread'):
+            MessageCache.set_read(oauth_id, message_id, action == 'read')
+        
+        try:
+            row = MailboxMessage.query.filter_by(oauth_id=oauth_id, message_id=message_id).first()
+
+            if not row:
+                return
+
+            # Apply the action to the index right away instead of waiting for the next sync
+            if action == 'delete':
+                db.session.delete(row)
+            elif action in ('read', 'unread'):
+                data = json.loads(fernet.decrypt(row.data.encode()).decode())
+                data['isRead'] = action == 'read'
+                data['@summary']['isRead'] = action == 'read'
+
+                row.is_read = action == 'read'
+                row.data = fernet.encrypt(json.dumps(data).encode()).decode()
+
+            db.session.commit()
+        except Exception as e:
+            logger.error('{} at line {}'.format(e, e.__traceback__.tb_lineno))
+            db.session.rollback()
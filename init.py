@@ -66,6 +66,12 @@ def create_app():
     app.config['FLASK_ENV'] = env.get('FLASK_ENV')
     app.config['FLASK_DEBUG'] = bool(env.get('FLASK_DEBUG'))
     app.config['SECRET_KEY'] = env.get('SECRET_KEY')
+    
+    # The signed URLs, such as the inline image proxy, cannot be trusted without a secret key
+    if not env.get('SECRET_KEY'):
+        logger.error('SECRET_KEY is not set')
+        exit(1)
+    
     app.config['JWT_SECRET_KEY'] = env.get('JWT_SECRET_KEY')
     app.config['JWT_COOKIE_SECURE'] = bool(env.get('JWT_COOKIE_SECURE'))
     app.config['JWT_TOKEN_LOCATION'] = ['headers', 'cookies']
@@ -124,8 +130,10 @@ def create_app():
     from models.role import Role, UserRoles
     from models.contact import Contact, UserContacts
     from models.chat import Chat, ChatMessages
+    from models.mailbox import MailboxMessage, MailboxSync, MailboxSubscription
     
     from loader import FlaskErrorLoaders, JWTErrorLoaders, JWTUserCallbacks, TemplateFilters
+    from commands import PushCommands, AICommands
     
     # initialize JWT and migrate
     jwt.init_app(app)
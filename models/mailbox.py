@@ -0,0 +1,44 @@
+from sqlalchemy.sql import func
+from init import db
+
+class MailboxMessage(db.Model):
+    __tablename__ = 'mailbox_messages'
+    id = db.Column(db.Integer, primary_key=True)
+    oauth_id = db.Column(db.Integer, db.ForeignKey('user_oauth.id', ondelete='CASCADE'), nullable=False, index=True)
+    message_id = db.Column(db.String(255), nullable=False)
+    thread_id = db.Column(db.String(255), nullable=True)
+    folder_id = db.Column(db.String(255), nullable=True)
+    label_ids = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.BigInteger, nullable=False, default=0)
+    is_read = db.Column(db.Boolean, default=True)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+    updated_at = db.Column(db.DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        db.UniqueConstraint('oauth_id', 'message_id', name='uq_mailbox_message'),
+        db.Index('ix_mailbox_messages_received', 'oauth_id', 'received_at'),
+    )
+
+class MailboxSync(db.Model):
+    __tablename__ = 'mailbox_sync'
+    id = db.Column(db.Integer, primary_key=True)
+    oauth_id = db.Column(db.Integer, db.ForeignKey('user_oauth.id', ondelete='CASCADE'), nullable=False, index=True)
+    folder_id = db.Column(db.String(255), nullable=True)
+    sync_token = db.Column(db.Text, nullable=True)
+    synced_at = db.Column(db.DateTime, nullable=True)
+    # Received time of the oldest indexed message, older mail is listed from the provider (None when everything is indexed)
+    window_start = db.Column(db.BigInteger, nullable=True)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+    updated_at = db.Column(db.DateTime, server_default=func.now(), onupdate=func.now())
+
+class MailboxSubscription(db.Model):
+    __tablename__ = 'mailbox_subscriptions'
+    id = db.Column(db.Integer, primary_key=True)
+    oauth_id = db.Column(db.Integer, db.ForeignKey('user_oauth.id', ondelete='CASCADE'), nullable=False, index=True)
+    service = db.Column(db.String(50), nullable=False)
+    subscription_id = db.Column(db.String(255), nullable=True, index=True)
+    client_state = db.Column(db.String(255), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+    updated_at = db.Column(db.DateTime, server_default=func.now(), onupdate=func.now())
@@ -347,7 +347,162 @@ function deleteContact(contact_id) {
     });
 }
 
-function generateNewEmail(contacts, instruction, languageTone, length, oauth_id) {
+function readEventStream(response, handlers) {
+    return new Promise(async (resolve, reject) => {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        try {
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+
+                buffer += decoder.decode(value, { stream: true });
+
+                // Events are separated by a blank line
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const raw = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let event = 'message';
+                    let payload = '';
+                    raw.split('\n').forEach((line) => {
+                        if (line.startsWith('event:')) event = line.slice(6).trim();
+                        else if (line.startsWith('data:')) payload += line.slice(5).trim();
+                    });
+
+                    const message = payload ? JSON.parse(payload) : {};
+
+                    if (event === 'done' || event === 'error' || event === 'cancelled') {
+                        reader.cancel();
+                        event === 'done' ? resolve(message) : reject(message);
+                        return;
+                    }
+
+                    if (handlers[event]) handlers[event](message);
+                }
+            }
+        } catch (error) {
+            reject({ message: error.message });
+            return;
+        }
+
+        reject({ message: 'The connection closed before the email was generated.' });
+    });
+}
+
+function streamGeneratedEmail(type, data, handlers) {
+    return new Promise((resolve, reject) => {
+        fetch(`${API_URL}/chat/generate`, {
+            method: type,
+            credentials: 'include',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream',
+                'X-CSRF-Token': CSRF_TOKEN
+            },
+            body: JSON.stringify(Object.assign({}, data, { stream: true }))
+        }).then(async (response) => {
+            if (!response.ok) {
+                let message = await response.json().catch(() => null);
+                reject(message || 'Unknown error occurred.');
+                return;
+            }
+
+            // A queued job is streamed from the job worker instead
+            if (response.status === 202) {
+                const job = await response.json();
+                if (handlers.queued) handlers.queued(job);
+                return streamJob(job.job_id, handlers).then(resolve, reject);
+            }
+
+            return readEventStream(response, handlers).then(resolve, reject);
+        }).catch((error) => {
+            reject({ message: error.message });
+        });
+    });
+}
+
+function streamJob(job_id, handlers) {
+    return fetch(`${API_URL}/chat/job/${job_id}/stream`, {
+        credentials: 'include',
+        headers: {
+            'Accept': 'text/event-stream'
+        }
+    }).then(async (response) => {
+        if (!response.ok) {
+            let message = await response.json().catch(() => null);
+            throw message || 'Unknown error occurred.';
+        }
+
+        return readEventStream(response, handlers);
+    });
+}
+
+function waitForJob(job_id, interval = 1000) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            $.ajax({
+                type: 'GET',
+                url: `${API_URL}/chat/job/${job_id}`,
+                xhrFields: {
+                    withCredentials: true
+                },
+                success: function (job) {
+                    if (job.status === 'done') {
+                        resolve(job.result);
+                    } else if (job.status === 'failed' || job.status === 'cancelled') {
+                        reject({ message: job.message || `The request was ${job.status}.` });
+                    } else {
+                        setTimeout(poll, interval);
+                    }
+                },
+                error: function (xhr) {
+                    let message = xhr.responseJSON || 'Unknown error occurred.';
+                    reject(message);
+                }
+            });
+        };
+        poll();
+    });
+}
+
+function cancelJob(job_id) {
+    return new Promise((resolve, reject) => {
+        $.ajax({
+            type: 'DELETE',
+            url: `${API_URL}/chat/job/${job_id}`,
+            xhrFields: {
+                withCredentials: true
+            },
+            headers: {
+                'X-CSRF-Token': CSRF_TOKEN
+            },
+            success: function (response) {
+                resolve(response);
+            },
+            error: function (xhr) {
+                let message = xhr.responseJSON || 'Unknown error occurred.';
+                reject(message);
+            }
+        });
+    });
+}
+
+function generateNewEmail(contacts, instruction, languageTone, length, oauth_id, handlers = null) {
+    // Stream the email as it is generated when handlers are given
+    if (handlers) {
+        return streamGeneratedEmail('POST', {
+            contacts: contacts,
+            instruction: instruction,
+            language_tone: languageTone,
+            length: length,
+            oauth_id: oauth_id
+        }, handlers);
+    }
+
     return new Promise((resolve, reject) => {
         $.ajax({
             type: 'POST',
@@ -367,7 +522,8 @@ function generateNewEmail(contacts, instruction, languageTone, length, oauth_id)
                 'X-CSRF-Token': CSRF_TOKEN
             },
             success: function (response) {
-                resolve(response);
+                // A queued job resolves once the job worker finishes it
+                response.job_id ? waitForJob(response.job_id).then(resolve, reject) : resolve(response);
             },
             error: function (xhr) {
                 let message = xhr.responseJSON || 'Unknown error occurred.';
@@ -377,7 +533,18 @@ function generateNewEmail(contacts, instruction, languageTone, length, oauth_id)
     });
 }
 
-function generateModifyEmail(chat_id, contacts, instruction, languageTone, length) {
+function generateModifyEmail(chat_id, contacts, instruction, languageTone, length, handlers = null) {
+    // Stream the email as it is generated when handlers are given
+    if (handlers) {
+        return streamGeneratedEmail('PUT', {
+            chat_id: chat_id,
+            contacts: contacts,
+            instruction: instruction,
+            language_tone: languageTone,
+            length: length
+        }, handlers);
+    }
+
     return new Promise((resolve, reject) => {
         $.ajax({
             type: 'PUT',
@@ -397,7 +564,8 @@ function generateModifyEmail(chat_id, contacts, instruction, languageTone, lengt
                 'X-CSRF-Token': CSRF_TOKEN
             },
             success: function (response) {
-                resolve(response);
+                // A queued job resolves once the job worker finishes it
+                response.job_id ? waitForJob(response.job_id).then(resolve, reject) : resolve(response);
             },
             error: function (xhr) {
                 let message = xhr.responseJSON || 'Unknown error occurred.';
@@ -675,7 +843,8 @@ function paraphrase(text, message_id, selectedType, position) {
             },
 
             success: function (response) {
-                resolve(response);
+                // A queued job resolves once the job worker finishes it
+                response.job_id ? waitForJob(response.job_id).then(resolve, reject) : resolve(response);
             },
             error: function (xhr) {
                 let error = xhr.responseJSON || 'Unknown error occurred.';
@@ -734,7 +903,9 @@ function getInboxMessages(service, id, folder, max_result = 10, query = null, ne
 
         const data = {
             folder_name: folder || 'inbox',
-            max_result: max_result || 10
+            max_result: max_result || 10,
+            view: 'summary',
+            prefetch: true
         };
 
         if (query) data.query = query;
@@ -833,7 +1004,7 @@ function replyInboxMessage(service, id, message_id, body, subject) {
     });
 }
 
-function generateSmartReply(subject, body, sender, instruction, oauthId) {
+function generateSmartReply(subject, messageId, sender, instruction, oauthId) {
     return new Promise((resolve, reject) => {
         $.ajax({
             type: 'POST',
@@ -841,7 +1012,7 @@ function generateSmartReply(subject, body, sender, instruction, oauthId) {
             contentType: 'application/json',
             data: JSON.stringify({
                 subject: subject,
-                body: body,
+                message_id: messageId,
                 sender: sender,
                 oauth_id: oauthId,
                 instruction: instruction
@@ -854,7 +1025,8 @@ function generateSmartReply(subject, body, sender, instruction, oauthId) {
             },
 
             success: function (response) {
-                resolve(response);
+                // A queued job resolves once the job worker finishes it
+                response.job_id ? waitForJob(response.job_id).then(resolve, reject) : resolve(response);
             },
             error: function (xhr) {
                 let error = xhr.responseJSON || 'Unknown error occurred.';
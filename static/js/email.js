@@ -615,6 +615,81 @@ function createEmail(subject, body, messageId, animate = true, emailSent = false
   if (!emailSent) emailSelection(); // Initialize the email selection functionality
 }
 
+/**
+ * Show a cancel button while a queued email generation runs
+ * @param {jQuery} $button - The button the cancel button is placed after
+ * @param {string} job_id - The ID of the queued job
+ * @returns {jQuery} The cancel button
+ */
+function createCancelJobButton($button, job_id) {
+  const $cancelBtn = $(`<button type="button" class="btn btn-outline-danger px-4">Cancel</button>`);
+
+  $cancelBtn.on('click', function () {
+    $cancelBtn.prop('disabled', true);
+    // The stream ends with a cancelled event once the job stops
+    cancelJob(job_id).catch((error) => {
+      toast(error.message ? error.message : "An error occurred", "error");
+      $cancelBtn.prop('disabled', false);
+    });
+  });
+
+  $button.after($cancelBtn);
+  return $cancelBtn;
+}
+
+/**
+ * Create an email message that fills in while it is generated
+ * @returns {object} update(token) appends generated text, finish(subject, body, messageId) shows the saved email, remove() drops it
+ */
+function createStreamingEmail() {
+  // Get the chat box and create a new message box
+  const $lastAction = $('.email-actions').last();
+  $lastAction.remove();
+  const $chatBox = $('#chatBox');
+  const $messageBox = $(`<div class="message bot-message"></div>`);
+  const $emailSubject = $(`<div class="email-subject"></div>`);
+  const $emailBody = $(`<div class="email-body"></div>`);
+
+  $chatBox.append($messageBox);
+  $messageBox.append($emailSubject);
+  $messageBox.append($emailBody);
+
+  let text = ''; // Generated text so far
+
+  return {
+    update(token) {
+      text += token;
+
+      // Split the text the way the server does, "Subject: ..." then "Body: ..."
+      const start = text.indexOf('Subject:');
+      if (start === -1) return;
+
+      const rest = text.slice(start + 'Subject:'.length);
+      const bodyStart = rest.indexOf('Body:');
+      const lineEnd = rest.indexOf('\n');
+      const subjectEnd = bodyStart !== -1 ? bodyStart : (lineEnd !== -1 ? lineEnd : rest.length);
+      let body = rest.slice(subjectEnd).replace(/^\s+/, '');
+
+      // Hide a "Body:" label that is still arriving
+      if ('Body:'.startsWith(body)) body = '';
+      body = body.replace(/^Body:\s*/, '');
+
+      $emailSubject.text(rest.slice(0, subjectEnd).trim());
+      $emailBody.text(body);
+      // Scroll to the bottom of the chat box
+      $chatBox.scrollTop($chatBox[0].scrollHeight);
+    },
+    finish(subject, body, messageId) {
+      // Replace the streamed text with the saved email and add its actions
+      $messageBox.remove();
+      createEmail(subject, body, messageId, false);
+    },
+    remove() {
+      $messageBox.remove();
+    }
+  };
+}
+
 /**
  * Initialize the chat functionality
  */
@@ -679,14 +754,28 @@ function sendChat() {
       ];
 
 
+      let $streamingEmail = null; // Email that fills in while it is generated
+      let $cancelBtn = null; // Cancels the generation while it is queued or running
+
       // Generate the email based on the chat message
-      generateModifyEmail($chatId, contacts, $instruction, $languageTone, $emailLength).then((response) => {
+      generateModifyEmail($chatId, contacts, $instruction, $languageTone, $emailLength, {
+        queued: (job) => {
+          $cancelBtn = createCancelJobButton($chatBtn, job.job_id);
+        },
+        start: () => {
+          $streamingEmail = createStreamingEmail();
+        },
+        token: (data) => {
+          $streamingEmail.update(data.text);
+        }
+      }).then((response) => {
         const $output = response.output;
         const $subject = $output.subject;
         const $email = $output.body;
         const $messageId = response.assistant_message_id;
         const $chatBot = $('#chatBot');
-        createEmail($subject, $email, $messageId);
+        if ($cancelBtn) $cancelBtn.remove();
+        $streamingEmail.finish($subject, $email, $messageId);
         window.scrollBy(0, $chatBot[0].scrollHeight);
         $chatInput.prop('disabled', false);
         $chatBtn.text('Send');
@@ -695,6 +784,9 @@ function sendChat() {
         error_message = error.message ? error.message : "An error occurred";
         // Display an error message
         toast(error_message, "error");
+        // Remove the partly generated email
+        if ($streamingEmail) $streamingEmail.remove();
+        if ($cancelBtn) $cancelBtn.remove();
         sendMessage('bot', 'Error generating email. Please try again.');
         $chatInput.prop('disabled', false);
         $chatBtn.text('Send');
@@ -843,8 +935,23 @@ function generateEmail() {
       }
     ];
 
-    // Generate the email based on the prompt
-    generateNewEmail(contacts, $instruction, $languageTone, $emailLength, $emailFromId).then((response) => {
+    let $streamingEmail = null; // Email that fills in while it is generated
+    let $cancelBtn = null; // Cancels the generation while it is queued or running
+
+    // Generate the email based on the prompt, the chat opens as soon as the server starts streaming
+    generateNewEmail(contacts, $instruction, $languageTone, $emailLength, $emailFromId, {
+      queued: (job) => {
+        $cancelBtn = createCancelJobButton($generateBtn, job.job_id); // Let the user cancel the queued job
+      },
+      start: (data) => {
+        createChatBot(data.chat_id); // Create the chat bot interface
+        sendMessage('user', $instruction); // Send the user message to the chat box
+        $streamingEmail = createStreamingEmail(); // Create the email message
+      },
+      token: (data) => {
+        $streamingEmail.update(data.text);
+      }
+    }).then((response) => {
       const $chat_id = response.chat_id; // Get the chat ID
       const $output = response.output; // Get the email output
       const $subject = $output.subject; // Get the email subject
@@ -852,10 +959,8 @@ function generateEmail() {
       const $messageId = response.assistant_message_id; // Get the message ID
       const $chatBot = $('#chatBot'); // Get the chat bot
 
-      createChatBot($chat_id); // Create the chat bot interface
-      sendMessage('user', $instruction); // Send the user message to the chat box
-
-      createEmail($subject, $email, $messageId, true); // Create the email message
+      if ($cancelBtn) $cancelBtn.remove(); // The job is over
+      $streamingEmail.finish($subject, $email, $messageId); // Show the saved email
       toast('Email generated successfully.', 'success'); // Display a success toast message
       $generateBtn.text('Generate Email'); // Change the generate email button text
       chatHistory(); // Refresh the chat history
@@ -865,6 +970,8 @@ function generateEmail() {
       error_message = error.message ? error.message : "An error occurred";
       // Display an error message
       toast(error_message, "error");
+      if ($streamingEmail) $streamingEmail.remove(); // Remove the partly generated email
+      if ($cancelBtn) $cancelBtn.remove(); // The job is over
       $generateBtn.text('Generate Email'); // Change the generate email button text
       $emailPrompt.prop('disabled', false); // Enable the email prompt text area
       $promptPreset.prop('disabled', false); // Enable the prompt preset select field
@@ -270,7 +270,7 @@ function getMessages($service, $id, $folderName, $next_page = null, $query = nul
             const $subject = $messageData.subject ? $messageData.subject.replace(/</g, '&lt;').replace(/>/g, '&gt;') : 'No Subject';
             const $dateStr = $messageData.date;
             const $isRead = $messageData.isRead;
-            const $attachments = $messageData.attachments;
+            const $hasAttachments = $messageData.hasAttachments;
 
             const $date = new Date($dateStr);
             const currentCategory = getDateCategory($date);
@@ -281,8 +281,8 @@ function getMessages($service, $id, $folderName, $next_page = null, $query = nul
             }
 
             const isUnreadClass = !$isRead ? 'fw-bold border-start border-4 border-primary bg-light unread' : '';
-            const attachmentIcon = $attachments.length > 0
-                ? `<i class="bi bi-paperclip text-muted me-2" title="${$attachments.length} attachment${$attachments.length > 1 ? 's' : ''}"></i>`
+            const attachmentIcon = $hasAttachments
+                ? `<i class="bi bi-paperclip text-muted me-2" title="Has attachments"></i>`
                 : '';
 
             $messageList.append(`
@@ -568,7 +568,7 @@ function getMessage($service, $id, $emailId) {
                 <div><i class="bi bi-paperclip me-2"></i>${attachment.filename}</div>
                 <div>
                   <span class="text-muted small me-3">${attachment.size} KB</span>
-                  <button class="btn btn-sm btn-outline-primary">Download</button>
+                  <a class="btn btn-sm btn-outline-primary" href="/api/link/${$service}/${$id}/message/${encodeURIComponent($emailId)}/attachment/${encodeURIComponent(attachment.attachment_id)}" download="${attachment.filename}">Download</a>
                 </div>
               </li>`).join('')}
               </ul>
@@ -652,8 +652,7 @@ function smartReply() {
             },
             preConfirm: (instruction) => {
                 const $emailSubject = $('#emailSubject').val();
-                const $iframe = $('#emailContentIframe').contents();
-                const $emailBody = $iframe.find('html').html();
+                const $emailId = $('#emailId').text().trim();
                 let $emailSender;
                 const $fromName = $('#fromName').text().trim();
                 const $fromEmail = $('#fromEmail').text().trim();
@@ -664,7 +663,7 @@ function smartReply() {
                 }
                 const $oauthId = Number($('#selectInbox').val());
 
-                return generateSmartReply($emailSubject, $emailBody, $emailSender, instruction, $oauthId)
+                return generateSmartReply($emailSubject, $emailId, $emailSender, instruction, $oauthId)
                     .then((data) => {
                         return data.reply;
                     })